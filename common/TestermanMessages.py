@@ -23,6 +23,7 @@
 
 import re
 import base64
+import struct
 import zlib
 import cPickle as pickle
 import JSON
@@ -36,6 +37,30 @@ HEADERLINE_REGEXP = re.compile(r'(?P<header>[a-zA-Z0-9_-]+)\s*:\s*(?P<value>.*)'
 REQUESTLINE_REGEXP = re.compile(r'(?P<method>[a-zA-Z0-9_-]+)\s*(?P<uri>[^\s]*)\s*(?P<protocol>[a-zA-Z0-9_-]+)/(?P<version>[0-9\.]+)')
 STATUSLINE_REGEXP = re.compile(r'(?P<status>[0-9]+)\s*(?P<reason>.*)')
 
+# Binary message format, used over binary framed connections
+# (see TestermanNodes) instead of the text format:
+# <marker><kind><header block length, 4 bytes, network order><header block><body>
+# where:
+# - marker is BINARY_MARKER, that cannot start a text message,
+# - kind is BINARY_KIND_REQUEST (requests, notifications) or BINARY_KIND_RESPONSE,
+# - the header block is a \x00-separated list of:
+#   method, uri, protocol, version (requests) or status code, reason (responses),
+#   then header name, header value pairs. Well-known header names are
+#   replaced with a single byte code (see BINARY_HEADER_NAMES).
+# - the body is sent as is, up to the end of the frame.
+# Bodies are never base64-encoded: a base64 body is decoded before being sent,
+# and the received message has a "none" Content-Encoding.
+BINARY_MARKER = '\x01'
+BINARY_KIND_REQUEST = 'Q'
+BINARY_KIND_RESPONSE = 'R'
+BINARY_HEADER_NAMES = [ 'Type', 'Transaction-Id', 'User-Agent', 'Contact', 
+	'Content-Encoding', 'Content-Type', 'Reason', 'Log-Class', 'Log-Timestamp', 
+	'Log-Filename', 'SUT-Address', 'Probe-Name', 'Probe-Type', 'Probe-Uri', 
+	'Agent-Uri', 'Path', 'File-Type', 'File-Path', 'File-Name' ]
+# Codes start at \x02 (\x00 is the separator, \x01 is kept as a reserved value)
+_BinaryHeaderCodes = dict([ (name, chr(i + 2)) for (i, name) in enumerate(BINARY_HEADER_NAMES) ])
+_BinaryHeaderNames = dict([ (chr(i + 2), name) for (i, name) in enumerate(BINARY_HEADER_NAMES) ])
+
 class Uri(object):
 	"""
 	Testerman URI object.
@@ -301,7 +326,12 @@ def parse(data):
 	"""
 	Parses data into a Message (either a Notification, Request, Response, actually).
 	Raises an exception in case of an invalid message.
+	
+	Accepts both text and binary (see encodeBinary()) formats.
 	"""
+	if data[:1] == BINARY_MARKER:
+		return parseBinary(data)
+
 	lines = data.split(SEPARATOR)
 
 	# request line, for request and notifications
@@ -336,3 +366,80 @@ def parse(data):
 
 	# OK, we're done.
 	return message
+
+
+##
+# Binary format
+##
+
+def encodeBinary(message):
+	"""
+	Encodes a message to the binary format, to send over
+	binary framed connections.
+	
+	@type  message: Message
+	@param message: the message to encode
+	
+	@rtype: string (not unicode)
+	@returns: the encoded message
+	"""
+	body = message.body
+	headers = message.headers
+	if body and headers.get("Content-Encoding") == Message.ENCODING_BASE64:
+		# Raw binary bodies are supported - no need to keep them base64-encoded
+		body = base64.decodestring(body)
+		headers = headers.copy()
+		headers["Content-Encoding"] = Message.ENCODING_NONE
+	
+	if isinstance(message, Response):
+		kind = BINARY_KIND_RESPONSE
+		fields = [ str(message.statusCode), str(message.reasonPhrase) ]
+	else:
+		kind = BINARY_KIND_REQUEST
+		fields = [ message.method, str(message.uri), message.protocol, message.version ]
+	codes = _BinaryHeaderCodes
+	for (h, v) in headers.items():
+		fields.append(codes.get(h, h))
+		fields.append(v)
+	headerBlock = '\x00'.join(fields)
+	return ''.join([ BINARY_MARKER, kind, struct.pack('!I', len(headerBlock)), headerBlock, body or '' ])
+
+def parseBinary(data):
+	"""
+	Parses a binary-encoded message (see encodeBinary()).
+	Raises an exception in case of an invalid message.
+	
+	@type  data: string (not unicode)
+	@param data: the encoded message
+	
+	@rtype: Message
+	@returns: the decoded message
+	"""
+	if len(data) < 6 or data[0] != BINARY_MARKER:
+		raise Exception("Invalid binary message")
+	kind = data[1]
+	(length, ) = struct.unpack('!I', data[2:6])
+	fields = data[6:6+length].split('\x00')
+	if kind == BINARY_KIND_REQUEST:
+		if len(fields) < 4:
+			raise Exception("Invalid binary request")
+		message = Request(method = fields[0].upper(), uri = Uri(fields[1]), protocol = fields[2], version = fields[3])
+		start = 4
+	elif kind == BINARY_KIND_RESPONSE:
+		if len(fields) < 2:
+			raise Exception("Invalid binary response")
+		message = Response(statusCode = fields[0], reasonPhrase = fields[1])
+		start = 2
+	else:
+		raise Exception("Invalid binary message kind (%s)" % repr(kind))
+
+	if (len(fields) - start) % 2:
+		raise Exception("Invalid binary message header block")
+	names = _BinaryHeaderNames
+	headers = message.headers
+	for i in xrange(start, len(fields), 2):
+		name = fields[i]
+		headers[names.get(name, name)] = fields[i+1]
+
+	message.setBody(data[6+length:])
+	return message
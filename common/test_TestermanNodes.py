@@ -0,0 +1,251 @@
+##
+# TestermanNodes packetizing and synchronous requests test tool.
+#
+# Feeds the packet framers/receive buffers with large and small packets,
+# received in small segments.
+#
+# Checks that a client whose send queue is full still gets the responses to
+# its requests, only notifications being discarded.
+#
+# Then checks that synchronous requests (executeRequest()) are released
+# when the node stops, and measures them on loopback round-trips:
+# 3000 requests sent by 1, 10 and 100 requester threads.
+#
+# Reference figures (Python 2.7.18, single-core Linux VM), mean latency /
+# CPU time per request (client + server nodes), vs the previous polling loop:
+# - 1 requester: 0.24 ms / 0.23 ms vs 0.35 ms / 0.33 ms
+# - 10 requesters: 2.2 ms / 0.22 ms vs 4.7 ms / 0.47 ms
+# - 100 requesters: 18 ms / 0.18 ms vs 338 ms / 3.5 ms
+##
+
+import TestermanNodes as Nodes
+import TestermanMessages as Messages
+
+import resource
+import struct
+import threading
+import time
+
+
+class FakeSocket:
+	"""
+	Delivers data by chunks, through recv() or recv_into().
+	"""
+	def __init__(self, data, chunkSize):
+		self.data = data
+		self.chunkSize = chunkSize
+		self.offset = 0
+
+	def recv(self, size):
+		size = min(size, self.chunkSize)
+		ret = self.data[self.offset:self.offset+size]
+		self.offset += len(ret)
+		return ret
+
+	def recv_into(self, buf, size):
+		data = self.recv(size)
+		buf[0:len(data)] = data
+		return len(data)
+
+
+def receiveAll(framer, data, chunkSize):
+	"""
+	Receives data through the framer by chunks of chunkSize bytes.
+	Returns the received packets and the elapsed time.
+	"""
+	sock = FakeSocket(data, chunkSize)
+	packets = []
+	start = time.time()
+	while framer.receive(sock, 65535):
+		packets += framer.packets()
+	return (packets, time.time() - start)
+
+def textFrame(packets):
+	return ''.join([ p + '\x00' for p in packets ])
+
+def binaryFrame(packets):
+	return ''.join([ struct.pack('!I', len(p)) + p for p in packets ])
+
+
+def test_large_message(bufferClass):
+	"""
+	A 50MB message received in 1KB chunks.
+	"""
+	message = ('abcdefghijklmnopqrstuvwxyz0123456789' * 1500000)[:50*1024*1024]
+	for (label, frame, binary) in [ ('text', textFrame, False), ('binary', binaryFrame, True) ]:
+		framer = Nodes.PacketFramer(None)
+		framer._buf = bufferClass()
+		framer.binary_receive = binary
+		(packets, duration) = receiveAll(framer, frame([ 'before', message, 'after' ]), 1024)
+		print "%s, %s framing: 50MB message received in 1KB chunks in %.2fs" % (bufferClass.__name__, label, duration)
+		assert(packets == [ 'before', message, 'after' ])
+		assert(len(framer._buf) == 0)
+
+def test_small_messages(bufferClass):
+	"""
+	Small messages and keep-alives, spanning chunks of several sizes,
+	then a switch to binary framing.
+	"""
+	messages = [ 'message %d %s' % (i, 'x' * (i % 300)) for i in range(2000) ]
+	textPart = textFrame(messages[:1000] + [ Nodes.KEEP_ALIVE_PDU, Nodes.BINARY_FRAMING_ACCEPT_PDU ])
+	binaryPart = binaryFrame(messages[1000:1500] + [ '' ] + messages[1500:])
+	for chunkSize in [ 1, 7, 1024, 65535 ]:
+		sent = []
+		framer = Nodes.PacketFramer(sent.append)
+		framer._buf = bufferClass()
+		(packets, duration) = receiveAll(framer, textPart + binaryPart, chunkSize)
+		assert(packets == messages)
+		assert(framer.binary_receive and framer.binary_send)
+		assert(sent == [ Nodes.BINARY_FRAMING_SWITCH_PDU + '\x00' ])
+		# feed() has the same behaviour
+		framer = Nodes.PacketFramer(sent.append)
+		framer._buf = bufferClass()
+		packets = []
+		data = textPart + binaryPart
+		for offset in range(0, len(data), chunkSize):
+			packets += framer.feed(data[offset:offset+chunkSize])
+		assert(packets == messages)
+	print "%s: small messages OK" % bufferClass.__name__
+
+
+class EchoServer(Nodes.ListeningNode):
+	"""
+	Responds to all requests, except the IGNORE ones.
+	"""
+	def onRequest(self, channel, transactionId, request):
+		if request.getMethod() != 'IGNORE':
+			self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+
+class Client(Nodes.ConnectingNode):
+	pass
+
+def startNodes(port):
+	server = EchoServer("server", "test/1.0")
+	server.initialize(('127.0.0.1', port))
+	server.start()
+	client = Client("client", "test/1.0")
+	client.initialize(('127.0.0.1', port))
+	client.start()
+	# Waits for the connection
+	while client.executeRequest(None, Messages.Request("TEST", "x:y", "XC", "1.0"), responseTimeout = 0.5) is None:
+		pass
+	return (server, client)
+
+class FakeFramer:
+	def __init__(self):
+		self.sent = []
+
+	def send(self, packet):
+		self.sent.append(packet)
+
+class FakeRequestHandler:
+	"""
+	A client connection whose send queue is full.
+	"""
+	def __init__(self, overflowPolicy):
+		self.queue = Nodes.SendQueue(1, overflowPolicy)
+		self.queue.put('x')
+		self.framer = FakeFramer()
+		self.stopEvent = threading.Event()
+
+	def trace(self, txt):
+		pass
+
+	def stop(self):
+		self.stopEvent.set()
+
+	send_packet = Nodes.TcpPacketizerServerThread.TcpPacketizerRequestHandler.send_packet.im_func
+
+def test_full_send_queue():
+	"""
+	Only notifications are discarded when a client send queue is full:
+	responses are always sent.
+	"""
+	for policy in [ Nodes.SendQueue.DROP, Nodes.SendQueue.DISCONNECT ]:
+		handler = FakeRequestHandler(policy)
+		handler.send_packet('response')
+		assert(handler.framer.sent == [ 'response' ])
+		assert(not handler.stopEvent.isSet())
+		handler.send_packet('notification', True)
+		assert(handler.framer.sent == [ 'response' ])
+		assert(handler.queue.dropped == 1)
+		assert(handler.stopEvent.isSet() == (policy == Nodes.SendQueue.DISCONNECT))
+
+	# Only the notifications are sent as discardable by the nodes
+	(server, client) = startNodes(42603)
+	messages = []
+	sendMessage = server._connector.sendMessage
+	def recordMessage(channel, message, discardable = False):
+		messages.append((message.isNotification(), discardable))
+		sendMessage(channel, message, discardable)
+	server._connector.sendMessage = recordMessage
+	channel = server._connector.server.clients.keys()[0]
+	server.sendNotification(channel, Messages.Notification("EVENT", "system:test", "XC", "1.0"))
+	assert(client.executeRequest(None, Messages.Request("TEST", "x:y", "XC", "1.0"), responseTimeout = 5.0) is not None)
+	assert(messages == [ (True, True), (False, False) ])
+	client.stop()
+	server.stop()
+	client.finalize()
+	server.finalize()
+	print "full send queue: OK"
+
+def test_stop():
+	"""
+	Synchronous requests are released when the node stops,
+	and do not wait when it is not started.
+	"""
+	(server, client) = startNodes(42601)
+	responses = []
+	requester = threading.Thread(target = lambda: responses.append(client.executeRequest(None, Messages.Request("IGNORE", "x:y", "XC", "1.0"), responseTimeout = 60.0)))
+	requester.start()
+	time.sleep(0.5)
+	start = time.time()
+	client.stop()
+	requester.join()
+	assert(responses == [ None ])
+	assert(time.time() - start < 5.0)
+	start = time.time()
+	assert(client.executeRequest(None, Messages.Request("TEST", "x:y", "XC", "1.0"), responseTimeout = 60.0) is None)
+	assert(time.time() - start < 1.0)
+	client.finalize()
+	server.stop()
+	server.finalize()
+	print "synchronous requests on stop: OK"
+
+def test_synchronous_requests():
+	"""
+	Mean latency and CPU time of loopback round-trips.
+	"""
+	(server, client) = startNodes(42602)
+	count = 3000
+	for requesterCount in [ 1, 10, 100 ]:
+		latencies = []
+		def requester():
+			for i in range(count / requesterCount):
+				start = time.time()
+				assert(client.executeRequest(None, Messages.Request("TEST", "x:y", "XC", "1.0")) is not None)
+				latencies.append(time.time() - start)
+		threads = [ threading.Thread(target = requester) for i in range(requesterCount) ]
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		usage2 = resource.getrusage(resource.RUSAGE_SELF)
+		cpu = (usage2.ru_utime - usage.ru_utime) + (usage2.ru_stime - usage.ru_stime)
+		print "%d requesters: mean latency %.2f ms, CPU %.2f ms/request" % (requesterCount, sum(latencies) / len(latencies) * 1000, cpu / len(latencies) * 1000)
+	client.stop()
+	client.finalize()
+	server.stop()
+	server.finalize()
+
+def test():
+	for bufferClass in [ Nodes.ReceiveBuffer, Nodes.StringReceiveBuffer ]:
+		test_small_messages(bufferClass)
+		test_large_message(bufferClass)
+	test_full_send_queue()
+	test_stop()
+	test_synchronous_requests()
+
+if __name__ == '__main__':
+	test()
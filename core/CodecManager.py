@@ -21,6 +21,8 @@
 #
 ##
 
+import threading
+
 
 ##
 # Codec-related exceptions
@@ -49,6 +51,11 @@ class Codec:
 	"""
 	Codec base class for all codec plugins.
 	Subclass it to create your own codec.
+	
+	A codec instance is reused for several encode()/decode() calls
+	(from the same thread) with the same properties: do not keep per-call
+	states in the instance. It may, however, cache what it computed
+	from its properties.
 	"""
 
 	# These constant are used for incremental decoding only.
@@ -154,6 +161,22 @@ class Codec:
 			return (self.DECODING_ERROR, 0, None, None)
 		# We assume that the whole data was consumed.
 		return (self.DECODING_OK, len(data), message, summary)
+
+	def createDecodingSession(self):
+		"""
+		Creates a decoding session, to decode a stream fed by the caller
+		as it receives it (see DecodingSession).
+		
+		Stateful incremental decoders may reimplement this one to return
+		their own DecodingSession subclass, keeping their parse state across
+		the fed data.
+		By default, the session accumulates the fed data and calls the
+		stateless incrementalDecode() on the whole buffer each time.
+
+		@rtype: DecodingSession
+		@returns: a new decoding session bound to this codec instance
+		"""
+		return DecodingSession(self)
 		
 
 	# To reimplement in your own codecs
@@ -221,6 +244,9 @@ class IncrementalCodec(Codec):
 	
 	However, this is a stateless codec. It does not have to "wait for more data",
 	as the next attempt will provide the same data plus additional one.
+	Codecs that need to avoid analyzing the same data again on each attempt
+	(large messages received in many segments) may also provide a stateful
+	DecodingSession (see Codec.createDecodingSession()).
 	
 	Notice that incremental encoding is useless for Testerman, the user always
 	provides a full payload to encode.
@@ -296,6 +322,123 @@ class IncrementalCodec(Codec):
 		else:
 			return (None, None)
 
+class DecodingSession:
+	"""
+	A decoding session, created by Codec.createDecodingSession(),
+	that decodes a stream incrementally: the caller feeds the raw data
+	as it receives it (feed()), then gets the decoded messages (decode())
+	until the session needs more data.
+	
+	Use one session per stream (a TCP connection, for instance), as the
+	session keeps the data that were not consumed yet.
+	
+	This base class implements the stateless fallback: the fed data are
+	accumulated, and the codec's incrementalDecode() is called on the whole
+	buffer each time.
+	Stateful codecs subclass it to keep their parse state across the calls
+	and only analyze the new data, by reimplementing
+	feed(), decodeNext(), hasData() and reset().
+	"""
+
+	# Same constants as in Codec
+	DECODING_ERROR = Codec.DECODING_ERROR
+	DECODING_NEED_MORE_DATA = Codec.DECODING_NEED_MORE_DATA
+	DECODING_OK = Codec.DECODING_OK
+
+	def __init__(self, codec):
+		self._codec = codec
+		self._buffer = ''
+	
+	def getCodec(self):
+		return self._codec
+	
+	# Convenience functions for decodeNext() implementations
+	def decodingError(self):
+		return (self.DECODING_ERROR, '', None, None)
+	
+	def needMoreData(self):
+		return (self.DECODING_NEED_MORE_DATA, '', None, None)
+	
+	def decoded(self, decodedMessage, summary, payload):
+		return (self.DECODING_OK, payload, decodedMessage, summary)
+
+	def decode(self, complete):
+		"""
+		Tries to decode the next message from the data fed so far.
+		Call it again after a successful decoding, until it returns
+		NEED_MORE_DATA, as the fed data may contain several messages.
+		
+		In case of a decoding error (or an exception raised by the codec),
+		the data buffered by the session are dropped.
+
+		@type  complete: bool
+		@param complete: set to True when no more data will be fed (end of stream).
+		In this case, if the codec still needs more data, this is reported as
+		a decoding error.
+		
+		@rtype: tuple (int, string, obj, string)
+		@returns: tuple (status, payload, message, summary) where:
+		  status is DECODING_ERROR, DECODING_NEED_MORE_DATA or DECODING_OK,
+		  payload is the raw data consumed to decode the message (DECODING_OK only),
+		  message and summary are the decoded message and its summary (DECODING_OK only).
+		"""
+		try:
+			ret = self.decodeNext(complete)
+		except Exception:
+			self.reset()
+			raise
+		if ret[0] == self.DECODING_NEED_MORE_DATA and complete and self.hasData():
+			ret = self.decodingError()
+		if ret[0] == self.DECODING_ERROR:
+			self.reset()
+		return ret
+
+	# Functions to reimplement in stateful sessions
+	def feed(self, data):
+		"""
+		Feeds the session with new raw data received from the stream.
+		Does not decode anything.
+
+		@type  data: string (as a buffer)
+		@param data: the newly received data
+		"""
+		self._buffer += data
+
+	def hasData(self):
+		"""
+		@rtype: bool
+		@returns: True if some fed data have not been consumed yet.
+		"""
+		return self._buffer != ''
+
+	def reset(self):
+		"""
+		Drops the fed data that were not consumed yet, and the current parse state.
+		"""
+		self._buffer = ''
+
+	def decodeNext(self, complete):
+		"""
+		Tries to decode the next message, as described in decode(),
+		without having to care about the completion or error handling.
+		
+		You may raise exceptions in case of decoding errors.
+		"""
+		buf = self._buffer
+		if not buf:
+			return self.needMoreData()
+		(status, consumedSize, decodedMessage, summary) = self._codec.incrementalDecode(buf, complete)
+		if status == self.DECODING_NEED_MORE_DATA:
+			return self.needMoreData()
+		elif status == self.DECODING_OK:
+			if consumedSize == 0:
+				consumedSize = len(buf)
+			self._buffer = buf[consumedSize:]
+			return self.decoded(decodedMessage, summary, buf[:consumedSize])
+		else:
+			return self.decodingError()
+
+
 ##
 # Internal class - do not use
 ##
@@ -309,6 +452,10 @@ class CodecManager(object):
 		#: dict[codec/aliasname] = (codec class, params)
 		self._codecs = {}
 		self._logCallback = None
+		#: Configured codec instances, per thread (see _getCodecInstance()).
+		#: Dropped when a codec or an alias is (re)defined.
+		self._local = threading.local()
+		self._generation = 0
 	
 	def log(self, txt):
 		if self._logCallback:
@@ -320,6 +467,7 @@ class CodecManager(object):
 	def registerCodecClass(self, name, class_):
 		if not self._codecs.has_key(name):
 			self._codecs[name] = (class_, {})
+			self._generation += 1
 			self.log("Codec class %s registered as codec %s" % (class_.__name__, name))
 	
 	def alias(self, name, codec, **kwargs):
@@ -338,49 +486,72 @@ class CodecManager(object):
 		for n, p in kwargs.items():
 			mergedProperties[n] = p
 		self._codecs[name] = (codecClass, mergedProperties)
+		self._generation += 1
 
-	def _getCodecInstance(self, name):
+	def _createCodecInstance(self, name, properties):
 		"""
-		Creates and returns configured codec instance.
+		Creates and returns a configured codec instance,
+		with overriding properties, or None if the codec is not registered.
 		"""
 		if not self._codecs.has_key(name):
 			return None
+		codecClass, codecProperties = self._codecs[name]
+		c = codecClass()
+		for n, p in codecProperties.items():
+			c._setProperty(n, p)
+		for n, p in properties.items():
+			c._setProperty(n, p)
+		return c
+
+	def _getCodecInstance(self, name, properties = {}):
+		"""
+		Returns a configured codec instance, with overriding properties,
+		or None if the codec is not registered.
+		
+		Instances are reused for the calls from the same thread with the same
+		codec name and overriding properties, so that concurrent PTCs or probes
+		never share a codec instance.
+		They are dropped when a codec or alias is (re)defined.
+		"""
+		local = self._local
+		if getattr(local, 'generation', None) != self._generation:
+			local.instances = {}
+			local.generation = self._generation
+		if properties:
+			key = (name, tuple(sorted(properties.items())))
 		else:
-			codecClass, properties = self._codecs[name]
-			c = codecClass()
-			for n, p in properties.items():
-				c._setProperty(n, p)
-			return c
+			key = name
+		try:
+			return local.instances[key]
+		except KeyError:
+			pass
+		except TypeError:
+			# Unhashable property values: not cached
+			return self._createCodecInstance(name, properties)
+		c = self._createCodecInstance(name, properties)
+		if c:
+			local.instances[key] = c
+		return c
 	
 	def encode(self, name, template, **properties):
-		# NB: we instantiate a codec each type to be thread safe and parallel.
-		# This is not optimized, we may use a TLS one day.
-		codec = self._getCodecInstance(name)
+		codec = self._getCodecInstance(name, properties)
 		if codec:
-			for k, v in properties.items():
-				codec._setProperty(k, v)
 			return codec.encode(template)
 		else:
 			# Unable to find the codec
 			raise CodecNotFoundException("Codec '%s' not found" % name)
 
 	def decode(self, name, data,  **properties):
-		# NB: we instantiate a codec each type to be thread safe and parallel
-		codec = self._getCodecInstance(name)
+		codec = self._getCodecInstance(name, properties)
 		if codec:
-			for k, v in properties.items():
-				codec._setProperty(k, v)
 			return codec.decode(data)
 		else:
 			# Unable to find the codec
 			raise CodecNotFoundException("Codec '%s' not found" % name)
 
 	def incrementalDecode(self, name, data, complete, **properties):
-		# NB: we instantiate a codec each type to be thread safe and parallel
-		codec = self._getCodecInstance(name)
+		codec = self._getCodecInstance(name, properties)
 		if codec:
-			for k, v in properties.items():
-				codec._setProperty(k, v)
 			(ret, a, b, c) = codec.incrementalDecode(data, complete)
 			# If the codec expects more data and we can't provide mode: decoding error
 			if ret == codec.DECODING_NEED_MORE_DATA and complete:
@@ -390,6 +561,15 @@ class CodecManager(object):
 			# Unable to find the codec
 			raise CodecNotFoundException("Codec '%s' not found" % name)
 
+	def createDecodingSession(self, name, **properties):
+		# The session keeps its own codec instance, as it may be fed from any thread
+		codec = self._createCodecInstance(name, properties)
+		if codec:
+			return codec.createDecodingSession()
+		else:
+			# Unable to find the codec
+			raise CodecNotFoundException("Codec '%s' not found" % name)
+
 
 TheInstance = None
 
@@ -452,3 +632,21 @@ def incrementalDecode(name, data, complete, **properties):
 	"""
 	return instance().incrementalDecode(name, data, complete, **properties)
 
+def createDecodingSession(name, **properties):
+	"""
+	Creates a decoding session for a stream, to feed with the data
+	as they are received.
+	The session uses the stateful implementation of the codec, if any,
+	or falls back to its stateless incremental decoding.
+
+	@type  name: string
+	@param name: the codec name
+	@type  properties: keyword args of objects
+	@param properties: overriding properties for this session
+
+	@throws CodecNotFoundException if the codec was not found
+	
+	@rtype: DecodingSession
+	@returns: a new decoding session
+	"""
+	return instance().createDecodingSession(name, **properties)
@@ -18,19 +18,32 @@
 # dependency resolver.
 #
 # Provides several functions to identify dependencies
-# and resolve them to actual file names.
+# and resolve them to actual file names,
+# and a repository-wide import graph.
 #
 ##
 
 import ConfigManager
 import FileSystemManager
 
+import cPickle as pickle
 import imp
 import logging
 import modulefinder
+import os
 import os.path
 import re
 import StringIO
+import sys
+import threading
+import time
+
+try:
+	import hashlib
+	shaclass = hashlib.sha1
+except:
+	import sha
+	shaclass = sha.sha
 
 
 cm = ConfigManager.instance()
@@ -155,11 +168,19 @@ def python_getDependencyFilenames(source, sourceFilename, recursive = True, modu
 
 	return ret	
 
+# Imported userland modules (list of names), indexed by the SHA-1 of the source,
+# so that a shared module is parsed once whatever the number of its importers.
+IMPORTED_MODULES_CACHE_MAX_SIZE = 20000
+_importedModulesCache = {}
+_importedModulesCacheMutex = threading.RLock()
+
 def python_getImportedUserlandModules(source, sourceFilename):
 	"""
 	Returns a list of direct (userland) dependencies (source is an ATS/Module source code),
 	as a list of module names (not filenames !)
 	
+	The result is cached by content.
+	
 	@type  source: utf-8 string
 	@param source: Python source code
 	@type  sourceFilename: utf-8 string
@@ -168,6 +189,30 @@ def python_getImportedUserlandModules(source, sourceFilename):
 	@rtype: list of strings
 	@returns: a list of module names ('mylibs.mymodule', 'amodule', etc) 
 	"""
+	if isinstance(source, unicode):
+		source = source.encode('utf-8')
+	key = shaclass(source).hexdigest()
+	_importedModulesCacheMutex.acquire()
+	try:
+		directdeps = _importedModulesCache.get(key)
+	finally:
+		_importedModulesCacheMutex.release()
+	if directdeps is not None:
+		getLogger().debug('Userland modules imported by file %s: cached' % sourceFilename)
+		return directdeps[:]
+
+	directdeps = _findImportedUserlandModules(source, sourceFilename)
+
+	_importedModulesCacheMutex.acquire()
+	try:
+		if len(_importedModulesCache) >= IMPORTED_MODULES_CACHE_MAX_SIZE:
+			_importedModulesCache.clear()
+		_importedModulesCache[key] = directdeps[:]
+	finally:
+		_importedModulesCacheMutex.release()
+	return directdeps
+
+def _findImportedUserlandModules(source, sourceFilename):
 	mf = modulefinder.ModuleFinder()
 	fp = StringIO.StringIO(source)
 	mf.load_module('__main__', fp, '<string>', ("", "r", imp.PY_SOURCE))
@@ -185,6 +230,41 @@ def python_getImportedUserlandModules(source, sourceFilename):
 	
 	return directdeps
 
+def _loadImportedModulesCache(filename):
+	"""
+	Loads the imported modules cache saved by a previous run.
+	
+	The cache is discarded if the Python module search path changed,
+	since it determines which imports are userland ones.
+	"""
+	f = open(filename, 'rb')
+	try:
+		(path, cache) = pickle.load(f)
+	finally:
+		f.close()
+	if path != sys.path:
+		getLogger().info('Python path changed, discarding the imported modules cache')
+		return
+	_importedModulesCacheMutex.acquire()
+	try:
+		_importedModulesCache.update(cache)
+	finally:
+		_importedModulesCacheMutex.release()
+
+def _saveImportedModulesCache(filename):
+	_importedModulesCacheMutex.acquire()
+	try:
+		cache = _importedModulesCache.copy()
+	finally:
+		_importedModulesCacheMutex.release()
+	tmpFilename = filename + '.tmp'
+	f = open(tmpFilename, 'wb')
+	try:
+		pickle.dump((sys.path, cache), f, 2)
+	finally:
+		f.close()
+	os.rename(tmpFilename, filename)
+
 
 ################################################################################
 # Campaign source management
@@ -303,3 +383,380 @@ def campaign_getDependencyFilenames(source, sourcePath = None, recursive = False
 	return currentDependencies
 		
 
+
+################################################################################
+# Repository-wide import graph
+################################################################################
+
+class ImportGraph:
+	"""
+	An index of the userland modules imported by each ATS and module of the
+	repository, resolved to filenames, with the reverse edges
+	(the files importing a given module).
+
+	The graph is built on first use (or on startup, see initialize()) by
+	scanning the repository, without holding the lock the FileSystemManager
+	change listener waits for; it is then maintained from these notifications:
+	a written or deleted file is reparsed and, if it is a module,
+	the imports of its name are resolved again.
+	Directory and package changes trigger a full rebuild on next use.
+	The parsing results are cached by content (see python_getImportedUserlandModules()),
+	so that a rebuild only reads the files.
+
+	Files changed without going through the FileSystemManager
+	are taken into account on the next rebuild only.
+	"""
+	def __init__(self, rootDir = '/repository', watchChanges = True):
+		self._mutex = threading.RLock()
+		# Only one build at a time
+		self._buildMutex = threading.Lock()
+		self._rootDir = rootDir
+		self._built = False
+		# Paths changed during a build, or None if not building
+		self._pendingChanges = None
+		self._reset()
+		if watchChanges:
+			FileSystemManager.instance().addChangeListener(self._onChange)
+
+	def _lock(self):
+		self._mutex.acquire()
+
+	def _unlock(self):
+		self._mutex.release()
+
+	def _reset(self):
+		# Imported module names, indexed by filename
+		self._imports = {}
+		# Resolved direct dependencies (list of filenames), indexed by filename
+		self._dependencies = {}
+		# Unresolved imported module names, indexed by filename
+		self._missing = {}
+		# Importing filenames (dict), indexed by imported filename
+		self._reverseDependencies = {}
+		# Importing filenames (dict), indexed by imported module name
+		self._importers = {}
+		# Package directories
+		self._packages = {}
+		# Scanned directories
+		self._directories = {}
+
+	##
+	# Graph building
+	##
+	def _lockBuilt(self):
+		"""
+		Builds the graph if needed, then acquires the lock.
+		"""
+		self._lock()
+		while not self._built:
+			self._unlock()
+			self.build()
+			self._lock()
+
+	def build(self):
+		"""
+		Builds the graph, if not built yet.
+		
+		The indexes are built on a separate graph, without holding the lock,
+		then swapped in. The changes notified meanwhile are applied then.
+		"""
+		self._buildMutex.acquire()
+		try:
+			if self._built:
+				return
+			start = time.time()
+			self._lock()
+			self._pendingChanges = []
+			self._unlock()
+			try:
+				graph = ImportGraph(self._rootDir, watchChanges = False)
+				filenames = []
+				graph._scan(self._rootDir, filenames)
+				for filename in filenames:
+					graph._indexFile(filename, FileSystemManager.instance().read(filename))
+				for filename in filenames:
+					graph._resolveFile(filename)
+			except:
+				self._lock()
+				self._pendingChanges = None
+				self._unlock()
+				raise
+			self._lock()
+			try:
+				for name in [ '_imports', '_dependencies', '_missing', '_reverseDependencies', '_importers', '_packages', '_directories' ]:
+					setattr(self, name, getattr(graph, name))
+				self._built = True
+				pendingChanges = self._pendingChanges
+				self._pendingChanges = None
+				for path in pendingChanges:
+					self._applyChange(path)
+			finally:
+				self._unlock()
+			getLogger().info("Import graph built: %d files indexed in %.2fs" % (len(filenames), time.time() - start))
+		finally:
+			self._buildMutex.release()
+
+	def _scan(self, path, filenames):
+		self._directories[path] = None
+		entries = FileSystemManager.instance().getdir(path)
+		if not entries:
+			return
+		for entry in entries:
+			name = '%s/%s' % (path, entry['name'])
+			if entry['type'] == FileSystemManager.APPTYPE_PACKAGE:
+				self._packages[name] = None
+				self._scan(name, filenames)
+			elif entry['type'] == FileSystemManager.APPTYPE_DIR:
+				self._scan(name, filenames)
+			elif entry['type'] in [ FileSystemManager.APPTYPE_ATS, FileSystemManager.APPTYPE_MODULE ]:
+				filenames.append(name)
+
+	def _indexFile(self, filename, source):
+		"""
+		Updates the imported module names of a file.
+		Does not resolve them.
+		"""
+		for name in self._imports.get(filename, []):
+			self._removeImporter(name, filename)
+		if source is None:
+			if self._imports.has_key(filename):
+				del self._imports[filename]
+			return
+		try:
+			imports = python_getImportedUserlandModules(source, filename)
+		except Exception, e:
+			getLogger().warning("Unable to parse %s, considered as importing nothing: %s" % (filename, str(e)))
+			imports = []
+		self._imports[filename] = imports
+		self._directories[os.path.split(filename)[0]] = None
+		for name in imports:
+			self._importers.setdefault(name, {})[filename] = None
+
+	def _removeImporter(self, name, filename):
+		importers = self._importers.get(name)
+		if importers and importers.has_key(filename):
+			del importers[filename]
+			if not importers:
+				del self._importers[name]
+
+	def _getModuleRootDir(self, filename):
+		"""
+		Same convention as AtsJob.prepare(): the package src dir
+		for a file contained in a package, the repository root otherwise.
+		"""
+		currentdir = ''
+		for dirname in os.path.split(filename)[0].split('/')[1:]:
+			currentdir = '%s/%s' % (currentdir, dirname)
+			if self._packages.has_key(currentdir):
+				return currentdir + '/src'
+		return self._rootDir
+
+	def _resolve(self, name, fromFilename):
+		"""
+		Same search path as python_getDependencyFilenames(),
+		looked up in the index.
+		"""
+		for path in [ os.path.split(fromFilename)[0], self._getModuleRootDir(fromFilename) ]:
+			filename = '%s/%s.py' % (path, name.replace('.', '/'))
+			if self._imports.has_key(filename):
+				return filename
+		return None
+
+	def _resolveFile(self, filename):
+		"""
+		(Re)resolves the imports of an indexed file,
+		and updates the reverse edges accordingly.
+		"""
+		for dependency in self._dependencies.get(filename, []):
+			reverseDependencies = self._reverseDependencies[dependency]
+			del reverseDependencies[filename]
+			if not reverseDependencies:
+				del self._reverseDependencies[dependency]
+		if not self._imports.has_key(filename):
+			for d in [ self._dependencies, self._missing ]:
+				if d.has_key(filename):
+					del d[filename]
+			return
+
+		dependencies = []
+		missing = []
+		for name in self._imports[filename]:
+			dependency = self._resolve(name, filename)
+			if dependency is None:
+				missing.append(name)
+			elif not dependency in dependencies:
+				dependencies.append(dependency)
+		self._dependencies[filename] = dependencies
+		self._missing[filename] = missing
+		for dependency in dependencies:
+			self._reverseDependencies.setdefault(dependency, {})[filename] = None
+
+	##
+	# Maintenance
+	##
+	def _onChange(self, path):
+		"""
+		FileSystemManager change listener.
+		"""
+		if not path.startswith(self._rootDir + '/'):
+			return
+		self._lock()
+		try:
+			if self._pendingChanges is not None:
+				# Applied once the graph being built is swapped in
+				self._pendingChanges.append(path)
+			elif self._built:
+				self._applyChange(path)
+		finally:
+			self._unlock()
+
+	def _applyChange(self, path):
+		if path == self._rootDir or os.path.split(path)[1] == 'package.xml' or self._directories.has_key(path) or FileSystemManager.instance().isdir(path):
+			# Packages or directories changed: rebuild on next use
+			self._built = False
+			self._reset()
+		elif path.endswith('.py') or path.endswith('.ats'):
+			self._updateFile(path)
+
+	def _updateFile(self, filename):
+		wasIndexed = self._imports.has_key(filename)
+		try:
+			source = FileSystemManager.instance().read(filename)
+		except Exception:
+			source = None
+		self._indexFile(filename, source)
+		self._resolveFile(filename)
+		if filename.endswith('.py') and wasIndexed != (source is not None):
+			# A module was created or deleted: resolve the imports
+			# that could reference it again
+			importers = {}
+			components = filename[:-3].split('/')
+			for i in range(len(components)):
+				importers.update(self._importers.get('.'.join(components[i:]), {}))
+			for importer in importers.keys():
+				self._resolveFile(importer)
+
+	def invalidate(self):
+		"""
+		Forces a full rebuild on next use, for instance after
+		files were changed outside of the FileSystemManager.
+		"""
+		self._lock()
+		if self._pendingChanges is not None:
+			# Invalidates the graph being built, once swapped in
+			self._pendingChanges.append(self._rootDir)
+		self._built = False
+		self._reset()
+		self._unlock()
+
+	##
+	# Queries
+	##
+	def getDependencies(self, filename, recursive = False):
+		"""
+		Returns the userland modules an indexed ATS or module depends on,
+		as python_getDependencyFilenames() for a file in the repository.
+
+		@type  filename: string
+		@param filename: the docroot path to an ATS or a module
+		@type  recursive: bool
+		@param recursive: if True, also returns the dependencies of the dependencies
+
+		@rtype: list of strings, or None
+		@returns: the docroot paths to the dependencies (no duplicate),
+		or None if the file is not indexed.
+		"""
+		self._lockBuilt()
+		try:
+			if not self._imports.has_key(filename):
+				return None
+			ret = []
+			toVisit = [ filename ]
+			visited = { filename: None }
+			while toVisit:
+				current = toVisit.pop()
+				missing = self._missing[current]
+				if missing:
+					raise Exception('Missing module: %s (imported from %s) is not available in the repository' % (missing[0], current))
+				for dependency in self._dependencies[current]:
+					if not dependency in ret:
+						ret.append(dependency)
+					if recursive and not visited.has_key(dependency):
+						visited[dependency] = None
+						toVisit.append(dependency)
+			return ret
+		finally:
+			self._unlock()
+
+	def getReverseDependencies(self, filename):
+		"""
+		Returns the ATSes and modules that directly import a module.
+
+		@type  filename: string
+		@param filename: the docroot path to a module
+
+		@rtype: list of strings
+		@returns: the sorted docroot paths to the importing files
+		"""
+		self._lockBuilt()
+		try:
+			ret = self._reverseDependencies.get(filename, {}).keys()
+			ret.sort()
+			return ret
+		finally:
+			self._unlock()
+
+	def getStatistics(self):
+		"""
+		@rtype: dict
+		@returns: the number of indexed files and of resolved imports
+		"""
+		self._lock()
+		try:
+			return { 'built': self._built, 'files': len(self._imports),
+				'edges': sum([ len(x) for x in self._dependencies.values() ]) }
+		finally:
+			self._unlock()
+
+
+################################################################################
+# Main
+################################################################################
+
+TheImportGraph = None
+
+def instance():
+	return TheImportGraph
+
+def initialize():
+	"""
+	Loads the imported modules cache saved on finalize(),
+	then creates the import graph, built in background.
+	
+	Must be called once the FileSystemManager is initialized.
+	"""
+	global TheImportGraph
+	if cm.get('testerman.var_root'):
+		filename = cm.get('testerman.var_root') + '/import_cache.dump'
+		if os.path.isfile(filename):
+			try:
+				_loadImportedModulesCache(filename)
+			except Exception, e:
+				getLogger().warning("Unable to load the imported modules cache: %s" % str(e))
+	TheImportGraph = ImportGraph()
+	t = threading.Thread(target = _buildImportGraph, args = (TheImportGraph, ))
+	t.setDaemon(True)
+	t.start()
+
+def _buildImportGraph(graph):
+	try:
+		graph.build()
+	except Exception, e:
+		getLogger().warning("Unable to build the import graph (built on first use instead): %s" % str(e))
+
+def finalize():
+	if cm.get('testerman.var_root'):
+		try:
+			_saveImportedModulesCache(cm.get('testerman.var_root') + '/import_cache.dump')
+		except Exception, e:
+			getLogger().warning("Unable to save the imported modules cache: %s" % str(e))
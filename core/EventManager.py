@@ -24,6 +24,7 @@
 
 import ConfigManager
 import CounterManager
+import LogSink
 import TestermanMessages as Messages
 import TestermanNodes as Nodes
 import Versions
@@ -43,10 +44,10 @@ class XcException(Exception):
 		self.reason = reason
 
 class XcServer(Nodes.ListeningNode):
-	def __init__(self, manager, xcAddress):
+	def __init__(self, manager, xcAddress, maxSendQueueSize = 0, sendQueueOverflowPolicy = Nodes.SendQueue.BLOCK):
 		Nodes.ListeningNode.__init__(self, "TS/Xc", "XcServer/%s" % Versions.getServerVersion())
 		self._manager = manager
-		self.initialize(xcAddress)
+		self.initialize(xcAddress, maxSendQueueSize = maxSendQueueSize, sendQueueOverflowPolicy = sendQueueOverflowPolicy)
 
 	def getLogger(self):
 		return logging.getLogger('TS.XcServer')
@@ -114,16 +115,22 @@ class Manager:
 	"""
 	The Manager manages the subscriptions.
 	It is interfaces through the WebServices.
+	
+	Each Xc client has its own bounded send queue, so that a slow client
+	does not delay the others (see Nodes.SendQueue).
 	"""
-	def __init__(self, xcAddress, ilAddress):
+	def __init__(self, xcAddress, ilAddress, maxSendQueueSize = 0, sendQueueOverflowPolicy = Nodes.SendQueue.BLOCK):
 		self._mutex = threading.RLock()
-		self._xcServer = XcServer(self, xcAddress)
+		self._xcServer = XcServer(self, xcAddress, maxSendQueueSize, sendQueueOverflowPolicy)
 		self._ilServer = IlServer(self, ilAddress)
 	
 		# The subscription mapping is a list of Xc channels objects per uri (jobid:<id>, system:jobs, ...).
 		self._subscriptions = {}
 		self._xcClients = []
 		
+		# Execution log files, kept open and written by batches
+		self._logSink = LogSink.LogSink()
+		
 	def _lock(self):
 		self._mutex.acquire()
 	
@@ -138,6 +145,7 @@ class Manager:
 
 	def start(self):
 		self.getLogger().info("Starting...")
+		self._logSink.start()
 		self._xcServer.start()
 		self._ilServer.start()
 		self.getLogger().info("Started")
@@ -148,6 +156,7 @@ class Manager:
 		self._xcServer.finalize()
 		self._ilServer.stop()
 		self._ilServer.finalize()
+		self._logSink.stop()
 		self.getLogger().info("Stopped")
 	
 	def subscribe(self, channel, uri):
@@ -214,18 +223,28 @@ class Manager:
 		uri = str(notification.getUri()) # make sure we deal with URI strings, not URI objects
 		self.getLogger().debug("Dispatching notification on Xc for %s..." % uri)
 		nbClients = 0
+		# Sending is done out of the lock, on a snapshot of the subscribers
 		self._lock()
-		if not self._subscriptions.has_key(uri):
-			self._unlock()
+		channels = self._subscriptions.get(uri)
+		if channels:
+			channels = channels[:]
+		self._unlock()
+		if not channels:
 			return
-		for channel in self._subscriptions[uri]:
+		for channel in channels:
 			try:
 				self._xcServer.sendNotification(channel, notification)
 				nbClients += 1
 			except:
 				self.getLogger().warning("Unable to send event to a client")
-		self._unlock()
 		self.getLogger().debug("Notification dispatched to %d Xc clients" % nbClients)
+
+	def getDroppedEventCount(self, channel):
+		"""
+		Returns the number of events discarded for a Xc client
+		because its send queue was full.
+		"""
+		return self._xcServer.getDroppedCount(channel)
 	
 	def getLogger(self):
 		return logging.getLogger('TS.TL')
@@ -237,9 +256,7 @@ class Manager:
 			filename = notification.getHeader('Log-Filename')
 			if filename:
 				try:
-					f = open(filename, 'a')
-					f.write('%s\n' % notification.getBody())
-					f.close()
+					self._logSink.write(filename, '%s\n' % notification.getBody())
 				except Exception, e:
 					self.getLogger().error("Unable to write log for %s: %s" % (notification.getUri(), str(e)))		
 		else:
@@ -248,6 +265,32 @@ class Manager:
 		# Dispath
 		self.dispatchNotification(notification)
 
+	def flushLog(self, filename):
+		"""
+		Writes the buffered log events for a log file, if any,
+		so that the file can be read.
+		
+		@type  filename: string
+		@param filename: the absolute path of the log file
+		"""
+		try:
+			self._logSink.flush(filename)
+		except Exception, e:
+			self.getLogger().error("Unable to flush log %s: %s" % (filename, str(e)))
+
+	def closeLog(self, filename):
+		"""
+		Writes the buffered log events for a log file, syncs and closes it.
+		To call once the execution that generated this log is over.
+		
+		@type  filename: string
+		@param filename: the absolute path of the log file
+		"""
+		try:
+			self._logSink.close(filename)
+		except Exception, e:
+			self.getLogger().error("Unable to close log %s: %s" % (filename, str(e)))
+
 
 ################################################################################
 # Main module functions
@@ -264,7 +307,7 @@ def initialize():
 	global TheManager
 	xcAddress = (cm.get("interface.xc.ip"), cm.get("interface.xc.port"))
 	ilAddress = (cm.get("interface.il.ip"), cm.get("interface.il.port"))
-	TheManager = Manager(xcAddress, ilAddress)
+	TheManager = Manager(xcAddress, ilAddress, cm.get("interface.xc.send_queue_size"), cm.get("interface.xc.send_queue_overflow_policy"))
 	TheManager.initialize()
 	TheManager.start()
 
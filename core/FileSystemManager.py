@@ -125,6 +125,9 @@ class FileSystemManager:
 	- unlink
 	"""
 
+	def __init__(self):
+		self._changeListeners = []
+
 	def logged(fn, *args, **kw):
 		"""
 		Decorator function to log function calls easily.
@@ -181,6 +184,23 @@ class FileSystemManager:
 	def _notifyFileChanged(self, filename):
 		pass
 
+	def addChangeListener(self, callback):
+		"""
+		Registers a callback called with the docroot path of each file
+		written or deleted, and of each directory deleted, once done,
+		and with the source and destination paths of each renamed object,
+		whatever the notify flag of the operation.
+		Profiles are not reported.
+		"""
+		self._changeListeners.append(callback)
+
+	def _notifyChange(self, path):
+		for callback in self._changeListeners:
+			try:
+				callback(path)
+			except Exception, e:
+				getLogger().warning("Change listener failed for %s: %s" % (path, str(e)))
+
 	def _notifyFileRenamed(self, filename, newName):
 		"""
 		Filename is the path+name to the previous name, before renaming.
@@ -309,6 +329,7 @@ class FileSystemManager:
 			getLogger().error("Unable to write %s: %s" % (filename, str(e)))
 			return False
 
+		self._notifyChange(filename)
 		if notify:
 			if newfile:
 				self._notifyFileCreated(filename)
@@ -358,6 +379,8 @@ class FileSystemManager:
 			ret = backend.unlinkprofile(adjusted, vpath.getVirtualValue(), username = username)
 		else:
 			ret = backend.unlink(adjusted, reason, username = username)
+			if ret:
+				self._notifyChange(filename)
 
 		if ret and notify:
 			self._notifyFileDeleted(filename)
@@ -478,6 +501,8 @@ class FileSystemManager:
 		else:
 			getLogger().info("Deleting directory '%s' recursively, adjusted to '%s' for backend '%s'" % (path, adjusted, backend))
 			ret = self._rmdir(adjusted, backend, notify = True)
+		if ret:
+			self._notifyChange(path)
 		if ret and notify:
 			self._notifyDirDeleted(path)
 		return ret
@@ -733,6 +758,8 @@ class FileSystemManager:
 			else:
 				ret = backend.rename(adjusted, newName)
 			if ret:
+				self._notifyChange(source)
+				self._notifyChange(destination)
 				self._notifyFileRenamed(source, newName)
 			return ret
 
@@ -37,8 +37,10 @@ import Versions
 import base64
 import compiler
 import cPickle as pickle
+import cStringIO
 import copy_reg
 import fcntl
+import heapq
 import logging
 import os
 import os.path
@@ -46,11 +48,19 @@ import parser
 import re
 import shutil
 import signal
+import struct
 import sys
 import tempfile
 import threading
 import time
 import zipfile
+import zlib
+try:
+	import hashlib
+	shaclass = hashlib.sha1
+except:
+	import sha
+	shaclass = sha.sha
 
 cm = ConfigManager.instance()
 
@@ -440,6 +450,7 @@ class Job(object):
 			self.postRun()
 			self.cleanup()
 		
+		instance().updateJob(self)
 		self.notifyStateChange()
 
 	def notifyStateChange(self):
@@ -503,6 +514,7 @@ class Job(object):
 		if self._scheduledStartTime > time.time():
 			self.setScheduledStartTime(at)
 			self._unlock()
+			instance().updateJob(self)
 			self.notifyStateChange()
 			return True
 		else:
@@ -585,6 +597,157 @@ class Job(object):
 		"""
 		pass
 
+################################################################################
+# TE build cache
+################################################################################
+
+class TeBuildCache:
+	"""
+	A size-bounded cache of the TE eggs built by AtsJob.prepare(),
+	indexed by a hash of everything a build depends on (see AtsJob._getBuildKey()).
+
+	A cached egg is hard-linked (or copied, if not possible) into the
+	job's prepared TE directory. Eggs are never modified once built,
+	so that an evicted entry does not affect the jobs using it.
+	The least recently used entries are evicted when the cache exceeds
+	its maximum size.
+	"""
+	def __init__(self, directory, maxSize):
+		"""
+		@type  directory: string
+		@param directory: the cache directory, created if needed
+		@type  maxSize: integer
+		@param maxSize: the maximum size of the cached eggs, in bytes
+		"""
+		self._mutex = threading.RLock()
+		self._directory = directory
+		self._maxSize = maxSize
+		self._hits = 0
+		self._misses = 0
+		self._evictions = 0
+		# (size, last use time), indexed by key
+		self._entries = {}
+		self._size = 0
+		try:
+			os.makedirs(directory)
+		except:
+			pass
+		# Entries from a previous run
+		for filename in os.listdir(directory):
+			path = os.path.join(directory, filename)
+			if filename.endswith('.egg'):
+				s = os.stat(path)
+				self._entries[filename[:-4]] = (s.st_size, s.st_mtime)
+				self._size += s.st_size
+			else:
+				# Interrupted put()
+				os.unlink(path)
+		self._evict()
+
+	def _lock(self):
+		self._mutex.acquire()
+
+	def _unlock(self):
+		self._mutex.release()
+
+	def _getFilename(self, key):
+		return os.path.join(self._directory, '%s.egg' % key)
+
+	def get(self, key, filename):
+		"""
+		Links or copies a cached egg to filename.
+
+		@rtype: bool
+		@returns: True if the egg was cached (hit), False otherwise (miss).
+		"""
+		self._lock()
+		try:
+			if not self._entries.has_key(key):
+				self._misses += 1
+				return False
+			cachedFilename = self._getFilename(key)
+			try:
+				os.link(cachedFilename, filename)
+			except OSError:
+				shutil.copyfile(cachedFilename, filename)
+			self._entries[key] = (self._entries[key][0], time.time())
+			self._hits += 1
+			return True
+		finally:
+			self._unlock()
+
+	def put(self, key, filename):
+		"""
+		Adds a built egg to the cache.
+		"""
+		self._lock()
+		try:
+			if self._entries.has_key(key):
+				return
+			cachedFilename = self._getFilename(key)
+			# Atomically added, so that an interrupted copy is not considered on restart
+			tmpFilename = cachedFilename + '.tmp'
+			try:
+				os.link(filename, tmpFilename)
+			except OSError:
+				shutil.copyfile(filename, tmpFilename)
+			os.rename(tmpFilename, cachedFilename)
+			size = os.stat(cachedFilename).st_size
+			self._entries[key] = (size, time.time())
+			self._size += size
+			self._evict()
+		finally:
+			self._unlock()
+
+	def _evict(self):
+		if self._size <= self._maxSize:
+			return
+		entries = self._entries.items()
+		entries.sort(lambda x, y: cmp(x[1][1], y[1][1]))
+		for (key, (size, lastUse)) in entries:
+			if self._size <= self._maxSize:
+				break
+			try:
+				os.unlink(self._getFilename(key))
+			except Exception, e:
+				getLogger().warning("Unable to remove TE build cache entry %s: %s" % (key, str(e)))
+			del self._entries[key]
+			self._size -= size
+			self._evictions += 1
+
+	def getStatistics(self):
+		"""
+		@rtype: dict
+		@returns: the cache hits, misses, evictions, and current entries and size
+		"""
+		self._lock()
+		ret = { 'hits': self._hits, 'misses': self._misses, 'evictions': self._evictions,
+			'entries': len(self._entries), 'size': self._size }
+		self._unlock()
+		return ret
+
+
+TheTeBuildCache = None
+TheTeBuildCacheMutex = threading.RLock()
+
+def getTeBuildCache():
+	"""
+	Returns the TE build cache, or None if disabled
+	(no testerman.var_root, or ts.te_build_cache.max_size set to 0).
+	"""
+	global TheTeBuildCache
+	TheTeBuildCacheMutex.acquire()
+	try:
+		if TheTeBuildCache is None and cm.get('testerman.var_root') and cm.get('ts.te_build_cache.max_size'):
+			try:
+				TheTeBuildCache = TeBuildCache(cm.get('testerman.var_root') + '/te_build_cache', cm.get('ts.te_build_cache.max_size'))
+			except Exception, e:
+				getLogger().warning("Unable to create the TE build cache: %s" % str(e))
+		return TheTeBuildCache
+	finally:
+		TheTeBuildCacheMutex.release()
+
+
 ################################################################################
 # Job subclass: ATS
 ################################################################################
@@ -778,6 +941,33 @@ class AtsJob(Job):
 
 		getLogger().info("%s: resolved deps:\n%s" % (str(self), userlandDependencies))
 
+		# Read the dependencies - their contents are part of the TE build key
+		dependencyContents = {}
+		try:
+			for filename in userlandDependencies:
+				dependencyContents[filename] = FileSystemManager.instance().read(filename)
+		except Exception, e:
+			desc = 'unable to read dependency %s: %s' % (filename, str(e))
+			return handleError(20, desc)
+
+		# Now create a TE temporary package directory containing the prepared TE and all its dependencies.
+		# Will be moved to archives/ upon run()
+		self._tePreparedPackageDirectory = tempfile.mkdtemp()
+
+		# The same TE may have been built for a previous job
+		buildCache = getTeBuildCache()
+		buildKey = None
+		if buildCache:
+			try:
+				buildKey = self._getBuildKey(adapterModuleName, adapterDependencies, dependencyContents, packagePath)
+				if buildCache.get(buildKey, "%s/ats.egg" % self._tePreparedPackageDirectory):
+					getLogger().info("%s: using cached TE %s (TE build cache: %s)" % (str(self), buildKey, buildCache.getStatistics()))
+					self.setState(self.STATE_WAITING)
+					return
+			except Exception, e:
+				getLogger().warning("%s: unable to use the TE build cache: %s" % (str(self), str(e)))
+				buildKey = None
+
 		getLogger().info("%s: creating TE..." % str(self))
 		try:
 			te = TEFactory.createTestExecutable(self.getName(), self._source)
@@ -802,9 +992,6 @@ class AtsJob(Job):
 			return handleError(22, desc)
 
 		getLogger().info("%s: preparing TE files..." % str(self))
-		# Now create a TE temporary package directory containing the prepared TE and all its dependencies.
-		# Will be moved to archives/ upon run()
-		self._tePreparedPackageDirectory = tempfile.mkdtemp()
 		# We will now create a python egg file containing everything needed to run the TE independently from the server
 		
 		# The egg root dir is self._tePreparedPackageDirectory
@@ -842,7 +1029,7 @@ class AtsJob(Job):
 			for filename in userlandDependencies:
 				# filename is a docroot-path
 
-				depContent = FileSystemManager.instance().read(filename)
+				depContent = dependencyContents[filename]
 				# Alter the content (additional includes, etc)
 				depContent = TEFactory.createDependency(depContent)
 
@@ -992,6 +1179,12 @@ import main_te
 		for s in sources:
 			egg.write("%s/%s" % (self._tePreparedPackageDirectory, s), s)
 		egg.close()
+
+		if buildKey:
+			try:
+				buildCache.put(buildKey, "%s/ats.egg" % self._tePreparedPackageDirectory)
+			except Exception, e:
+				getLogger().warning("%s: unable to add the TE to the TE build cache: %s" % (str(self), str(e)))
 		
 		getLogger().info("%s: cleaning up temporary files..." % (str(self)))
 		try:
@@ -1004,6 +1197,51 @@ import main_te
 		# OK, we're ready.
 		self.setState(self.STATE_WAITING)
 
+	def _getBuildKey(self, adapterModuleName, coreDependencies, dependencyContents, packagePath):
+		"""
+		Computes the key of the TE in the TE build cache,
+		a hash of everything the built egg depends on:
+		the ATS and its name and path, its userland dependencies and their contents,
+		the adapter module and its core dependencies, the TE template,
+		the server version and the configuration values embedded in the TE.
+		
+		@rtype: string
+		@returns: the key, as an hexadecimal string
+		"""
+		h = shaclass()
+		def add(value):
+			if isinstance(value, unicode):
+				value = value.encode('utf-8')
+			else:
+				value = str(value)
+			h.update('%d:' % len(value))
+			h.update(value)
+
+		for value in [ self.getName(), self._path, self._source, packagePath, Versions.TESTERMAN_SERVER_VERSION,
+			adapterModuleName, cm.get("testerman.te.python.ttcn3module"), 
+			cm.get("tacs.ip"), cm.get("tacs.port"), cm.get("interface.il.ip"), cm.get("interface.il.port"),
+			cm.get("testerman.te.log.max_payload_size"), cm.get("testerman.te.codec_paths"), cm.get("testerman.te.probe_paths"),
+			cm.get('ts.name') ]:
+			add(value)
+
+		f = open("%s/%s" % (cm.get_transient('ts.server_root'), TEFactory.TE_TEMPLATE_NAME))
+		add(f.read())
+		f.close()
+
+		filenames = dependencyContents.keys()
+		filenames.sort()
+		for filename in filenames:
+			add(filename)
+			add(dependencyContents[filename])
+
+		for coreDep in coreDependencies:
+			f = open("%s/%s" % (cm.get_transient('ts.server_root'), coreDep), 'rb')
+			add(coreDep)
+			add(f.read())
+			f.close()
+
+		return h.hexdigest()
+
 	def preRun(self):
 		"""
 		Called by the scheduler when just about to call run() in a dedicated thread.
@@ -1169,6 +1407,7 @@ import main_te
 
 		# Normal continuation, once the child has returned.
 		getLogger().info("%s: TE completed" % str(self))
+		EventManager.instance().closeLog(teLogFilename)
 		if sig > 0:
 			getLogger().info("%s: TE terminated with signal %d" % (str(self), sig))
 			# In case of a kill, make sure we never return a "OK" retcode
@@ -1220,6 +1459,7 @@ import main_te
 			try:
 				# Logs are locally generated, so no need to access them through the FileSystemManager.
 				absoluteLogFilename = os.path.normpath("%s%s" % (cm.get("testerman.document_root"), self._logFilename))
+				EventManager.instance().flushLog(absoluteLogFilename)
 				f = open(absoluteLogFilename, 'r')
 				fcntl.flock(f.fileno(), fcntl.LOCK_EX)
 				res = '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n%s</ats>' % f.read()
@@ -1453,6 +1693,7 @@ class CampaignJob(Job):
 			self.setResult(1)
 			self.setState(self.STATE_CANCELLED)
 		self._logEvent('event', 'campaign-stopped', {'id': self._name, 'result': self.getResult()})
+		EventManager.instance().closeLog(self._absoluteLogFilename)
 		
 		return self.getResult()
 
@@ -1708,6 +1949,7 @@ class CampaignJob(Job):
 		Returns the current known log.
 		"""
 		if self._logFilename:
+			EventManager.instance().flushLog(self._absoluteLogFilename)
 			f = open(self._absoluteLogFilename, 'r')
 			fcntl.flock(f.fileno(), fcntl.LOCK_EX)
 			# FIXME: we generate a 'ats' root element. Is that correct ?
@@ -1717,48 +1959,320 @@ class CampaignJob(Job):
 		else:
 			return '<?xml version="1.0" encoding="utf-8" ?>\n<ats>\n</ats>'
 
+################################################################################
+# Job queue persistence
+################################################################################
+
+class JobQueueStore:
+	"""
+	Persists the job queue as a snapshot and an append-only journal.
+
+	Each time a job is registered or updated, its attributes are appended
+	to the journal, as well as the ids of the purged jobs.
+	The other jobs referenced by a job (its parent, its children) are
+	recorded as their ids, so that the cost of a record does not depend
+	on the queue size.
+	The journal is periodically compacted into a new snapshot: the journal
+	is first rotated (its records are moved to a previous journal), so that
+	the snapshot can be written, to a temporary file then renamed,
+	while new records are appended. The previous journal is then removed.
+
+	The snapshot is the pickled (last journal sequence number, job queue).
+	A journal record is: 4 bytes length, 4 bytes CRC32 (network order),
+	the payload: a pickled header (sequence number, record type, job id(s), job class),
+	followed by the pickled job attributes for a job record.
+	A truncated or corrupted record (crash during a write) ends the journal.
+	"""
+	RECORD_JOB = "job"
+	RECORD_PURGE = "purge"
+
+	def __init__(self, snapshotFilename, journalFilename):
+		self._snapshotFilename = snapshotFilename
+		self._journalFilename = journalFilename
+		self._previousJournalFilename = journalFilename + '.previous'
+		self._journal = None
+		# Sequence number of the last record
+		self._seq = 0
+		# Sequence number of the last record in the snapshot
+		self._snapshotSeq = 0
+		# Sequence number of the last record in the previous journal
+		self._rotationSeq = 0
+		# Serializes the snapshot writes
+		self._snapshotMutex = threading.Lock()
+		# Protects the previous journal
+		self._mutex = threading.Lock()
+		# Number of records in the journal
+		self._journalRecords = 0
+		# Ids of the jobs that can be recorded as references
+		self._ids = {}
+
+	def restore(self):
+		"""
+		Loads the snapshot, replays the journals (the previous one, if a
+		compaction was interrupted, then the current one), then opens the
+		journal for appending, after its last valid record.
+
+		@rtype: list of Job instances
+		@returns: the restored job queue, in registration order
+		"""
+		jobs = {}
+		queue = []
+		if os.path.isfile(self._snapshotFilename):
+			f = open(self._snapshotFilename, 'rb')
+			try:
+				snapshot = pickle.load(f)
+			finally:
+				f.close()
+			if isinstance(snapshot, list):
+				# Previous format: the job queue only
+				snapshot = (0, snapshot)
+			(self._seq, queue) = snapshot
+			for job in queue:
+				jobs[job.getId()] = job
+
+		self._snapshotSeq = self._seq
+		for filename in [ self._previousJournalFilename, self._journalFilename ]:
+			if os.path.isfile(filename):
+				self._replayJournal(filename, jobs, queue)
+
+		self._journal = open(self._journalFilename, 'ab')
+		queue = filter(lambda x: jobs.get(x.getId()) is x, queue)
+		self._ids = dict.fromkeys(jobs.keys())
+		return queue
+
+	def _replayJournal(self, filename, jobs, queue):
+		"""
+		Replays the records of a journal file, then truncates it after
+		its last valid record.
+		"""
+		validSize = 0
+		f = open(filename, 'rb')
+		try:
+			while 1:
+				header = f.read(8)
+				if len(header) < 8:
+					break
+				(length, crc) = struct.unpack('>II', header)
+				payload = f.read(length)
+				if len(payload) < length or (zlib.crc32(payload) & 0xffffffff) != crc:
+					getLogger().warning("Truncated or corrupted job queue journal record, ignoring the end of the journal")
+					break
+				try:
+					self._replay(payload, jobs, queue)
+				except Exception, e:
+					getLogger().warning("Unable to replay a job queue journal record, ignoring the end of the journal: %s" % str(e))
+					break
+				validSize = f.tell()
+				self._journalRecords += 1
+		finally:
+			f.close()
+		f = open(filename, 'r+b')
+		f.truncate(validSize)
+		f.close()
+
+	def _replay(self, payload, jobs, queue):
+		unpickler = pickle.Unpickler(cStringIO.StringIO(payload))
+		unpickler.persistent_load = lambda pid: jobs.get(int(pid))
+		(seq, recordType, arg, cls) = unpickler.load()
+		if seq <= self._seq:
+			# Already in the snapshot (crash after a snapshot, before resetting the journal)
+			return
+		self._seq = seq
+		if recordType == self.RECORD_JOB:
+			job = jobs.get(arg)
+			if job is None:
+				job = cls.__new__(cls)
+				jobs[arg] = job
+				queue.append(job)
+			job.__dict__.update(unpickler.load())
+			# The parent may still reference the copy of the job
+			# recorded with it, before the job was registered
+			parent = job.getParent()
+			if parent is not None:
+				for children in parent._childBranches.values():
+					for i in range(len(children)):
+						if children[i] is not job and children[i].getId() == arg:
+							children[i] = job
+		elif recordType == self.RECORD_PURGE:
+			for id_ in arg:
+				if jobs.has_key(id_):
+					del jobs[id_]
+
+	def _persistentId(self, obj):
+		if isinstance(obj, Job) and self._ids.has_key(obj.getId()):
+			return str(obj.getId())
+		return None
+
+	def _append(self, recordType, arg, cls = None, state = None):
+		self._seq += 1
+		f = cStringIO.StringIO()
+		pickler = pickle.Pickler(f, 2)
+		pickler.persistent_id = self._persistentId
+		pickler.dump((self._seq, recordType, arg, cls))
+		if state is not None:
+			pickler.dump(state)
+		payload = f.getvalue()
+		self._journal.write(struct.pack('>II', len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+		self._journal.flush()
+		self._journalRecords += 1
+
+	def appendJob(self, job):
+		"""
+		Records the current attributes of a job.
+		"""
+		self._ids[job.getId()] = None
+		self._append(self.RECORD_JOB, job.getId(), job.__class__, job.__dict__.copy())
+
+	def appendPurge(self, ids):
+		"""
+		Records the ids of purged jobs.
+		"""
+		for id_ in ids:
+			if self._ids.has_key(id_):
+				del self._ids[id_]
+		self._append(self.RECORD_PURGE, ids)
+
+	def getJournalRecordCount(self):
+		return self._journalRecords
+
+	def rotate(self):
+		"""
+		Starts a new journal: the current records are moved
+		to the previous journal, until a snapshot including them is written.
+		Must not be called concurrently with appends.
+
+		@rtype: integer
+		@returns: the sequence number of the last record, to pass to writeSnapshot()
+		"""
+		self._mutex.acquire()
+		try:
+			self._journal.close()
+			if os.path.isfile(self._previousJournalFilename):
+				# The previous snapshot was not written: keep its records
+				f = open(self._previousJournalFilename, 'ab')
+				try:
+					f.write(open(self._journalFilename, 'rb').read())
+					f.flush()
+					os.fsync(f.fileno())
+				finally:
+					f.close()
+			else:
+				os.rename(self._journalFilename, self._previousJournalFilename)
+			self._journal = open(self._journalFilename, 'wb')
+			self._journalRecords = 0
+			self._rotationSeq = self._seq
+			return self._seq
+		finally:
+			self._mutex.release()
+
+	def writeSnapshot(self, seq, queue):
+		"""
+		Writes a new snapshot of the job queue, then removes the previous
+		journal if the snapshot includes all its records.
+		May be called concurrently with appends, but the queue must not
+		be modified meanwhile (pass a copy).
+
+		@type  seq: integer
+		@param seq: the sequence number returned by rotate() when the queue was copied
+		@type  queue: list of Job instances
+		@param queue: the complete job queue
+		"""
+		self._snapshotMutex.acquire()
+		try:
+			if seq < self._snapshotSeq:
+				# A more recent snapshot was written meanwhile
+				return
+			tmpFilename = self._snapshotFilename + '.tmp'
+			f = open(tmpFilename, 'wb')
+			try:
+				pickle.dump((seq, queue), f, 2)
+				f.flush()
+				os.fsync(f.fileno())
+			finally:
+				f.close()
+			self._mutex.acquire()
+			try:
+				os.rename(tmpFilename, self._snapshotFilename)
+				self._snapshotSeq = seq
+				# A crash here is safe: the previous journal records are
+				# older than the snapshot, and not replayed.
+				if seq == self._rotationSeq and os.path.isfile(self._previousJournalFilename):
+					os.remove(self._previousJournalFilename)
+			finally:
+				self._mutex.release()
+		finally:
+			self._snapshotMutex.release()
+
+	def compact(self, queue):
+		"""
+		Writes a new snapshot of the job queue, then resets the journal.
+		Must not be called concurrently with appends.
+
+		@type  queue: list of Job instances
+		@param queue: the complete job queue
+		"""
+		self.writeSnapshot(self.rotate(), queue)
+
+	def close(self):
+		if self._journal:
+			self._journal.close()
+			self._journal = None
+
+
 ################################################################################
 # The Scheduler Thread
 ################################################################################
 
 class Scheduler(threading.Thread):
 	"""
-	A Background thread that regularly checks the main job queue for job to start (job in STATE_WAITING).
-	
-	We should have a dedicated heap for that.
-	However, since we won't have thousands of waiting jobs, a first straightforward implementation
-	may be enough.
+	A Background thread that starts the waiting root jobs on time.
+
+	The manager keeps them in a heap of scheduled start times:
+	the thread sleeps until the next scheduled start time, or until
+	notified of a new (or rescheduled) job.
 	"""
-	def __init__(self, manager):	
+	def __init__(self, manager):
 		threading.Thread.__init__(self)
 		self._manager = manager
 		self._stopEvent = threading.Event()
 		self._notifyEvent = threading.Event()
-	
+
 	def run(self):
 		getLogger().info("Job scheduler started.")
 		while not self._stopEvent.isSet():
-			# this delay is dynamic - re-read at each iterations
-			delay = float(cm.get('ts.jobscheduler.interval')) / 1000.0
-			self._notifyEvent.wait(delay)
+			nextStartTime = self.check()
+			if nextStartTime is None:
+				self._notifyEvent.wait()
+			else:
+				# The sleep is capped by this delay (dynamic - re-read at each iterations),
+				# so that we don't oversleep if the system clock is changed.
+				delay = min(nextStartTime - time.time(), float(cm.get('ts.jobscheduler.interval')) / 1000.0)
+				if delay > 0:
+					self._notifyEvent.wait(delay)
 			self._notifyEvent.clear()
-			self.check()
 		getLogger().info("Job scheduler stopped.")
-	
+
 	def check(self):
-		jobs = self._manager.getWaitingRootJobs()
+		"""
+		Starts the jobs whose scheduled start time is reached.
+
+		@rtype: timestamp, or None
+		@returns: the next scheduled start time, if any
+		"""
+		(jobs, nextStartTime) = self._manager.popDueJobs(time.time())
 		for job in jobs:
-			if job.getScheduledStartTime() < time.time():
-				getLogger().info("Scheduler: starting new job: %s" % str(job))
-				# Prepare a new thread, execute the job
-				job.preRun()
-				jobThread = threading.Thread(target = lambda: job.run(job.getScheduledSession()))
-				jobThread.start()
+			getLogger().info("Scheduler: starting new job: %s" % str(job))
+			# Prepare a new thread, execute the job
+			job.preRun()
+			jobThread = threading.Thread(target = lambda job = job: job.run(job.getScheduledSession()))
+			jobThread.start()
+		return nextStartTime
 
 	def stop(self):
 		self._stopEvent.set()
+		self._notifyEvent.set()
 		self.join()
-	
+
 	def notify(self):
 		self._notifyEvent.set()
 
@@ -1766,10 +2280,22 @@ class Scheduler(threading.Thread):
 class JobManager:
 	"""
 	A Main entry point to the job manager module.
+
+	Besides the job queue, the registered jobs are indexed by id and
+	by state, and the waiting root jobs are scheduled in a heap,
+	so that the lookups and the scheduler do not slow down with the number
+	of jobs kept in the queue.
+	Jobs call updateJob() when their state or scheduled start time changes.
 	"""
 	def __init__(self):
 		self._mutex = threading.RLock()
+		# Registered jobs, in registration order
 		self._jobQueue = []
+		self._initIndexes()
+		# The JobQueueStore, once restored
+		self._store = None
+		# The thread writing a snapshot after the journal was rotated, if any
+		self._compactionThread = None
 		self._scheduler = Scheduler(self)
 	
 	def start(self):
@@ -1784,6 +2310,57 @@ class JobManager:
 	def _unlock(self):
 		self._mutex.release()
 	
+	def _initIndexes(self):
+		"""
+		Resets the indexes, then indexes the jobs in the queue.
+		"""
+		# Job instances, indexed by id
+		self._jobsById = {}
+		# Job instances, indexed by id, per state
+		self._jobsByState = {}
+		# The state a job is currently indexed with, per job id
+		self._indexedStates = {}
+		# Heap of (scheduled start time, job id) of the waiting root jobs.
+		# Outdated entries (rescheduled or started jobs) are not removed from it,
+		# but skipped when popped: only the entry in self._scheduledStartTimes is valid.
+		self._schedule = []
+		self._scheduledStartTimes = {}
+		for job in self._jobQueue:
+			self._indexJob(job)
+
+	def _indexJob(self, job):
+		id_ = job.getId()
+		state = job.getState()
+		self._jobsById[id_] = job
+		self._jobsByState.setdefault(state, {})[id_] = job
+		self._indexedStates[id_] = state
+		self._scheduleJob(job)
+
+	def _unindexJob(self, job):
+		id_ = job.getId()
+		del self._jobsById[id_]
+		del self._jobsByState[self._indexedStates.pop(id_)][id_]
+		if self._scheduledStartTimes.has_key(id_):
+			del self._scheduledStartTimes[id_]
+
+	def _scheduleJob(self, job):
+		"""
+		Adds a waiting root job to the schedule heap, if not already
+		scheduled at its current scheduled start time.
+
+		@rtype: bool
+		@returns: True if the job was (re)scheduled, False otherwise
+		"""
+		if job.getParent() is not None or self._indexedStates[job.getId()] != Job.STATE_WAITING:
+			return False
+		id_ = job.getId()
+		startTime = job.getScheduledStartTime()
+		if self._scheduledStartTimes.get(id_) == startTime:
+			return False
+		self._scheduledStartTimes[id_] = startTime
+		heapq.heappush(self._schedule, (startTime, id_))
+		return True
+
 	def registerJob(self, job):
 		"""
 		Register a new job in the queue.
@@ -1792,30 +2369,135 @@ class JobManager:
 		"""
 		self._lock()
 		self._jobQueue.append(job)
+		self._indexJob(job)
+		self._persistJob(job)
+		self._unlock()
+
+	def updateJob(self, job):
+		"""
+		Updates the indexes of a job after a change of its state
+		or of its scheduled start time.
+		Does nothing if the job is not registered.
+		"""
+		self._lock()
+		try:
+			id_ = job.getId()
+			if not self._jobsById.has_key(id_):
+				return
+			# Always index the current state: this may be called concurrently
+			# for several state changes of the same job.
+			state = job.getState()
+			previousState = self._indexedStates[id_]
+			if state != previousState:
+				del self._jobsByState[previousState][id_]
+				self._jobsByState.setdefault(state, {})[id_] = job
+				self._indexedStates[id_] = state
+			scheduled = self._scheduleJob(job)
+			self._persistJob(job)
+		finally:
+			self._unlock()
+		if scheduled:
+			# Wake up the scheduler: the job may be the next one to start
+			self._scheduler.notify()
+
+	def popDueJobs(self, now):
+		"""
+		Extracts the waiting root jobs whose scheduled start time is reached
+		from the schedule heap.
+		Useful for the scheduler.
+		Non-root (waiting) jobs are started by their parents explicitely,
+		not by the scheduler.
+
+		@type  now: timestamp
+		@param now: the current time
+
+		@rtype: tuple (list of Job instances, timestamp or None)
+		@returns: the jobs to start, by scheduled start time, and
+		          the next scheduled start time, if any.
+		"""
+		ret = []
+		nextStartTime = None
+		self._lock()
+		try:
+			while self._schedule:
+				(startTime, id_) = self._schedule[0]
+				job = self._jobsById.get(id_)
+				if self._scheduledStartTimes.get(id_) != startTime \
+					or job is None \
+					or job.getScheduledStartTime() != startTime \
+					or job.getParent() is not None \
+					or self._indexedStates[id_] != Job.STATE_WAITING:
+					# Outdated entry
+					heapq.heappop(self._schedule)
+					if self._scheduledStartTimes.get(id_) == startTime:
+						del self._scheduledStartTimes[id_]
+					continue
+				if startTime > now:
+					nextStartTime = startTime
+					break
+				heapq.heappop(self._schedule)
+				del self._scheduledStartTimes[id_]
+				ret.append(job)
+		finally:
+			self._unlock()
+		return (ret, nextStartTime)
+
+	def _persistJob(self, job):
+		"""
+		Appends the current job attributes to the journal (if persistence
+		is enabled), then compacts the journal if too large.
+		Must be called with the lock held.
+		"""
+		if not self._store:
+			return
+		try:
+			self._store.appendJob(job)
+			if self._store.getJournalRecordCount() >= cm.get('ts.jobqueue.compaction_threshold') and not self._compactionThread:
+				# Only the journal rotation and the queue copy are done
+				# with the lock held: the snapshot is written in background
+				getLogger().debug("Compacting job queue journal...")
+				seq = self._store.rotate()
+				self._compactionThread = threading.Thread(target = self._writeSnapshot, args = (seq, self._jobQueue[:]))
+				self._compactionThread.start()
+		except Exception, e:
+			getLogger().warning("Unable to persist job %s: %s" % (job.getId(), str(e)))
+
+	def _writeSnapshot(self, seq, queue):
+		try:
+			self._store.writeSnapshot(seq, queue)
+			getLogger().debug("Job queue journal compacted")
+		except Exception, e:
+			getLogger().warning("Unable to compact the job queue journal: %s" % str(e))
+		self._lock()
+		self._compactionThread = None
 		self._unlock()
 
 	def persist(self):
 		"""
-		Persists the current job queue to disk.
+		Persists the current job queue to disk, as a new snapshot.
 		"""
-		if not cm.get('testerman.var_root'):
+		if not self._store:
 			return 
 
-		queueFilename = cm.get('testerman.var_root') + '/jobqueue.dump'
-		getLogger().debug("Persisting queue to %s..." % queueFilename)
+		getLogger().debug("Persisting queue...")
 		self._lock()
 		try:
-			dump = pickle.dumps(self._jobQueue)
-			f = open(queueFilename, 'w')
-			f.write(dump)
-			f.close()
+			seq = self._store.rotate()
+			queue = self._jobQueue[:]
 		except Exception, e:
-			getLogger().warning("Unable to persist job queue to %s: %s" % (queueFilename, str(e)))
+			self._unlock()
+			getLogger().warning("Unable to persist job queue: %s" % str(e))
+			return
 		self._unlock()
+		try:
+			self._store.writeSnapshot(seq, queue)
+		except Exception, e:
+			getLogger().warning("Unable to persist job queue: %s" % str(e))
 
 	def restore(self):
 		"""
-		Reload the queue for the persisted queue.
+		Reload the queue for the persisted queue (snapshot and journal),
+		and enables its persistence.
 		Called on restart.
 		Jobs in running states are flagged as "crashed".
 		
@@ -1826,16 +2508,13 @@ class JobManager:
 
 		maxId = 0
 		queueFilename = cm.get('testerman.var_root') + '/jobqueue.dump'
-		try:		
-			f = open(queueFilename)
-			dump = f.read()
-			f.close()
-		except:
-			return
+		store = JobQueueStore(queueFilename, cm.get('testerman.var_root') + '/jobqueue.journal')
 		
 		getLogger().info("Restoring job queue from %s..." % queueFilename)
 		try:
-			self._jobQueue = pickle.loads(dump)
+			self._jobQueue = store.restore()
+			self._store = store
+			self._initIndexes()
 			for job in self._jobQueue:
 				if job.getState() in [ job.STATE_RUNNING, job.STATE_PAUSED, job.STATE_CANCELLING, job.STATE_INITIALIZING ]:
 					getLogger().info("Job %s marked as being crashed" % job.getId())
@@ -1848,8 +2527,15 @@ class JobManager:
 			global _GeneratorBaseId
 			_GeneratorBaseId = maxId
 			getLogger().info("Continuing job IDs at %s" % maxId)
+			# Start with an empty journal
+			self.persist()
 		except Exception, e:
-			getLogger().info("Unable to restore job queue: %s" % str(e))
+			# Keep the files for analysis
+			store.close()
+			self._store = None
+			self._jobQueue = []
+			self._initIndexes()
+			getLogger().error("Unable to restore job queue, job queue persistence disabled: %s" % str(e))
 #		self._unlock()
 		
 	def submitJob(self, job):
@@ -1876,36 +2562,39 @@ class JobManager:
 	def getWaitingRootJobs(self):
 		"""
 		Only extracts the waiting root jobs subset from the queue.
-		Useful for the scheduler.
 		Non-root (waiting) jobs are started by their parents explicitely,
 		not by the scheduler.
 
 		@rtype: list of Job instances
-		@returns: the list of waiting jobs.
+		@returns: the list of waiting jobs, by id.
 		"""
 		self._lock()
 		try:
-			ret = filter(lambda x: (x.getParent() is None) and (x.getState() == Job.STATE_WAITING), self._jobQueue)
-		except Exception, e:
-			ret = []
-			getLogger().error("JobManager: unable to get jobs waiting for execution: %s" % str(e))	
-		self._unlock()
+			ret = filter(lambda x: x.getParent() is None, self._jobsByState.get(Job.STATE_WAITING, {}).values())
+			ret.sort(lambda x, y: cmp(x.getId(), y.getId()))
+		finally:
+			self._unlock()
 		return ret
-	
+
 	def getJobInfo(self, id_ = None):
 		"""
 		@type  id_: integer, or None
 		@param id_: the jobId for which we request some info, or None if we want all.
-		
+
 		@rtype: list of dict
 		@returns: a list of job dict representations. May be empty if the id_ was not found.
 		"""
+		if id_ is not None:
+			job = self.getJob(id_)
+			if not job:
+				return []
+			return [ job.toDict() ]
+
 		ret = []
 		self._lock()
 		try:
 			for job in self._jobQueue:
-				if id_ is None or job.getId() == id_:
-					ret.append(job.toDict())
+				ret.append(job.toDict())
 		except:
 			pass
 		self._unlock()
@@ -1941,15 +2630,25 @@ class JobManager:
 		Internal only ?
 		Gets a job based on its id.
 		"""
-		j = None
 		self._lock()
-		for job in self._jobQueue:
-			if job.getId() == id_:
-				j = job
-				break
+		j = self._jobsById.get(id_)
 		self._unlock()
 		return j
-	
+
+	def getJobsByState(self, state):
+		"""
+		@type  state: string in Job.STATES
+		@param state: the job state
+
+		@rtype: list of Job instances
+		@returns: the registered jobs currently in this state, by id.
+		"""
+		self._lock()
+		ret = self._jobsByState.get(state, {}).values()
+		self._unlock()
+		ret.sort(lambda x, y: cmp(x.getId(), y.getId()))
+		return ret
+
 	def sendSignal(self, id_, signal):
 		job = self.getJob(id_)
 		if job:
@@ -1989,23 +2688,29 @@ class JobManager:
 	def purgeJobs(self, older_than):
 		"""
 		Scans the queue and purge jobs whose completion time is older than older_than.
-		
+
 		If one of the parent jobs is still running (a campaign, etc),
 		the job is kept even if it was completed before the older_than.
 		"""
 		self._lock()
 		try:
-		
-			keptQueue = []
-			count = len(self._jobQueue)
-			# Let's select kept jobs instead of removing items in the current jobqueue
-			for job in self._jobQueue:
-				if not self.isBottomUpTreeCompleted(job) or not (job._stopTime and job._stopTime < older_than):
-					keptQueue.append(job)
-					count -= 1
-			self._jobQueue = keptQueue
-			return count
-		finally:	
+			# Only the jobs in a final state have a completion time
+			purged = {}
+			for state in Job.FINAL_STATES:
+				for job in self._jobsByState.get(state, {}).values():
+					if self.isBottomUpTreeCompleted(job) and job._stopTime < older_than:
+						purged[job.getId()] = job
+			if purged:
+				for job in purged.values():
+					self._unindexJob(job)
+				self._jobQueue = filter(lambda x: not purged.has_key(x.getId()), self._jobQueue)
+				if self._store:
+					try:
+						self._store.appendPurge(purged.keys())
+					except Exception, e:
+						getLogger().warning("Unable to persist purged jobs: %s" % str(e))
+			return len(purged)
+		finally:
 			self._unlock()
 
 TheJobManager = None
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+##
+# This file is part of Testerman, a test automation system.
+# Copyright (c) 2008,2009,2010 Sebastien Lefevre and other contributors
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+##
+
+##
+# A buffered log writer, used to append log events to execution log files.
+#
+# Used by the TL subsystem (EventManager, for server-controlled executions)
+# and the TE local logger (LocalIlClient, for standalone executions).
+#
+# A LogSink keeps the log files open (up to maxOpenFiles, the least recently
+# written one is closed when this limit is reached) and buffers the appended
+# events. A file buffer is written:
+# - as soon as it reaches maxBufferSize bytes,
+# - or by a background flusher, every flushInterval seconds,
+# - or on explicit flush()/close() calls (before reading the log file, at
+#   the end of an execution).
+#
+# Files that were not written for idleTimeout seconds are closed by the
+# flusher, so that log files of completed executions do not keep file
+# descriptors forever, even if nobody close()d them.
+#
+# When the sink is not started (or once stopped), writes are not buffered.
+#
+# The written data is left unchanged: what is written is the concatenation
+# of the write()'d data, in the same order.
+##
+
+import os
+import threading
+import time
+
+
+class _LogFile:
+	"""
+	An open log file and its pending (unwritten) data.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'a')
+		self.buffer = []
+		self.bufferSize = 0
+		self.lastWrite = time.time()
+
+	def flush(self):
+		if self.buffer:
+			data = ''.join(self.buffer)
+			self.buffer = []
+			self.bufferSize = 0
+			self.file.write(data)
+			self.file.flush()
+
+	def close(self, sync = False):
+		try:
+			self.flush()
+			if sync:
+				os.fsync(self.file.fileno())
+		finally:
+			self.file.close()
+
+
+class _FlusherThread(threading.Thread):
+	"""
+	Periodically flushes the buffered data of a LogSink,
+	and closes its idle files.
+	"""
+	def __init__(self, sink, interval):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self._sink = sink
+		self._interval = interval
+		self._stopEvent = threading.Event()
+
+	def run(self):
+		while not self._stopEvent.isSet():
+			self._stopEvent.wait(self._interval)
+			try:
+				self._sink._flushAll()
+			except Exception:
+				pass
+
+	def stop(self):
+		self._stopEvent.set()
+
+
+class LogSink:
+	"""
+	A thread-safe, buffered writer for log files.
+
+	Writes that cannot be performed (unable to open or write
+	a file) raise an exception when the data is written, i.e.
+	not necessarily in the write() call that provided it.
+	"""
+	def __init__(self, maxOpenFiles = 64, maxBufferSize = 65536, flushInterval = 1.0, idleTimeout = 30.0):
+		"""
+		@type  maxOpenFiles: integer
+		@param maxOpenFiles: the maximum number of files kept open
+		@type  maxBufferSize: integer
+		@param maxBufferSize: the per-file buffer size (in bytes) that triggers a write
+		@type  flushInterval: float
+		@param flushInterval: the maximum delay before buffered data is written, in s
+		@type  idleTimeout: float
+		@param idleTimeout: the delay after which a file that was not written is closed, in s
+		"""
+		self._mutex = threading.Lock()
+		self._files = {}
+		self._maxOpenFiles = maxOpenFiles
+		self._maxBufferSize = maxBufferSize
+		self._flushInterval = flushInterval
+		self._idleTimeout = idleTimeout
+		self._flusher = None
+
+	def _lock(self):
+		self._mutex.acquire()
+
+	def _unlock(self):
+		self._mutex.release()
+
+	def start(self):
+		"""
+		Starts the background flusher.
+		"""
+		self._lock()
+		if not self._flusher:
+			self._flusher = _FlusherThread(self, self._flushInterval)
+			self._flusher.start()
+		self._unlock()
+
+	def stop(self):
+		"""
+		Stops the background flusher, writes the pending data,
+		syncs and closes all files.
+		"""
+		self._lock()
+		flusher = self._flusher
+		self._flusher = None
+		try:
+			for filename in self._files.keys():
+				try:
+					self._close(filename, sync = True)
+				except Exception:
+					pass
+		finally:
+			self._unlock()
+		if flusher:
+			flusher.stop()
+			flusher.join()
+
+	def write(self, filename, data):
+		"""
+		Appends data to a file.
+
+		@type  filename: string
+		@param filename: the absolute path of the file to write
+		@type  data: string (not unicode)
+		@param data: the data to append
+		"""
+		self._lock()
+		try:
+			f = self._files.get(filename)
+			if not f:
+				if len(self._files) >= self._maxOpenFiles:
+					self._closeLeastRecentlyWritten()
+				f = _LogFile(filename)
+				self._files[filename] = f
+			f.buffer.append(data)
+			f.bufferSize += len(data)
+			f.lastWrite = time.time()
+			if f.bufferSize >= self._maxBufferSize or not self._flusher:
+				f.flush()
+		finally:
+			self._unlock()
+
+	def flush(self, filename):
+		"""
+		Writes the pending data for a file, if any,
+		so that it can be read by other processes.
+
+		@type  filename: string
+		@param filename: the absolute path of the file to flush
+		"""
+		self._lock()
+		try:
+			f = self._files.get(filename)
+			if f:
+				f.flush()
+		finally:
+			self._unlock()
+
+	def close(self, filename, sync = True):
+		"""
+		Writes the pending data for a file and closes it.
+		A subsequent write() to this file reopens it.
+
+		@type  filename: string
+		@param filename: the absolute path of the file to close
+		@type  sync: bool
+		@param sync: if True, syncs the file to the disk before closing it
+		"""
+		self._lock()
+		try:
+			self._close(filename, sync)
+		finally:
+			self._unlock()
+
+	def _close(self, filename, sync):
+		f = self._files.get(filename)
+		if f:
+			del self._files[filename]
+			f.close(sync)
+
+	def _closeLeastRecentlyWritten(self):
+		lru = None
+		for f in self._files.values():
+			if lru is None or f.lastWrite < lru.lastWrite:
+				lru = f
+		if lru:
+			self._close(lru.filename, sync = False)
+
+	def _flushAll(self):
+		"""
+		Called by the flusher: writes all pending data,
+		closes idle files.
+		"""
+		self._lock()
+		try:
+			now = time.time()
+			for filename, f in self._files.items():
+				try:
+					if now - f.lastWrite > self._idleTimeout:
+						self._close(filename, sync = False)
+					else:
+						f.flush()
+				except Exception:
+					# Do not prevent other files from being flushed
+					pass
+		finally:
+			self._unlock()
+
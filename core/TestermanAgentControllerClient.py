@@ -45,12 +45,19 @@ class IaClient(Nodes.ConnectingNode):
 	def __init__(self, name):
 		Nodes.ConnectingNode.__init__(self, name, "IaClient")
 		self.receivedNotificationCallback = None # on TRI-ENQUEUE-MSG
+		self.receivedBatchNotificationCallback = None # on TRI-ENQUEUE-MSGS
 		self.logNotificationCallback = None # on LOG
 		self.probeNotificationCallback = None # on PROBE
 		self._logger = DummyLogger()
+		self.sendErrorCallback = None # on pipelined TRI-SEND failure
 		self._subscriptions =[]
 		self._mutex = threading.RLock()
 		self._connected = False
+		# Pipelined TRI-SEND management: max number of in-flight requests (0: disabled),
+		# and probe URI of the pending ones, indexed by transaction ID
+		self._sendWindow = 0
+		self._pendingSends = {}
+		self._pendingSendsCondition = threading.Condition()
 	
 	def lock(self):
 		self._mutex.acquire()
@@ -105,13 +112,35 @@ class IaClient(Nodes.ConnectingNode):
 		self.getLogger().debug("Received a notification")
 		if notification.getMethod() == "TRI-ENQUEUE-MSG" and self.receivedNotificationCallback:
 			self.receivedNotificationCallback(notification.getUri(), notification.getApplicationBody(), notification.getHeader("SUT-Address"))
+		elif notification.getMethod() == "TRI-ENQUEUE-MSGS":
+			# Messages enqueued by several probes: list of (probe uri, message, sut address)
+			if self.receivedBatchNotificationCallback:
+				self.receivedBatchNotificationCallback(notification.getApplicationBody())
+			elif self.receivedNotificationCallback:
+				for (probeUri, message, sutAddress) in notification.getApplicationBody():
+					self.receivedNotificationCallback(probeUri, message, sutAddress)
 		elif notification.getMethod() == "LOG" and self.logNotificationCallback:
 			self.logNotificationCallback(notification.getUri(), notification.getHeader('Log-Class'), notification.getApplicationBody())
 		elif notification.getMethod() == "PROBE-EVENT" and self.probeNotificationCallback:
 			self.probeNotificationCallback(notification)
 	
 	def onResponse(self, channel, transactionId, response):
-		self.getLogger().warning("Unexpected asynchronous response received, discarding.")
+		self._pendingSendsCondition.acquire()
+		probeUri = self._pendingSends.pop(transactionId, None)
+		self._pendingSendsCondition.notifyAll()
+		self._pendingSendsCondition.release()
+
+		if probeUri is None:
+			self.getLogger().warning("Unexpected asynchronous response received, discarding.")
+		elif not response:
+			self._onSendError(probeUri, "Timeout while sending a message through %s. Please check that the probe (or the hosting agent) still works and the TACS is still online." % (probeUri))
+		elif response.getStatusCode() != 200:
+			self._onSendError(probeUri, "Error while sending a message through %s:\n%d %s\nDetailled error:\n%s" % (probeUri, response.getStatusCode(), response.getReasonPhrase(), response.getBody()))
+
+	def _onSendError(self, probeUri, description):
+		self.getLogger().error(description)
+		if self.sendErrorCallback:
+			self.sendErrorCallback(probeUri, description)
 		
 	def setLogNotificationCallback(self, cb):
 		self.logNotificationCallback = cb
@@ -119,9 +148,49 @@ class IaClient(Nodes.ConnectingNode):
 	def setReceivedNotificationCallback(self, cb):
 		self.receivedNotificationCallback = cb
 
+	def setReceivedBatchNotificationCallback(self, cb):
+		"""
+		cb(messages) is called with the list of (probeUri, message, sutAddress)
+		of a TRI-ENQUEUE-MSGS notification.
+		If not set, the received notification callback is called for each message.
+		"""
+		self.receivedBatchNotificationCallback = cb
+
 	def setProbeNotificationCallback(self, cb):
 		self.probeNotificationCallback = cb
 
+	def setSendErrorCallback(self, cb):
+		"""
+		cb(probeUri, description) is called when a pipelined TRI-SEND fails.
+		"""
+		self.sendErrorCallback = cb
+
+	def setPipelinedSend(self, window):
+		"""
+		Enables or disables the pipelined TRI-SEND mode.
+		
+		In this mode, triSend() does not wait for the TRI-SEND response
+		(unless window requests are already in flight), and errors are
+		reported asynchronously through the send error callback.
+		
+		@type  window: int
+		@param window: the max number of in-flight TRI-SEND requests. 0 to disable.
+		"""
+		self._pendingSendsCondition.acquire()
+		self._sendWindow = window
+		self._pendingSendsCondition.notifyAll()
+		self._pendingSendsCondition.release()
+
+	def waitForPendingSends(self, probeUri = None):
+		"""
+		Waits until all the in-flight pipelined TRI-SEND requests
+		(for probeUri, or for all probes if None) are acknowledged or timed out.
+		"""
+		self._pendingSendsCondition.acquire()
+		while (probeUri is None and self._pendingSends) or (probeUri in self._pendingSends.values()):
+			self._pendingSendsCondition.wait()
+		self._pendingSendsCondition.release()
+
 	# High level functions callable from an IaClient
 	# FIXME: temporarly set the default profile to PICKLE instead of CONTENT_TYPE_JSON 
 	# (binary payload encoding problems)
@@ -130,6 +199,20 @@ class IaClient(Nodes.ConnectingNode):
 		request = Messages.Request("TRI-SEND", probeUri, "Ia", "1.0")
 		request.setHeader("SUT-Address", sutAddress)
 		request.setApplicationBody(message, profile)
+
+		self._pendingSendsCondition.acquire()
+		if self._sendWindow:
+			# Pipelined mode: only wait for a free slot in the window
+			while self._sendWindow and len(self._pendingSends) >= self._sendWindow:
+				self._pendingSendsCondition.wait()
+			# The condition is held until the transaction is registered,
+			# so that its response cannot be handled before
+			transactionId = self.sendRequest(0, request, responseTimeout = 10.0)
+			self._pendingSends[transactionId] = probeUri
+			self._pendingSendsCondition.release()
+			return True
+		self._pendingSendsCondition.release()
+
 		response = self.executeRequest(0, request)
 		if response:
 			if response.getStatusCode() == 200:
@@ -140,6 +223,8 @@ class IaClient(Nodes.ConnectingNode):
 			raise TaccException("Timeout while sending a message through %s. Please check that the probe (or the hosting agent) still works and the TACS is still online." % (probeUri))
 	
 	def triSAReset(self, probeUri):
+		# Make sure the probe got all our messages before resetting it
+		self.waitForPendingSends(probeUri)
 		request = Messages.Request("TRI-SA-RESET", probeUri, "Ia", "1.0")
 		response = self.executeRequest(0, request)
 		if response and response.getStatusCode() == 200:
@@ -156,6 +241,7 @@ class IaClient(Nodes.ConnectingNode):
 			return False
 
 	def triUnmap(self, probeUri):
+		self.waitForPendingSends(probeUri)
 		request = Messages.Request("TRI-UNMAP", probeUri, "Ia", "1.0")
 		response = self.executeRequest(0, request)
 		if response and response.getStatusCode() == 200:
@@ -373,7 +459,10 @@ class DisabledIaClient:
 	"""
 	def setLogNotificationCallback(self, cb): pass
 	def setReceivedNotificationCallback(self, cb): pass
+	def setReceivedBatchNotificationCallback(self, cb): pass
 	def setProbeNotificationCallback(self, cb): pass
+	def setSendErrorCallback(self, cb): pass
+	def setPipelinedSend(self, window): pass
 	def stop(self): pass
 	def finalize(self): pass
 	def __getattr__(self, name):
@@ -106,6 +106,9 @@ class XaServer(Nodes.ListeningNode):
 	 N LOG
 	 N TRI-ENQUEUE-MSG
 	
+	Agent -> TACS, on behalf of its probes:
+	 N TRI-ENQUEUE-MSGS
+	
 	TACS -> Probe:
 	 R TRI-SEND
 	 R TRI-SA-RESET
@@ -117,6 +120,9 @@ class XaServer(Nodes.ListeningNode):
 	def __init__(self, controller, xaAddress):
 		Nodes.ListeningNode.__init__(self, "TACS/Xa", "XaServer/%s" % Versions.getAgentControllerVersion())
 		self._controller = controller
+		# Response callbacks for forwarded TRI-SEND, indexed by Xa transaction ID
+		self._pendingTriSends = {}
+		self._pendingTriSendsMutex = threading.RLock()
 		self.initialize(xaAddress)
 	
 	def getLogger(self):
@@ -185,23 +191,51 @@ class XaServer(Nodes.ListeningNode):
 			self._controller.onLog(channel, notification)
 		elif method == "TRI-ENQUEUE-MSG":
 			self._controller.onTriEnqueueMsg(channel, notification)
+		elif method == "TRI-ENQUEUE-MSGS":
+			self._controller.onTriEnqueueMsgs(channel, notification)
 		else:
 			self.getLogger().info("Received unsupported notification method: " + method)
 	
 	def onResponse(self, channel, transactionId, response):
-		self.getLogger().warning("Received an unexpected asynchronous response")
+		self._pendingTriSendsMutex.acquire()
+		pending = self._pendingTriSends.pop(transactionId, None)
+		self._pendingTriSendsMutex.release()
+		if not pending:
+			self.getLogger().warning("Received an unexpected asynchronous response")
+			return
+
+		(uri, callback) = pending
+		if not response:
+			e = XaException("Timeout while waiting for TRI-SEND response from probe %s" % uri)
+			response = Messages.Response(e.code, e.reason)
+			response.setBody(str(e))
+		elif response.getStatusCode() != 200:
+			e = XaException("TRI-SEND from probe %s returned:\n%d %s\n%s" % (uri, response.getStatusCode(), response.getReasonPhrase(), response.getBody()))
+			response = Messages.Response(e.code, e.reason)
+			response.setBody(str(e))
+		else:
+			response = Messages.Response(200, "OK")
+		callback(response)
 
 	# TACS -> Probes
 
-	def triSend(self, channel, request):
+	def triSend(self, channel, request, callback):
 		"""
+		Asynchronously forwards a TRI-SEND to a probe, so that several
+		TRI-SENDs can be in flight at the same time towards an agent.
+		
 		@type request: TestermanMessages.Request
+		@type callback: callable(TestermanMessages.Response)
+		@param callback: called with the response to forward on Ia
 		"""
-		resp = self.executeRequest(channel, request)
-		if not resp:
-			raise XaException("Timeout while waiting for TRI-SEND response from probe %s" % request.getUri())
-		if resp.getStatusCode() != 200:
-			raise XaException("TRI-SEND from probe %s returned:\n%d %s\n%s" % (request.getUri(), resp.getStatusCode(), resp.getReasonPhrase(), resp.getBody()))
+		# The mutex is held until the transaction is registered,
+		# so that its response cannot be handled before
+		self._pendingTriSendsMutex.acquire()
+		try:
+			transactionId = self.sendRequest(channel, request, responseTimeout = 10.0)
+			self._pendingTriSends[transactionId] = (request.getUri(), callback)
+		finally:
+			self._pendingTriSendsMutex.release()
 
 	def triExecuteTestCase(self, channel, request):
 		"""
@@ -333,12 +367,13 @@ class IaServer(Nodes.ListeningNode):
 	Probe -> TE/TS via TACS:
 	 N LOG
 	 N TRI-ENQUEUE-MSG
+	 N TRI-ENQUEUE-MSGS
 	 
 	"""
-	def __init__(self, controller, iaAddress):
+	def __init__(self, controller, iaAddress, maxSendQueueSize = 0, sendQueueOverflowPolicy = Nodes.SendQueue.BLOCK):
 		Nodes.ListeningNode.__init__(self, "TACS/Ia", "IaServer/%s" % Versions.getAgentControllerVersion())
 		self._controller = controller
-		self.initialize(iaAddress)
+		self.initialize(iaAddress, maxSendQueueSize = maxSendQueueSize, sendQueueOverflowPolicy = sendQueueOverflowPolicy)
 	
 	def getLogger(self):
 		return logging.getLogger('TACS.IaServer')
@@ -355,8 +390,9 @@ class IaServer(Nodes.ListeningNode):
 				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
 			elif method == "TRI-SEND":
 				# Probe send - we forward the body as is, with the original encoding and type.
-				self._controller.triSend(request.getUri(), request)
-				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
+				# The response is sent back once the probe acknowledged it, without blocking
+				# other requests from this TE (pipelined TRI-SENDs).
+				self._controller.triSend(request.getUri(), request, lambda response: self.sendResponse(channel, transactionId, response))
 			elif method == "TRI-SA-RESET":
 				self._controller.triSaReset(request.getUri())
 				self.sendResponse(channel, transactionId, Messages.Response(200, "OK"))
@@ -499,12 +535,14 @@ class Controller(object):
 	corresponding (probe) URIs.
 	[step 1]: notifications are forwarded to ALL Ia clients.
 	
+	Each Ia client has its own bounded send queue, so that a slow client
+	does not delay the others (see Nodes.SendQueue).
 	"""
 	
-	def __init__(self, xaAddress, iaAddress, documentRoot):
+	def __init__(self, xaAddress, iaAddress, documentRoot, maxSendQueueSize = 0, sendQueueOverflowPolicy = Nodes.SendQueue.BLOCK):
 		self._mutex = threading.RLock()
 		self._xaServer = XaServer(self, xaAddress)
-		self._iaServer = IaServer(self, iaAddress)
+		self._iaServer = IaServer(self, iaAddress, maxSendQueueSize, sendQueueOverflowPolicy)
 		self._agents = {}
 		self._probes = {}
 		self._documentRoot = documentRoot
@@ -713,18 +751,28 @@ class Controller(object):
 		uri = str(notification.getUri()) # make sure we deal with URI strings, not URI objects
 		self.getLogger().debug("Dispatching notification on Ia for %s..." % uri)
 		nbClients = 0
+		# Sending is done out of the lock, on a snapshot of the subscribers
 		self._lock()
-		if not self._subscriptions.has_key(uri):
-			self._unlock()
+		channels = self._subscriptions.get(uri)
+		if channels:
+			channels = channels[:]
+		self._unlock()
+		if not channels:
 			return
-		for channel in self._subscriptions[uri]:
+		for channel in channels:
 			try:
 				self._iaServer.sendNotification(channel, notification)
 				nbClients += 1
 			except:
 				self.getLogger().warning("Unable to send a notification to a client")
-		self._unlock()
 		self.getLogger().debug("Notification dispatched to %d Ia clients" % nbClients)
+
+	def getDroppedNotificationCount(self, channel):
+		"""
+		Returns the number of notifications discarded for an Ia client
+		because its send queue was full.
+		"""
+		return self._iaServer.getDroppedCount(channel)
 	
 	##
 	# TACS Northbound API (exposed through Ia)
@@ -852,9 +900,10 @@ class Controller(object):
 		self._unlock()
 		raise TacsException("", 404, "Probe Not Found")
 
-	def triSend(self, uri, request):
+	def triSend(self, uri, request, callback):
 		"""
-		Forwards a TRI-SEND operation, expect a response.
+		Forwards a TRI-SEND operation.
+		The probe response is asynchronously passed to callback(response).
 		"""
 		uri = str(uri)
 		probe = None
@@ -870,7 +919,7 @@ class Controller(object):
 			req.setContentType(request.getContentType())
 			req.setContentEncoding(request.getContentEncoding())
 			req.setBody(request.getBody())
-			self._xaServer.triSend(probe['channel'], req)
+			self._xaServer.triSend(probe['channel'], req, callback)
 		else:
 			raise TacsException("Probe %s not available on controller" % uri)
 
@@ -999,6 +1048,37 @@ class Controller(object):
 		"""
 		self._dispatchNotification(notification)
 	
+	def onTriEnqueueMsgs(self, channel, notification):
+		"""
+		Forward a batch of enqueued messages from Xa to Ia.
+		
+		The batch, whose body is a list of (probe uri, message, sut address),
+		is forwarded as is to the clients subscribing to all its probes
+		(the usual case), and only decoded and split for the others.
+		"""
+		probeUris = notification.getHeader('Probe-Uris').split(',')
+		# The batch probes each client subscribes to
+		subscribedUris = {}
+		self._lock()
+		for uri in probeUris:
+			for c in self._subscriptions.get(uri, []):
+				subscribedUris.setdefault(c, []).append(uri)
+		self._unlock()
+
+		batch = None
+		for c, uris in subscribedUris.items():
+			msg = notification
+			if len(uris) < len(probeUris):
+				if batch is None:
+					batch = notification.getApplicationBody()
+				msg = Messages.Notification("TRI-ENQUEUE-MSGS", notification.getUri(), "Ia", "1.0")
+				msg.setApplicationBody([ x for x in batch if x[0] in uris ], profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE)
+				msg.setHeader("Probe-Uris", ','.join(uris))
+			try:
+				self._iaServer.sendNotification(c, msg)
+			except:
+				self.getLogger().warning("Unable to send a notification to a client")
+	
 	def onLog(self, channel, notification):
 		"""
 		Forward to subscribers for the probe
@@ -1026,6 +1106,8 @@ def main():
 	expandPath = lambda x: x and os.path.abspath(os.path.expandvars(os.path.expanduser(x)))
 	cm.register("interface.ia.ip", "127.0.0.1")
 	cm.register("interface.ia.port", 8087)
+	cm.register("interface.ia.send_queue_size", 100000)
+	cm.register("interface.ia.send_queue_overflow_policy", "block")
 	cm.register("interface.xa.ip", "0.0.0.0")
 	cm.register("interface.xa.port", 40000)
 	cm.register("tacs.daemonize", False)
@@ -1130,7 +1212,7 @@ def main():
 	cm.set_transient("tacs.pid", os.getpid())
 	controller = None
 	try:
-		controller = Controller(xaAddress = (cm.get("interface.xa.ip"), cm.get("interface.xa.port")), iaAddress = (cm.get("interface.ia.ip"), cm.get("interface.ia.port")), documentRoot = cm.get("testerman.document_root"))
+		controller = Controller(xaAddress = (cm.get("interface.xa.ip"), cm.get("interface.xa.port")), iaAddress = (cm.get("interface.ia.ip"), cm.get("interface.ia.port")), documentRoot = cm.get("testerman.document_root"), maxSendQueueSize = cm.get("interface.ia.send_queue_size"), sendQueueOverflowPolicy = cm.get("interface.ia.send_queue_overflow_policy"))
 		controller.start()
 		controller.getLogger().info("Started.")
 		while 1:
@@ -14,19 +14,22 @@
 
 ##
 # -*- coding: utf-8 -*-
-# First implementation:
-# Using Threading.Timer.
-# Not scalable (max ~ 30 timers).
-#
 # Testerman TRI implementation - Platform Interface part.
 #
+# Timers are managed by a single dispatcher thread over a heap
+# of expiry deadlines (was: one threading.Timer per started timer,
+# which was not scalable - max ~ 30 timers).
+#
 ##
 
 
 import TestermanTCI
 import TestermanTTCN3 as Testerman
 
+import errno
+import heapq
 import threading
+import select
 import signal
 import os
 import re
@@ -44,7 +47,10 @@ def log(message):
 
 PaMutex = None
 
-CurrentTimers = {} # { 'timer': threading.Timer, 'start': timestamp } indexed by the TE timerId
+CurrentTimers = {} # { 'deadline': timestamp, 'start': timestamp, 'sequence': int } indexed by the TE timerId
+
+TimerDispatcher = None
+
 
 def _lock():
 	PaMutex.acquire()
@@ -53,14 +59,109 @@ def _unlock():
 	PaMutex.release()
 
 def _onTimeout(timerId):
-	_lock()
-	if not CurrentTimers.has_key(timerId):
-		_unlock()
-		log("Timeout received on unexisting timerId. Ignoring")
-		return
-	del CurrentTimers[timerId]
-	_unlock()
-	Testerman.triTimeout(timerId)
+	try:
+		Testerman.triTimeout(timerId)
+	except Exception, e:
+		log("Exception while notifying timeout for timerId %s: %s" % (str(timerId), str(e)))
+
+
+class TimerDispatcherThread(threading.Thread):
+	"""
+	The single timer engine thread.
+
+	Pending expiries are kept in a heap of (deadline, sequence, timerId).
+	Stopped or restarted timers are not removed from the heap: their
+	entries are discarded when they reach its top (lazy deletion), as
+	CurrentTimers only references the entry that is actually armed.
+
+	The thread sleeps in a select() on a private pipe, with a timeout
+	set to the next deadline; the pipe is only used to wake it up when
+	a new earliest deadline is scheduled, or when stopping.
+	"""
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.setName("PA timer dispatcher")
+		self.setDaemon(True)
+		self._heap = []
+		self._sequence = 0
+		self._stopEvent = threading.Event()
+		self._wakeupPipe = os.pipe()
+
+	def schedule(self, timerId, timer):
+		"""
+		Adds an expiry for timerId in the heap, and marks
+		the timer entry with the sequence number identifying it.
+		Must be called with the PA mutex held.
+		"""
+		self._sequence += 1
+		timer['sequence'] = self._sequence
+		heapq.heappush(self._heap, (timer['deadline'], self._sequence, timerId))
+		# Garbage collect lazily-deleted entries when they become the majority
+		if len(self._heap) > 1024 and len(self._heap) > 2 * len(CurrentTimers):
+			self._heap = [ entry for entry in self._heap if CurrentTimers.has_key(entry[2]) and CurrentTimers[entry[2]]['sequence'] == entry[1] ]
+			heapq.heapify(self._heap)
+		if self._heap[0][1] == self._sequence:
+			self.wakeup()
+
+	def wakeup(self):
+		try:
+			os.write(self._wakeupPipe[1], 'w')
+		except OSError:
+			pass
+
+	def stop(self):
+		self._stopEvent.set()
+		self.wakeup()
+		self.join()
+		os.close(self._wakeupPipe[0])
+		os.close(self._wakeupPipe[1])
+
+	def _popExpired(self, now):
+		"""
+		Pops all the timers whose deadline is reached.
+		Must be called with the PA mutex held.
+
+		@rtype: tuple (list of timerIds, float or None)
+		@returns: the expired timerIds, in deadline order, and the
+		delay until the next deadline, or None if no timers are pending.
+		"""
+		expired = []
+		while self._heap:
+			(deadline, sequence, timerId) = self._heap[0]
+			timer = CurrentTimers.get(timerId)
+			if timer is None or timer['sequence'] != sequence:
+				# Stopped or restarted timer
+				heapq.heappop(self._heap)
+			elif deadline <= now:
+				heapq.heappop(self._heap)
+				del CurrentTimers[timerId]
+				expired.append(timerId)
+			else:
+				return (expired, deadline - now)
+		return (expired, None)
+
+	def run(self):
+		while not self._stopEvent.isSet():
+			_lock()
+			(expired, delay) = self._popExpired(time.time())
+			_unlock()
+
+			# Timeout notifications are performed outside the PA mutex
+			for timerId in expired:
+				_onTimeout(timerId)
+			if expired:
+				continue
+
+			try:
+				if delay is None:
+					r, w, e = select.select([self._wakeupPipe[0]], [], [])
+				else:
+					r, w, e = select.select([self._wakeupPipe[0]], [], [], delay)
+				if r:
+					os.read(self._wakeupPipe[0], 1024)
+			except (select.error, OSError), e:
+				if e.args[0] != errno.EINTR:
+					raise
 
 ################################################################################
 # tri interface: PA-provided (TE -> PA)
@@ -78,13 +179,13 @@ def triStartTimer(timerId, duration):
 	"""
 	log("triStartTimer(%s, duration %f)" % (str(timerId), duration))
 	
-	# We should check that timerId is not already used
+	# If timerId is already used, the previous expiry is simply discarded
 	_lock()
-	
-	t = threading.Timer(duration, lambda: _onTimeout(timerId))
-	CurrentTimers[timerId] = { 'timer': t, 'start': time.time() }
+	now = time.time()
+	timer = { 'deadline': now + duration, 'start': now }
+	CurrentTimers[timerId] = timer
+	TimerDispatcher.schedule(timerId, timer)
 	_unlock()
-	t.start()
 	
 	return TRI_OK
 	
@@ -96,10 +197,7 @@ def triStopTimer(timerId):
 	if not CurrentTimers.has_key(timerId):
 		_unlock()
 		return TRI_Error
-	try:
-		CurrentTimers[timerId]['timer'].cancel()
-	except:
-		pass
+	# Its heap entry will be discarded by the dispatcher
 	del CurrentTimers[timerId]
 	_unlock()
 	return TRI_OK
@@ -210,16 +308,28 @@ def initialize():
 	Initialize the PA
 	"""
 	global PaMutex
+	global TimerDispatcher
 
 	log("Initializating PA...")
 	PaMutex = threading.RLock()	
+	TimerDispatcher = TimerDispatcherThread()
+	TimerDispatcher.start()
 	log("PA initialized")
 	
 def finalize():
 	"""
-	TODO
+	Stops the timer engine.
+	Pending timers are discarded without notification.
 	"""
+	global TimerDispatcher
+
 	log("finalizing timer engine...")
+	if TimerDispatcher:
+		TimerDispatcher.stop()
+		TimerDispatcher = None
+	_lock()
+	CurrentTimers.clear()
+	_unlock()
 	log("timer engine finalized.")
 	
 
@@ -60,11 +60,18 @@ def log(msg):
 	TestermanTCI.logInternal("SA: %s" % msg)
 
 class TliLogger:
-	def warning(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def error(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def debug(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def critical(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
-	def info(self, txt): TestermanTCI.logInternal("SA: %s" % txt)
+	def warning(self, txt): log(txt)
+	def error(self, txt): log(txt)
+	def debug(self, txt): log(txt)
+	def critical(self, txt): log(txt)
+	def info(self, txt): log(txt)
+	def isEnabledFor(self, level):
+		"""
+		logging.Logger-like interface, enabling probes to skip
+		formatting messages that won't be logged.
+		All levels are mapped to the 'internal' TE log level.
+		"""
+		return TestermanTCI.isLogLevelEnabled('internal')
 
 
 ################################################################################
@@ -265,7 +272,18 @@ def initialize(tacsAddress):
 	ProbeImplementationManager.setLogger(TliLogger())
 	TACC.initialize("TE", tacsAddress)
 	TACC.instance().setReceivedNotificationCallback(onTriEnqueueMsgNotification)
+	TACC.instance().setReceivedBatchNotificationCallback(onTriEnqueueMsgsNotification)
 	TACC.instance().setLogNotificationCallback(onLogNotification)
+	TACC.instance().setSendErrorCallback(onTriSendError)
+
+def setPipelinedSend(window):
+	"""
+	Enables (window > 0) or disables (window = 0) pipelined sending
+	through remote probes: triSend() returns as soon as the message
+	is sent to the TACS, with up to window messages not acknowledged yet.
+	Send errors are then logged asynchronously.
+	"""
+	TACC.instance().setPipelinedSend(window)
 
 def finalize():
 	log("finalizing...")
@@ -310,6 +328,12 @@ def onLogNotification(probeUri, logClass, logInfo):
 	except Exception, e:
 		log("Exception in onLogNotification: %s" % str(e))
 
+def onTriSendError(probeUri, description):
+	"""
+	Called when a pipelined TRI-SEND failed.
+	"""
+	TestermanTCI.logUser("WARNING: unable to send a message through %s (pipelined send): %s" % (probeUri, description))
+
 def onTriEnqueueMsgNotification(probeUri, message, sutAddress):
 	"""
 	Called when receiving a TRI-ENQUEUE-MSG event from a probe
@@ -323,6 +347,23 @@ def onTriEnqueueMsgNotification(probeUri, message, sutAddress):
 	except Exception, e:
 		log("Exception in onTriEnqueueMsgNotification: %s" % str(e))
 
+def onTriEnqueueMsgsNotification(messages):
+	"""
+	Called when receiving a TRI-ENQUEUE-MSGS event, i.e. a batch of
+	messages enqueued by one or several probes of an agent.
+	
+	@type  messages: list of (string, object, string)
+	@param messages: the (probe uri, message, sut address) of each message, in order
+	"""
+	for (probeUri, message, sutAddress) in messages:
+		try:
+			probeAdapter = WatchedProbes.get(probeUri)
+			if probeAdapter:
+				probeAdapter.triEnqueueMsg(message, sutAddress)
+
+		except Exception, e:
+			log("Exception in onTriEnqueueMsgsNotification: %s" % str(e))
+
 ################################################################################
 # Test Adapters configuration management (bindings)
 ################################################################################
@@ -20,6 +20,7 @@
 ##
 
 import ConfigManager
+import DependencyResolver
 import EventManager
 import FileSystemManager
 import JobManager
@@ -299,6 +300,8 @@ def main():
 	cm.register("interface.ws.port", 8080)
 	cm.register("interface.xc.ip", "0.0.0.0")
 	cm.register("interface.xc.port", 8081)
+	cm.register("interface.xc.send_queue_size", 10000)
+	cm.register("interface.xc.send_queue_overflow_policy", "drop")
 	cm.register("interface.il.ip", "0.0.0.0")
 	cm.register("interface.il.port", 8082)
 	cm.register("interface.ih.ip", "0.0.0.0")
@@ -313,6 +316,8 @@ def main():
 	cm.register("ts.pid_filename", "")
 	cm.register("ts.name", socket.gethostname(), dynamic = True)
 	cm.register("ts.jobscheduler.interval", 1000, dynamic = True)
+	cm.register("ts.jobqueue.compaction_threshold", 10000, dynamic = True)
+	cm.register("ts.te_build_cache.max_size", 100*1024*1024) # the maximum size of the cached TE builds (in testerman.var_root), in bytes. 0 disables the cache.
 	cm.register("testerman.document_root", "/tmp", xform = expandPath, dynamic = True)
 	cm.register("testerman.var_root", "", xform = expandPath)
 	cm.register("testerman.web.document_root", "%s/web" % testerman_home, xform = expandPath, dynamic = False)
@@ -493,6 +498,7 @@ def main():
 	try:
 		serverThread = XmlRpcServerThread() # Ws server
 		FileSystemManager.initialize()
+		DependencyResolver.initialize() # Import graph
 		EventManager.initialize() # Xc server, Ih server [TSE:CH], Il server [TSE:TL]
 		ProbeManager.initialize() # Ia client
 		JobManager.initialize() # Job scheduler
@@ -510,6 +516,7 @@ def main():
 	JobManager.finalize()
 	ProbeManager.finalize()
 	EventManager.finalize()
+	DependencyResolver.finalize()
 	FileSystemManager.finalize()
 	getLogger().info("Shut down.")
 	logging.shutdown()
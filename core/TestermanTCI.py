@@ -44,6 +44,7 @@ class LogLevelDocumentation:
 	|| `internal` || `internal` || Internal/debug logs ||
 	"""
 
+import LogSink
 import TestermanMessages as Messages
 import TestermanNodes as Nodes
 
@@ -120,6 +121,10 @@ class LocalIlClient:
 	def __init__(self, logFilename = None):
 		self.logFilename = logFilename
 		self.mutex = threading.RLock()
+		# Log events are buffered and written by batches;
+		# the log file is synced and closed on stop().
+		self.sink = LogSink.LogSink(maxOpenFiles = 1)
+		self.sink.start()
 	
 	def sendLogNotification(self, logClass, xml):
 		"""
@@ -128,17 +133,21 @@ class LocalIlClient:
 		if not self.logFilename:
 			return
 			
-		self.mutex.acquire()
 		if self.logFilename == '-':
+			self.mutex.acquire()
 			print xml
+			self.mutex.release()
 		else:
 			try:
-				f = open(self.logFilename, 'a')
-				f.write('%s\n' % xml.encode('utf-8'))
-				f.close()
+				self.sink.write(self.logFilename, '%s\n' % xml.encode('utf-8'))
 			except:
 				pass
-		self.mutex.release()
+
+	def stop(self):
+		self.sink.stop()
+	
+	def finalize(self):
+		pass
 
 def initialize(logFilename, ilServerAddress = None, jobId = None, maxPayloadSize = 65535):
 	"""
@@ -179,6 +188,20 @@ def setExcludedLogLevels(levels):
 def getExcludedLogLevels():
 	return ExcludedLogLevels
 
+def isLogLevelEnabled(level):
+	"""
+	Fast path for log call sites: enables to skip building a log event
+	(message formatting, template expansion, XML serialization)
+	when its level is excluded.
+	
+	@type  level: string
+	@param level: the log level to check
+	
+	@rtype: bool
+	@returns: True if the events of this level are logged.
+	"""
+	return not level in ExcludedLogLevels
+
 def enableDebugLogs():
 	setExcludedLogLevels([])
 
@@ -217,15 +240,21 @@ def logAtsStopped(id_, result, message = ''):
 	tliLog('core', toXml('ats-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'result': str(result) }, cgi.escape(message)))
 
 def logUser(message, tc = None):
+	if not isLogLevelEnabled('user'):
+		return
 	if tc is None:
 		tliLog('user', toXml('user', { 'class': 'user', 'timestamp': time.time() }, cgi.escape(message)))
 	else:
 		tliLog('user', toXml('user', { 'class': 'user', 'timestamp': time.time(), 'tc': tc }, cgi.escape(message)))
 
 def logInternal(message):
+	if not isLogLevelEnabled('internal'):
+		return
 	tliLog('internal', toXml('internal', { 'class': 'internal', 'timestamp': time.time() }, cgi.escape(message)))
 	
 def logMessageSent(fromTc, fromPort, toTc, toPort, message, address = None):
+	if not isLogLevelEnabled('event'):
+		return
 	if not address:
 		address = ''
 	try:
@@ -244,30 +273,48 @@ def logTestcaseStopped(id_, verdict, description):
 	tliLog('core', toXml('testcase-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'verdict': verdict }, u"<![CDATA[%s]]>" % description))
 
 def logTimerStarted(id_, tc, duration):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('timer-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'duration': str(duration), 'tc': tc }))
 
 def logTimerStopped(id_, tc, runningTime):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('timer-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'running-time': str(runningTime), 'tc': tc }))
 
 def logTimerExpiry(id_, tc):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('timer-expiry', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'tc': tc }))
 
 def logTestComponentCreated(id_):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('tc-created', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
 
 def logTestComponentStarted(id_, behaviour):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('tc-started', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'behaviour': behaviour }))
 
 def logTestComponentStopped(id_, verdict, message = ''):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('tc-stopped', { 'class': 'event', 'timestamp': time.time(), 'id': id_, 'verdict': verdict }, cgi.escape(message)))
 
 def logTestComponentKilled(id_, message = ''):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('tc-killed', { 'class': 'event', 'timestamp': time.time(), 'id': id_, }, cgi.escape(message)))
 
 def logVerdictUpdated(tc, verdict):
+	if not isLogLevelEnabled('event'):
+		return
 	tliLog('event', toXml('verdict-updated', { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'verdict': verdict }))
 
 def logTemplateMatch(tc, port, message, template, encodedMessage = None):
+	if not isLogLevelEnabled('match'):
+		return
 	try:
 		# Should we call a tliMatch/tliMisMatch ?
 		if encodedMessage:
@@ -279,6 +326,8 @@ def logTemplateMatch(tc, port, message, template, encodedMessage = None):
 		logUser(unicode(e) + u'\n' + unicode(ret))
 
 def logTemplateMismatch(tc, port, message, template, encodedMessage = None, mismatchedPath = None):
+	if not isLogLevelEnabled('mismatch'):
+		return
 	attributes = { 'class': 'event', 'timestamp': time.time(), 'tc': tc, 'port': port }
 	if mismatchedPath:
 		attributes['path'] = mismatchedPath 
@@ -293,22 +342,32 @@ def logTemplateMismatch(tc, port, message, template, encodedMessage = None, mism
 		logUser(unicode(e) + u'\n' + unicode(ret))
 
 def logTimeoutBranchSelected(id_):
+	if not isLogLevelEnabled('match'):
+		return
 	# in a alt, we selected a timer.TIMEOUT where the timer's id is id_
 	tliLog('match', toXml('timeout-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
 
 def logDoneBranchSelected(id_):
+	if not isLogLevelEnabled('match'):
+		return
 	# in a alt, we selected a tc.DONE where the tc's id is id_
 	tliLog('match', toXml('done-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
 
 def logKilledBranchSelected(id_):
+	if not isLogLevelEnabled('match'):
+		return
 	# in a alt, we selected a tc.KILLED where the tc's id is id_
 	tliLog('match', toXml('killed-branch', { 'class': 'event', 'timestamp': time.time(), 'id': id_ }))
 
 def logSystemSent(tsiPort, label, payload, sutAddress = None):
+	if not isLogLevelEnabled('system'):
+		return
 	if sutAddress is None: sutAddress = ''
 	tliLog('system', toXml('system-sent', { 'class': 'system', 'timestamp': time.time(), 'tsi-port': tsiPort }, '%s%s%s' % (testermanToXml(label, 'label'), testermanToXml(payload, 'payload'), testermanToXml(sutAddress, 'sut-address'))))
 
 def logSystemReceived(tsiPort, label, payload, sutAddress = None):
+	if not isLogLevelEnabled('system'):
+		return
 	if sutAddress is None: sutAddress = ''
 	tliLog('system', toXml('system-received', { 'class': 'system', 'timestamp': time.time(), 'tsi-port': tsiPort }, '%s%s%s' % (testermanToXml(label, 'label'), testermanToXml(payload, 'payload'), testermanToXml(sutAddress, 'sut-address'))))
 
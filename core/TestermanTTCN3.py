@@ -30,13 +30,14 @@ import TestermanCD
 from TestermanTCI import *
 import TestermanTCI
 
+from collections import deque
 import binascii
 import random
 import re
+import thread
 import threading
 import time
 import os
-import select
 
 # 1.1:
 # - added control:bind()
@@ -45,7 +46,9 @@ import select
 # - added control:stop_testcase_on_failure(stop = True)
 # 1.3: 
 # - added set_(*args)
-API_VERSION = "1.3"
+# 1.4:
+# - added enable_pipelined_send(window = 32), disable_pipelined_send()
+API_VERSION = "1.4"
 
 ################################################################################
 # Some general functions
@@ -145,9 +148,9 @@ class TestermanContext:
 		# Current activated default alternatives
 		self._defaultAlternatives = []
 		self._defaultAltsteps = {}
-		# The pipe used for system queue notifications in alt()
-		self._systemQueueNotifier = None
-		self._systemQueueNotifierUserCount = 0 # smart counter, multiple nested alt() can use the same notifier
+		# The notifier used to wake up alt() when a watched port (including the system queue)
+		# has something new in it
+		self._notifier = _ComponentNotifier()
 	
 	def getValues(self):
 		return self._values
@@ -211,24 +214,8 @@ class TestermanContext:
 		if timer in self._timers:
 			self._timers.remove(timer)
 	
-	def getSystemQueueNotifier(self):
-		if not self._systemQueueNotifier:
-			self._systemQueueNotifier = os.pipe()
-			self._systemQueueNotifierUserCount = 0
-		self._systemQueueNotifierUserCount += 1
-		return self._systemQueueNotifier
-	
-	def cleanSystemQueueNotifier(self, force = False):
-		self._systemQueueNotifierUserCount -= 1
-		if (force or self._systemQueueNotifierUserCount <= 0) and self._systemQueueNotifier:
-			try:
-				os.close(self._systemQueueNotifier[0])
-				os.close(self._systemQueueNotifier[1])
-			except:
-				pass
-			self._systemQueueNotifierUserCount = 0
-			self._systemQueueNotifier = None
-			logInternal("tc %s does not use the system queue notifier any more - cleaned up" % self._tc)
+	def getNotifier(self):
+		return self._notifier
 	
 def getLocalContext():
 	"""
@@ -270,12 +257,107 @@ def _clearLocalContexts():
 	Clears the existing local contexts.
 	"""
 	_ContextMapMutex.acquire()
-	for context in _ContextMap.values():
-		context.cleanSystemQueueNotifier(force = True)
 	_ContextMap.clear()
 	_ContextMapMutex.release()
 
 
+class _ComponentNotifier:
+	"""
+	The wakeup primitive used by a test component to wait in alt()
+	until one of its watched ports has something new in it.
+
+	This is an auto-reset event: notify() wakes up the waiter,
+	or the next call to wait() if nobody is waiting yet; multiple
+	notifications before a wait() are coalesced.
+	
+	Based on a raw lock, so that waiting does not poll (as threading
+	timed waits do) and does not consume any file descriptor (as the
+	previous per-port pipes did).
+	"""
+	def __init__(self):
+		self._event = thread.allocate_lock()
+		self._event.acquire()
+		self._mutex = thread.allocate_lock()
+		self._signaled = False
+		# The ports this notifier is registered to, as a listener
+		self._ports = {}
+	
+	def _addPort(self, port):
+		self._mutex.acquire()
+		self._ports[port] = None
+		self._mutex.release()
+	
+	def close(self):
+		"""
+		Unregisters from all the ports the component watched.
+		To call when the component behaviour ends.
+		"""
+		self._mutex.acquire()
+		ports = self._ports.keys()
+		self._ports = {}
+		self._mutex.release()
+		for port in ports:
+			port._unregisterListener(self)
+	
+	def notify(self):
+		self._mutex.acquire()
+		if not self._signaled:
+			self._signaled = True
+			self._event.release()
+		self._mutex.release()
+	
+	def wait(self):
+		"""
+		Blocks until notified.
+		Alt waiters are also notified every second by the _AltTicker.
+		"""
+		_AltTicker.register(self)
+		self._event.acquire()
+		_AltTicker.unregister(self)
+		self._mutex.acquire()
+		self._signaled = False
+		self._mutex.release()
+
+
+class _AltTickerThread(threading.Thread):
+	"""
+	Notifies all the components currently waiting in alt() every second,
+	so that alt() is periodically re-evaluated, and signals (delivered to
+	the main thread only) are handled even if it waits for a long time.
+	"""
+	def __init__(self):
+		threading.Thread.__init__(self)
+		self.setName("alt ticker")
+		self.setDaemon(True)
+		self._mutex = threading.RLock()
+		self._waiters = {}
+		self._started = False
+	
+	def register(self, notifier):
+		self._mutex.acquire()
+		if not self._started:
+			self._started = True
+			self.start()
+		self._waiters[notifier] = None
+		self._mutex.release()
+	
+	def unregister(self, notifier):
+		self._mutex.acquire()
+		self._waiters.pop(notifier, None)
+		self._mutex.release()
+	
+	def run(self):
+		while True:
+			time.sleep(1.0)
+			self._mutex.acquire()
+			waiters = self._waiters.keys()
+			self._mutex.release()
+			for notifier in waiters:
+				notifier.notify()
+
+_AltTicker = _AltTickerThread()
+
+
 class _BranchCondition:
 	"""
 	This class represents a branch condition in an alternative.
@@ -637,6 +719,10 @@ class TestComponent:
 			# Kill it
 			self._doKill()
 
+		# The ports that are not stopped with the PTC (the system queue,
+		# other components' ports) must not notify it any more
+		getLocalContext().getNotifier().close()
+
 	def _setverdict(self, verdict):
 		"""
 		Updates the local verdict (may be the testcase verdict if the tc is the mtc)
@@ -929,7 +1015,7 @@ class Port:
 		self._mutex = threading.RLock()
 
 		# The internal port's message queue
-		self._messageQueue = []
+		self._messageQueue = deque()
 
 		# The port state. Automatically started() when accessed for the first type ( via tc[port])
 		self._started = False
@@ -944,17 +1030,55 @@ class Port:
 		# In this case, _connectedPorts shall be empty.
 		self._mappedTsiPort = None
 		
-		# a pipe ((r, w) fds) to notify that the port has something new in it.
-		# Enables to implement a poll/select on multiple ports in alt()
-		self._notifier = None
+		# The notifiers of the test components that watched this port in an alt().
+		# They remain registered until the port is stopped or the component
+		# behaviour ends, so that alt() does not have to (un)register to all its
+		# ports at each call.
+		self._listeners = {}
+		self._listenersMutex = thread.allocate_lock()
 	
-	def getNotifierFd(self):
+	def _registerListener(self, notifier):
 		"""
-		Returns the (pipe) fd to watch to be notified
-		of a new message on this port.
+		Registers a test component notifier as a listener, so that
+		it is notified whenever the port has something new in it.
+		
+		@type  notifier: _ComponentNotifier
+		@param notifier: the notifier of the component watching the port
 		"""
-		return self._notifier[0]
+		self._listenersMutex.acquire()
+		self._listeners[notifier] = None
+		self._listenersMutex.release()
+		notifier._addPort(self)
+	
+	def _unregisterListener(self, notifier):
+		self._listenersMutex.acquire()
+		self._listeners.pop(notifier, None)
+		self._listenersMutex.release()
 	
+	def _clearListeners(self):
+		self._listenersMutex.acquire()
+		self._listeners = {}
+		self._listenersMutex.release()
+	
+	def _notifyListeners(self):
+		self._listenersMutex.acquire()
+		for notifier in self._listeners:
+			notifier.notify()
+		self._listenersMutex.release()
+	
+	def _consume(self, entry):
+		"""
+		Consumes the first message of the queue, as seen in an alt() snapshot,
+		if it is still there (the port may have been cleared meanwhile).
+		
+		@type  entry: tuple (message, from_)
+		@param entry: the first queue entry, as seen in the snapshot
+		"""
+		self._lock()
+		if self._messageQueue and self._messageQueue[0] is entry:
+			self._messageQueue.popleft()
+		self._unlock()
+
 	def _lock(self):
 		self._mutex.acquire()
 	
@@ -982,12 +1106,7 @@ class Port:
 		self._lock()
 		if self._started:
 			self._messageQueue.append((message, from_))
-			try:
-				os.write(self._notifier[1], 'r')
-				logInternal("port %s: notifying a new message for reader on %s" % (self, self._notifier[0]))
-			except Exception, e:
-				logInternal("port %s: async notifier error %s" % (self, e))
-				pass
+			self._notifyListeners()
 		# else not started: not enqueueing anything.
 		self._unlock()
 
@@ -1009,17 +1128,21 @@ class Port:
 		"""
 		logInternal("sending a message through %s" % str(self))
 		if self._started:
-			messageToLog = _expandTemplate(message)
+			logEvents = isLogLevelEnabled('event')
+			if logEvents:
+				messageToLog = _expandTemplate(message)
 			messageToSend = _encodeTemplate(message)
 
 			# Mapped port first.
 			if self._mappedTsiPort:
-				logMessageSent(fromTc = str(self._tc), fromPort = self._name, toTc = "system", toPort = self._mappedTsiPort._name, message = messageToLog, address = to)
+				if logEvents:
+					logMessageSent(fromTc = str(self._tc), fromPort = self._name, toTc = "system", toPort = self._mappedTsiPort._name, message = messageToLog, address = to)
 				self._mappedTsiPort.send(messageToSend, to)
 			else:
 				for port in self._connectedPorts:
 					if not to or port._tc == to or (isinstance(to, list) and port._tc in to):
-						logMessageSent(fromTc = str(self._tc), fromPort = self._name, toTc = str(port._tc), toPort = port._name, message = messageToLog, address = to)
+						if logEvents:
+							logMessageSent(fromTc = str(self._tc), fromPort = self._name, toTc = str(port._tc), toPort = port._name, message = messageToLog, address = to)
 						port._enqueue(messageToSend, self._tc)
 			return True
 		else:
@@ -1063,13 +1186,8 @@ class Port:
 		"""
 		self._lock()
 		if not self._started:
-			self._messageQueue = []
+			self._messageQueue = deque()
 			self._started = True
-			try:
-				self._notifier = os.pipe()
-			except Exception, e:
-				self._unlock()
-				raise Exception("Unable to start port %s: %s" % (str(self), e))
 		self._unlock()
 		logInternal("%s started" % str(self))
 
@@ -1079,15 +1197,9 @@ class Port:
 		Current enqueue messages are kept.
 		"""
 		self._lock()
-		if self._started:
-			self._started = False
-			try:
-				os.close(self._notifier[0])
-				os.close(self._notifier[1])
-			except:
-				pass
-			self._notifier = None
+		self._started = False
 		self._unlock()			
+		self._clearListeners()
 		logInternal("%s stopped" % str(self))
 
 	def clear(self):
@@ -1095,7 +1207,7 @@ class Port:
 		Purges the internal queue, without stopping the port.
 		"""
 		self._lock()
-		self._messageQueue = []
+		self._messageQueue = deque()
 		self._unlock()
 		logInternal("%s cleared" % str(self))
 
@@ -1810,9 +1922,7 @@ def alt(alternatives):
 	  They must be lambda or callable() to be executed only if the branch is selected.
 	
 	This implementation is not TTCN-3 compliant because:
-	- it does not take a snapshot at each iteration, meaning that messages may arrive on port2 just
-	  before analyzing it, while something arrives on port1 just after, leading to incorrect alt branching
-	  in the case of port1.RECEIVE() is before port2.RECEIVE() (in "order of appearance")
+	- messages that do not match any alternative are consumed (discarded) instead of blocking the port.
 	- altstep-branches are not implemented. Only timeout-, receiving-, killed-, done- branches are.
 	- there is no mechanism to trigger an exception if the alt is completely blocked.
 	  As a consequence, the user must carefully design his/her alt() (especially with watchdog timers)
@@ -1835,20 +1945,23 @@ def alt(alternatives):
 	The guard is detected if the first object in the list is callable. If it is, this is a guard. If not, no guard available.
 	"""
 	# Algorithm:
-	# 1. First, we group alternatives per port (ordered).
-	# 2. Then, we look messages port by port:
-	#  2.1 Pop the first message in its queue (if any)
-	#  2.2 Compare it to the templates contained in its associated alternative's conditions, once we checked that the guard was satisfied
-	#  2.3 If we have a template match (the first one for the list of alternatives)
-	#      - select the branch: execute the associated actions. If an action evaluates to RETURN, stop executing further actions,
-	#        and leave the alt. If one evaluates to REPEAT, stop executing further actions, and repeat the alt() from start.
-	#        If we have no other actions to execute, leave the alt.
-	#      If this is a mismatch, do nothing, just compare to the next alternative's conditions.
-	#  2.4 in any case (even if we leave or repeat the alt, match or mismatch), the current popped message is consumed.
-	# 3. Once we looped once without a match, repeat from 2 until we have a match.
+	# 1. First, we list the alternatives (in order of appearance) and the ports they watch.
+	# 2. Then, we evaluate them against a snapshot of these ports:
+	#  2.1 Take the snapshot: the first message in the queue of each port (if any),
+	#      and the whole system queue.
+	#  2.2 Evaluate the alternatives in order: once we checked that the guard was satisfied,
+	#      compare the snapshot message of its port to its template. The first match selects the branch:
+	#      the matched message is consumed, and the associated actions are executed. If an action evaluates
+	#      to RETURN, stop executing further actions, and leave the alt. If one evaluates to REPEAT, stop
+	#      executing further actions, and repeat the alt() from 2.1.
+	#      If we have no other actions to execute, leave the alt.
+	#  2.3 If nothing matched, the snapshot messages are consumed (mismatches).
+	# 3. Take a new snapshot as long as messages were consumed; once the snapshot is exhausted,
+	#    wait until something new arrives on a watched port, and repeat from 2.
 	# 
 	# The system queue is handled differently:
 	# - unmatched messages are not consumed, but kept in the queue. This is not the case for "userland ports".
+	# - all its messages are considered, not only the first one.
 
 	# Gets some basic things to intercept whenever we enter an alt, such as STOP_COMMAND and KILL_COMMAND
 	# through the system queue.	
@@ -1865,13 +1978,15 @@ def alt(alternatives):
 #	logInternal("Entering alt():\n%s" % alternatives)
 	
 	# Step 1. Preparation.
-	# Alternatives per port
-	portAlternatives = {}
-	# And prepare a list of watched fds (pipes) to be notified as soon as a
-	# port has something new in it.
-	watchedPortsFds = []
-	
-	systemQueueWatched = False
+	# Alternatives on started ports, in order of appearance
+	branches = []
+	# Watched ports
+	watchedPorts = {}
+	# We register our notifier on each watched port to be notified as soon as a
+	# port has something new in it (a notification for a port we are not watching
+	# any more only leads to an additional evaluation pass).
+	notifier = getLocalContext().getNotifier()
+	systemQueue = _getSystemQueue()
 		
 	for alternative in alternatives:
 		# Optional guard. Its presence is detected if the first element of the clause is callable.
@@ -1885,218 +2000,171 @@ def alt(alternatives):
 			condition = alternative[0]
 			actions = alternative[1:]
 		
- 		if not portAlternatives.has_key(condition.port) and condition.port._started:
-			portAlternatives[condition.port] = []
-			if condition.port is _getSystemQueue():
-				# Register ourselves as a listener on the system port
-				condition.port._registerListener()
-				systemQueueWatched = True
-			watchedPortsFds.append(condition.port.getNotifierFd())
-		portAlternatives[condition.port].append((guard, condition, actions))
+		if condition.port._started:
+			if not watchedPorts.has_key(condition.port):
+				watchedPorts[condition.port] = None
+				if not condition.port._listeners.has_key(notifier):
+					condition.port._registerListener(notifier)
+			branches.append((guard, condition, actions))
 	
-	logInternal("alt: tc %s is watching the following fds: %s - watching the system queue: %s" % (getLocalContext().getTc(), watchedPortsFds, systemQueueWatched))
+	logInternal("alt: tc %s is watching %d ports" % (getLocalContext().getTc(), len(watchedPorts)))
 
 	# Step 2.
-	matchedInfo = None # tuple (guard, template, asValue, actions, message, decodedMessage)
-	repeat = False
 	try:
-		while (not matchedInfo) or repeat:
-			# Reset info in case of a repeat
-			matchedInfo = None
-			repeat = False
-
-			for (port, alternatives) in portAlternatives.items():
+		while True:
+			# 2.1 Snapshot: freeze the watched ports
+			snapshot = {} # (message, from_) for normal ports, list of (message, from_) for the system queue, indexed by port
+			for port in watchedPorts:
+				port._lock()
+				if port is systemQueue:
+					if port._messageQueue:
+						snapshot[port] = list(port._messageQueue)
+				elif port._messageQueue:
+					snapshot[port] = port._messageQueue[0]
+				port._unlock()
+			
+			# 2.2 Evaluate the alternatives in order
+			matchedInfo = None # tuple (guard, condition, actions, message, decodedMessage, from_)
+			for (guard, condition, actions) in branches:
+				port = condition.port
+				if not snapshot.has_key(port):
+					continue
 
 				# Special handling for system queue: messages are NOT popped if not matching anything.
 				# Instead, they are kept in the queue for other consumers (other TCs, or in a next alt()
 				# in the current TC).
-				if port is _getSystemQueue():
-					port._lock()
-					try:
-						# Make sure that we don't loop forever here because we did not remove our notification
-						# from the notification pipe.
-						port._acknowledgeNotification()
-						for (message, from_) in port._messageQueue:
-							# We ignore the 'from' in systemQueue
-							for (guard, condition, actions) in alternatives:
-								# Guard is ignored for internal messages (we shouldn't have one, anyway)
-	
-								# Special message matches (NB: we're suppose to have only dict messages in the system queue)
-								if isinstance(message, dict) and condition.template['event'].startswith('any.'):
-									# "Wildcard"-based match: we do not expect this exact event in the queue.
-									# Instead, we match any 'ressembling' event.
-									if condition.template['event'] == 'any.c.done':
-										# We match is we have any 'done' in our queue
-										if message.get('event') == 'done':
-											match = True
-									elif condition.template['event'] == 'any.c.killed':
-										# We match is we have any 'killed' in our queue
-										if message.get('event') == 'killed':
-											match = True
-	
-									if match:
-										matchedInfo = (guard, condition, actions, message, None) # None: decodedMessage
-										# In this case, we do NOT consume the message: left for
-										# other ptc.KILLED, or other any component killed, ...
-										break
-
-								# Standard system message matches - consumed if matched
-								else:
-									# Ignore the decoded message: must be the same as encoded for internal events.
-									(match, _, _) = templateMatch(message, condition.template)
-									if match:
-										matchedInfo = (guard, condition, actions, message, None) # None: decodedMessage
-										# Consume the message
-										port._remove(message, from_)
-										# Exit the port alternative loop, with matchedInfo
-										break
-	
-							if matchedInfo:
-								# Exit the loop on messages directly.
-								break
-					except Exception, e:
-						port._unlock()
-						logInternal("Exception while analyzing system events: %s" % str(e))
-						raise
-					port._unlock()
-					if matchedInfo:
-						(guard, condition, actions, message, _) = matchedInfo
-						# OK, we have some actions to trigger (outside the critical section)
-						# According to the event type we matched, log it (or not)
-						# system queue events are always formatted as a dict { 'event': string } and 'ptc' or 'timer' dependending on the event.
-						branch = condition.template['event']
-						if branch == 'timeout':
-							# timeout-branch selected
-							logTimeoutBranchSelected(id_ = str(condition.template['timer']))
-						elif branch == 'done':
-							# done-branch selected
-							logDoneBranchSelected(id_ = str(condition.template['ptc']))
-						elif branch == 'killed':
-							# killed-branch selected
-							logKilledBranchSelected(id_ = str(condition.template['ptc']))
-						elif branch == 'all.c.done':
-							# all component-done branch selected
-							logDoneBranchSelected(id_ = 'all')
-						elif branch == 'all.c.killed':
-							# all component-killed branch selected
-							logKilledBranchSelected(id_ = 'all')
-						elif branch == 'any.c.done':
-							# any component-done branch selected
-							logDoneBranchSelected(id_ = 'any')
-						elif branch == 'any.c.killed':
-							# all component-killed branch selected
-							logKilledBranchSelected(id_ = 'any')
+				if port is systemQueue:
+					# Guard is ignored for internal messages (we shouldn't have one, anyway)
+					# We ignore the 'from' in systemQueue
+					for (message, from_) in snapshot[port]:
+						match = False
+						# Special message matches (NB: we're suppose to have only dict messages in the system queue)
+						if isinstance(message, dict) and condition.template['event'].startswith('any.'):
+							# "Wildcard"-based match: we do not expect this exact event in the queue.
+							# Instead, we match any 'ressembling' event.
+							if condition.template['event'] == 'any.c.done':
+								# We match is we have any 'done' in our queue
+								if message.get('event') == 'done':
+									match = True
+							elif condition.template['event'] == 'any.c.killed':
+								# We match is we have any 'killed' in our queue
+								if message.get('event') == 'killed':
+									match = True
+							# In this case, we do NOT consume the message: left for
+							# other ptc.KILLED, or other any component killed, ...
+
+						# Standard system message matches - consumed if matched
 						else:
-							# Other system messages are for internal purpose only and does not have TTCN-3 branch equivalent
-							logInternal('system event received in system queue: %s' % repr(condition.template))
+							# Ignore the decoded message: must be the same as encoded for internal events.
+							(match, _, _) = templateMatch(message, condition.template)
+							if match:
+								port._remove(message, from_)
 
-						for action in actions:
-							# Minimal command management for internal messages
-							if callable(action):
-								action = action()
-							if action == REPEAT:
-								repeat = True
-								break
-							elif action == RETURN:
-								return
-						if repeat:
-							# Break the loop on system messages
+						if match:
+							matchedInfo = (guard, condition, actions, message, None, from_) # None: decodedMessage
 							break
 
-					else:
-						# no match, nothing to do.
-						pass
-
+				# This is a normal port: only its first message is considered.
 				else:
-					# This is a normal port. We always consume the popped message, 
-					# support for RETURN and REPEAT "keywords" in actions, etc.
-					message = None
-					port._lock()
-					try:
-						if port._messageQueue:
-							# 2.1 Let's pop the first message in the queue (will be consumed whatever happens since not kept in queue)
-							# FIXME: flawn implementation: we shoud not consume only one message per port per pass.
-							# We should really take a "snapshot" (ie freezing ports) and considering timestamped messages...
-							(message, from_) = port._messageQueue[0]
-							port._messageQueue = port._messageQueue[1:]
-							# FIXME - must be hidden in the port class
-							try:
-								os.read(port._notifier[0], 1)
-							except:
-								pass
-					except Exception, e:
-						port._unlock()
-						logInternal("Exception while consuming standard port message: %s" % str(e))
-						raise e
-					port._unlock()
-					if message is not None: # And what is we want to send "None" ? should be considered as a non-message, ie a non-send ?
-						# 2.2: For each existing satisfied conditions for this port (x[0] is the guard)
-						for (guard, condition, actions) in filter(lambda x: (x[0] and x[0]()) or (x[0] is None), alternatives):
-							# Only try to match messages from the expected sender
-							if condition.from_ and condition.from_ != from_:
-								logInternal("not matching condition: not received from the expected address (expected: %s, got: %s)" % (condition.from_, from_))
-								match = False
-								# In this case, we don't even attempt to decode the message. So we assign a default decoded one for logging purpose
-								decodedMessage = message
-							else:
-								(match, decodedMessage, mismatchedPath) = templateMatch(message, condition.template)
-							# Now handle the matching result
-							if not match:
-								# 2.3 - Mismatch, we should log it.
-								logTemplateMismatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message, mismatchedPath = mismatchedPath)
-							else:
-								# 2.3 - Match
-								matchedInfo = (guard, condition, actions, message, decodedMessage)
-								logTemplateMatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message)
-								# Store the message as value, if needed
-								if condition.value:
-									_setValue(condition.value, decodedMessage)
-								if condition.sender:
-									_setSender(condition.sender, from_)
-								# Then execute actions
-								for action in actions:
-									if callable(action):
-										action = action()
-									if action == REPEAT:
-										repeat = True
-										break
-									elif action == RETURN:
-										return
-								# Break the loop on guard-validated alternatives for this port
-								break
-						if matchedInfo:
-							# We left the loop on guard-validated alternatives for this port because of a match,
-							# Let's break the main loop on ports
-							break
-						else:
-							# No match for this port: nothing to do
-							pass
+					if guard and not guard():
+						continue
+					(message, from_) = snapshot[port]
+					# Only try to match messages from the expected sender
+					if condition.from_ and condition.from_ != from_:
+						logInternal("not matching condition: not received from the expected address (expected: %s, got: %s)" % (condition.from_, from_))
+						match = False
+						# In this case, we don't even attempt to decode the message. So we assign a default decoded one for logging purpose
+						decodedMessage = message
+						mismatchedPath = None
+					else:
+						(match, decodedMessage, mismatchedPath) = templateMatch(message, condition.template)
+					# Now handle the matching result
+					if not match:
+						# Mismatch, we should log it.
+						if isLogLevelEnabled('mismatch'):
+							logTemplateMismatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message, mismatchedPath = mismatchedPath)
 					else:
-						# no message for this port: nothing to do
-						pass
-
-			# Now wait until another message arrives on one of our watched ports (if we have to wait)
-			if (not matchedInfo) or repeat:
-				try:
-					logInternal("alt: tc %s is renewing its subscription on the following fds: %s" % (getLocalContext().getTc(), watchedPortsFds))
-					r, w, e = select.select(watchedPortsFds, [], [], 1)
-				except select.error, e:
-					if e.args[0] == 4:
-						# Interrupted system call -> SIGINT, stop() the TC
-						stop()
+						# Match: the message is consumed
+						port._consume(snapshot[port])
+						matchedInfo = (guard, condition, actions, message, decodedMessage, from_)
+						if isLogLevelEnabled('match'):
+							logTemplateMatch(tc = port._tc, port = port._name, message = decodedMessage, template = _expandTemplate(condition.template), encodedMessage = message)
+
+				if matchedInfo:
+					break
+
+			if matchedInfo:
+				(guard, condition, actions, message, decodedMessage, from_) = matchedInfo
+				if condition.port is systemQueue:
+					# According to the event type we matched, log it (or not)
+					# system queue events are always formatted as a dict { 'event': string } and 'ptc' or 'timer' dependending on the event.
+					branch = condition.template['event']
+					if branch == 'timeout':
+						# timeout-branch selected
+						logTimeoutBranchSelected(id_ = str(condition.template['timer']))
+					elif branch == 'done':
+						# done-branch selected
+						logDoneBranchSelected(id_ = str(condition.template['ptc']))
+					elif branch == 'killed':
+						# killed-branch selected
+						logKilledBranchSelected(id_ = str(condition.template['ptc']))
+					elif branch == 'all.c.done':
+						# all component-done branch selected
+						logDoneBranchSelected(id_ = 'all')
+					elif branch == 'all.c.killed':
+						# all component-killed branch selected
+						logKilledBranchSelected(id_ = 'all')
+					elif branch == 'any.c.done':
+						# any component-done branch selected
+						logDoneBranchSelected(id_ = 'any')
+					elif branch == 'any.c.killed':
+						# all component-killed branch selected
+						logKilledBranchSelected(id_ = 'any')
 					else:
-						raise
+						# Other system messages are for internal purpose only and does not have TTCN-3 branch equivalent
+						if isLogLevelEnabled('internal'):
+							logInternal('system event received in system queue: %s' % repr(condition.template))
+				else:
+					# Store the message as value, if needed
+					if condition.value:
+						_setValue(condition.value, decodedMessage)
+					if condition.sender:
+						_setSender(condition.sender, from_)
+
+				# Then execute actions (outside any critical section)
+				repeat = False
+				for action in actions:
+					if callable(action):
+						action = action()
+					if action == REPEAT:
+						repeat = True
+						break
+					elif action == RETURN:
+						return
+				if repeat:
+					# New snapshot
+					continue
+				return
+
+			# 2.3 No match: the messages of the snapshot are consumed
+			consumed = False
+			for (port, entry) in snapshot.items():
+				if port is not systemQueue:
+					port._consume(entry)
+					consumed = True
+			
+			# 3. Wait until another message arrives on one of our watched ports, once the snapshot is exhausted
+			if not consumed:
+				cancelled = _isAtsCancelled()
+				notifier.wait()
+				if not cancelled and _isAtsCancelled() and isinstance(threading.currentThread(), threading._MainThread):
+					# SIGINT received while waiting, stop() the TC
+					stop()
 					
-	#			if r: logInternal("activity detected on port(s) %s" % r)
 	except Exception, e:
 		logInternal("exception in alt(): %s (%s)" % (str(e), repr(e)))
-		if systemQueueWatched:
-			_getSystemQueue()._unregisterListener()
 		raise e
 
-	if systemQueueWatched:
-		_getSystemQueue()._unregisterListener()
-
 # Control "Keywords" for alt().
 # May be used as is directly, in a lambda, or returned from an altstep or a function called
 # from a lambda.
@@ -2128,56 +2196,18 @@ class SystemQueue(Port):
 	system messages are handled in alt(), in particular with regards
 	to new message notifications.
 	
-	each alt() that are watching the system queue should register
-	a dedicated notifier (calling getNotifierFd(), the queue assign
-	a new notifier automatically per TLS),
+	each alt() that are watching the system queue registers
+	its component notifier as a listener, as for any other port,
 	and whenever a new message arrives in the system queue, all
 	registered notifiers are notified.
 	"""
 	def __init__(self):
 		Port.__init__(self, tc = None, name = '__system_queue__')
-		self._pipes = []
-
-	def _registerListener(self):
-		pipe = getLocalContext().getSystemQueueNotifier()
-		self._lock()
-		if not pipe in self._pipes:
-			self._pipes.append(pipe)
-		self._unlock()
-		logInternal("system queue: tc %s registered as a listener (fd %s)" % (getLocalContext().getTc(), pipe[0]))
-		return pipe
-	
-	def getNotifierFd(self):
-		pipe = getLocalContext().getSystemQueueNotifier()
-		return pipe[0]
-	
-	def _unregisterListener(self):
-		pipe = getLocalContext().getSystemQueueNotifier()
-		self._lock()
-		try:
-			self._pipes.remove(pipe)
-		except:
-			pass
-		self._unlock()
-		getLocalContext().cleanSystemQueueNotifier()
-		logInternal("system queue: tc %s unregistered as a listener (fd %s)" % (getLocalContext().getTc(), pipe[0]))
-	
-	def _notifyListeners(self):
-		"""
-		Notify current system queue listeners (writing something in their notification pipes).
-		"""
-		for p in self._pipes:
-			try:
-				os.write(p[1], 'r')
-				logInternal("system queue: notifying a new message for reader on %s" % (p[0]))
-			except Exception, e:
-				logInternal("system queue: async notifier error %s" % (e))
-				pass
 
 	def _enqueue(self, message, from_):
 		"""
 		The system queue implementation for enqueue is to enqueue the message,
-		then send a notification through the notifier pipe only if
+		then notify the listeners, even if the queue is not started.
 		"""
 		logInternal("system queue: enqueuing message from %s" % (str(from_)))
 		self._lock()
@@ -2185,23 +2215,6 @@ class SystemQueue(Port):
 		self._notifyListeners()
 		self._unlock()
 
-	def _acknowledgeNotification(self):
-		"""
-		To be called by a listener when it acknowledges that
-		it is aware that new messages where received in the system queue.
-		Technically, this purges its notification pipe to avoid an overflow
-		in the long run.
-		"""
-		pipe = getLocalContext().getSystemQueueNotifier()
-		try:
-			f = pipe[0]
-			r, w, e = select.select([f], [], [], 0)
-			if f in r:
-				os.read(f, 1000)
-				logInternal("system queue: tc %s acknowledged new message notification on fd %s" % (getLocalContext().getTc(), f))
-		except:
-			pass
-	
 	def _remove(self, message, from_):
 		"""
 		Consumes a particular message from the system queue.
@@ -2948,9 +2961,90 @@ class with_(CodecTemplate):
 # Template matching
 ################################################################################
 
+# Templates are compiled into matchers, i.e. callables (message, path) -> (bool, decodedMessage, path)
+# implementing the same semantics as the initial recursive template walk.
+#
+# The paths are lazily evaluated: a matcher passes to its children either the
+# (unicode) path it received, or a tuple (parent path, path element) that is only
+# converted to a string by _pathToString() when the path is actually needed
+# (mismatch, or non-builtin condition templates).
+
+# Compiled matchers, indexed by the id() of their templates.
+# The templates are referenced to make sure their ids are not reused,
+# with a signature of their contents to detect in-place modifications.
+# A template is only cached once seen twice, so that one-shot templates
+# do not evict the others; the oldest entries are evicted first.
+_TemplateMatchers = {} # id(template): (template, signature, matcher)
+_TemplateMatchersOrder = deque() # ids, in insertion order
+_TemplateCandidates = {} # id(template): None, templates seen once
+_TemplateMatchersMutex = thread.allocate_lock()
+_TemplateMatchersMaxSize = 1024
+
+# Conditions whose match() does not use its path argument
+_TerminalConditionClasses = [ greater_than, lower_than, between, any, any_or_none, empty, pattern, omit, equals_to ]
+
+def _pathToString(path):
+	"""
+	Converts a lazy template path to the actual path string.
+	"""
+	if not isinstance(path, tuple):
+		return path
+	elements = []
+	while isinstance(path, tuple):
+		(path, element) = path
+		elements.append(element)
+	elements.append(path)
+	elements.reverse()
+	return u''.join(elements)
+
+def _getTemplateSignature(template):
+	"""
+	Returns what a compiled matcher depends on: the structure of the
+	template (including the dict iteration order, which determines the
+	reported mismatched path) and its leaves. Conditions do not define
+	__eq__, so they are compared by identity.
+	"""
+	if isinstance(template, dict):
+		return (dict, [ (key, _getTemplateSignature(value)) for (key, value) in template.iteritems() ])
+	if isinstance(template, (list, tuple)):
+		return (template.__class__, [ _getTemplateSignature(value) for value in template ])
+	if isinstance(template, CodecTemplate):
+		return (template.__class__, template._codec, _getTemplateSignature(template._template))
+	return (template.__class__, template)
+
+def _getTemplateMatcher(template):
+	"""
+	Returns the compiled matcher for a template.
+	Structured templates are compiled once, then cached as long as
+	their contents do not change.
+	"""
+	if not isinstance(template, (dict, list, tuple, CodecTemplate)):
+		return _compileTemplate(template)
+	key = id(template)
+	signature = _getTemplateSignature(template)
+	entry = _TemplateMatchers.get(key) # no lock needed to read it
+	if entry and entry[0] is template and entry[1] == signature:
+		return entry[2]
+	matcher = _compileTemplate(template)
+	_TemplateMatchersMutex.acquire()
+	if entry or _TemplateCandidates.has_key(key):
+		_TemplateCandidates.pop(key, None)
+		if not _TemplateMatchers.has_key(key):
+			_TemplateMatchersOrder.append(key)
+			if len(_TemplateMatchersOrder) > _TemplateMatchersMaxSize:
+				del _TemplateMatchers[_TemplateMatchersOrder.popleft()]
+		_TemplateMatchers[key] = (template, signature, matcher)
+	else:
+		# First use: not cached yet
+		if len(_TemplateCandidates) >= _TemplateMatchersMaxSize:
+			_TemplateCandidates.clear()
+		_TemplateCandidates[key] = None
+	_TemplateMatchersMutex.release()
+	return matcher
+
 def templateMatch(message, template, initialPath = u'template'):
 	"""
-	A simple wrapper over _templateMatch to catch possible internal exceptions.
+	A simple wrapper over the compiled template matchers to catch possible internal exceptions.
 
 	@type  message: any object
 	@param message: the encoded message, as received (may be structured, too)
@@ -2962,11 +3056,12 @@ def templateMatch(message, template, initialPath = u'template'):
 	"""
 	mismatchedPath = initialPath
 	try:
-		(ret, decodedMessage, mismatchedPath) = _templateMatch(message, template, initialPath)
+		(ret, decodedMessage, mismatchedPath) = _getTemplateMatcher(template)(message, initialPath)
+		mismatchedPath = _pathToString(mismatchedPath)
 	except Exception:
 		# Actually, this is for debug purposes
 		logUser("Exception while trying to match a template:\n%s" % getBacktrace())
-		return (False, message, mismatchedPath)
+		return (False, message, _pathToString(mismatchedPath))
 	return (ret, decodedMessage, mismatchedPath)
 
 def match(message, template):
@@ -2975,8 +3070,9 @@ def match(message, template):
 	"""
 	ret, decodedMessage, mismatchedPath = templateMatch(message, template)
 	if not ret:
-		logTemplateMismatch(tc = getLocalContext().getTc(), port = "", message = decodedMessage, template = _expandTemplate(template), encodedMessage = message, mismatchedPath = mismatchedPath)
-	else:
+		if isLogLevelEnabled('mismatch'):
+			logTemplateMismatch(tc = getLocalContext().getTc(), port = "", message = decodedMessage, template = _expandTemplate(template), encodedMessage = message, mismatchedPath = mismatchedPath)
+	elif isLogLevelEnabled('match'):
 		logTemplateMatch(tc = getLocalContext().getTc(), port = "", message = decodedMessage, template = _expandTemplate(template), encodedMessage = message)
 	return ret
 
@@ -2998,103 +3094,146 @@ def _templateMatch(message, template, path):
 	          b the decoded message (same type as @param message),
 	          path is the last attempted template path before a mismatch. Undetermined if a == True.
 	"""
-	# Support for dynamic templates
+	(ret, decodedMessage, path) = _getTemplateMatcher(template)(message, path)
+	return (ret, decodedMessage, _pathToString(path))
+
+def _compileTemplate(template):
+	"""
+	Compiles a template into a matcher.
+	
+	@type  template: any python object, valid for a Testerman template: may contains template proxies such as CodecTemplates and ConditionTemplates.
+	@param template: the template to compile
+	
+	@rtype: callable (message, path) -> tuple (bool, object, path)
+	@returns: the matcher, returning (a, b, path) where a is the matching status (True/False),
+	          b the decoded message (same type as message),
+	          path is the last attempted (lazy) template path before a mismatch. Undetermined if a == True.
+	"""
+	# Support for dynamic templates: evaluated at each match
 	if callable(template):
-		template = template()
+		def matchDynamic(message, path):
+			return _compileTemplate(template())(message, path)
+		return matchDynamic
 
 	# Match all
 	if template is None:
-		return (True, message, path)
+		def matchAll(message, path):
+			return (True, message, path)
+		return matchAll
 	
 	# CodecTemplate proxy template
 	if isinstance(template, CodecTemplate):
-		# Let's see if we can first decode the message
-		try:
-			decodedMessage = template.decode(message)
-		except Exception, e:
-			logInternal("mismatch: unable to decode message part with codec %s: %s" % (template._codec, str(e) + getBacktrace()))
-			return (False, message, path)
-		# TODO: handle decoding error here ?
-		logInternal("_templateMatch: message part %s decoded with codec %s: %s" % (path, template._codec, repr(decodedMessage)))
-		# Now match the decoded message against the proxied template (not expanded, because it should contain other proxies, if any)
-		return _templateMatch(decodedMessage, template._template, path)
+		# The proxied template is not expanded, because it should contain other proxies, if any
+		matchDecoded = _compileTemplate(template._template)
+		def matchCodec(message, path):
+			# Let's see if we can first decode the message
+			try:
+				decodedMessage = template.decode(message)
+			except Exception, e:
+				if isLogLevelEnabled('internal'):
+					logInternal("mismatch: unable to decode message part with codec %s: %s" % (template._codec, str(e) + getBacktrace()))
+				return (False, message, path)
+			# Now match the decoded message against the proxied template
+			return matchDecoded(decodedMessage, path)
+		return matchCodec
 	
 	# Structured type: dict
 	# all entries in template dict must match ; extra message entries are ignored (but kept in "decoded dict")
 	if isinstance(template, dict):
-		if not isinstance(message, dict):
-			logInternal("mismatch: %s: expected a dict << %s >>, got << %s >>" % (path, repr(template), repr(message)))
-			return (False, message, path)
-		# Existing entries in template dict must be matched (excepting 'omit' entries, which must not be present...)
-		decodedDict = {}
-		result = True
-		mismatchedPath = None
+		# (key, path element, matcher, optional)
+		entries = []
 		for key, tmplt in template.items():
 			# any value or none, ie '*'
 			if tmplt is None:
 				continue
-			if message.has_key(key):
-				(ret, decodedField, p) = _templateMatch(message[key], tmplt, u"%s.{%s}" % (path, unicode(key)))
-				decodedDict[key] = decodedField
-				if not ret:
-					logInternal("mismatch: %s: mismatched dict entry %s" % (path, unicode(key)))
+			optional = isinstance(tmplt, (omit, any_or_none, ifpresent)) or (isinstance(tmplt, extract) and isinstance(tmplt._template, (omit, any_or_none, ifpresent)))
+			try:
+				element = u".{%s}" % unicode(key)
+			except UnicodeError:
+				# Will raise when actually matching this entry, as the initial implementation
+				element = None
+			entries.append((key, element, _compileTemplate(tmplt), optional))
+		def matchDict(message, path):
+			if not isinstance(message, dict):
+				if isLogLevelEnabled('internal'):
+					logInternal("mismatch: %s: expected a dict << %s >>, got << %s >>" % (_pathToString(path), repr(template), repr(message)))
+				return (False, message, path)
+			# Existing entries in template dict must be matched (excepting 'omit' entries, which must not be present...)
+			decodedDict = {}
+			result = True
+			mismatchedPath = None
+			for (key, element, matcher, optional) in entries:
+				if key in message:
+					(ret, decodedField, p) = matcher(message[key], (path, element or u".{%s}" % unicode(key)))
+					decodedDict[key] = decodedField
+					if not ret:
+						if isLogLevelEnabled('internal'):
+							logInternal("mismatch: %s: mismatched dict entry %s" % (_pathToString(path), unicode(key)))
+						result = False
+						mismatchedPath = p
+						# continue to traverse the dict to perform "maximum" message decoding
+				elif optional:
+					# if the missing keys are omit(), that's ok.
+					continue
+				else:
+					# if it's something else, missing key, so no match.
+					if isLogLevelEnabled('internal'):
+						logInternal("mismatch: %s: missing dict entry %s" % (_pathToString(path), repr(key)))
 					result = False
-					mismatchedPath = p
-					# continue to traverse the dict to perform "maximum" message decoding
-			elif isinstance(tmplt, (omit, any_or_none, ifpresent)) or (isinstance(tmplt, extract) and isinstance(tmplt._template, (omit, any_or_none, ifpresent))):
-				# if the missing keys are omit(), that's ok.
-				logInternal("omit: %s: omitted value %s not found, or optional value not found. OK." % (path, repr(key)))
-				continue
-			else:
-				# if it's something else, missing key, so no match.
-				logInternal("mismatch: %s: missing dict entry %s" % (path, repr(key)))
-				result = False
-				mismatchedPath = path
-		# Now, add message keys that were not in template to the decoded dict
-		for key, m in message.items():
-			if not key in template:
-				decodedDict[key] = m
-		return (result, decodedDict, mismatchedPath)
+					mismatchedPath = path
+			# Now, add message keys that were not in template to the decoded dict
+			for key, m in message.iteritems():
+				if not key in template:
+					decodedDict[key] = m
+			return (result, decodedDict, mismatchedPath)
+		return matchDict
 	
 	# Structured type: tuple (choice, value)
 	# Must be the same choice name (ie tupe[0]) and matching value
 	if isinstance(template, tuple):
-		if not isinstance(message, tuple):
-			logInternal("mismatch: %s: expected a tuple << %s >>, got << %s >>" % (path, repr(template), repr(message)))
-			return (False, message, path)
-		# Check choice
-		if not message[0] == template[0]:
-			logInternal("mismatch: %s: tuple choices differ (message: %s, template %s)" % (path, repr(message[0]), repr(template[0])))
-			return (False, message, path)
-		# Check value
-		(ret, decoded, path) = _templateMatch(message[1], template[1], u"%s.(%s)" % (path, unicode(message[0])))
-		return (ret, (message[0], decoded), path)
+		choice = template[0]
+		if isinstance(choice, basestring):
+			choiceElement = u".(%s)" % unicode(choice)
+		else:
+			choiceElement = None
+		matchValue = _compileTemplate(template[1])
+		def matchTuple(message, path):
+			if not isinstance(message, tuple):
+				if isLogLevelEnabled('internal'):
+					logInternal("mismatch: %s: expected a tuple << %s >>, got << %s >>" % (_pathToString(path), repr(template), repr(message)))
+				return (False, message, path)
+			# Check choice
+			if not message[0] == choice:
+				if isLogLevelEnabled('internal'):
+					logInternal("mismatch: %s: tuple choices differ (message: %s, template %s)" % (_pathToString(path), repr(message[0]), repr(choice)))
+				return (False, message, path)
+			# Check value
+			(ret, decoded, path) = matchValue(message[1], (path, choiceElement or u".(%s)" % unicode(message[0])))
+			return (ret, (message[0], decoded), path)
+		return matchTuple
 
 	# Structured type: list
 	# This is a one-to-one exact match, ordered.
 	# as a consequence, the same number of elements in template and message are expected,
 	# unless we have some * in template.
 	if isinstance(template, list):
-		if not isinstance(message, list):
-			logInternal("mismatch: %s: expected a list" % path)
-			return (False, message, path)
-		
-		# Wildcard (*) support:
-		# match(message, *|template) =
-		#  matched = False
-		#  i = 0
-		#  while not matched and message[i:]:
-		#   matched = match(message[i:], template)
-		(result, decodedList, path) = _templateMatch_list(message, template, path)
-		return (result, decodedList, path)
+		return _compileTemplate_list(template)
 
 	# conditions: proxied templates	
 	if isinstance(template, ConditionTemplate):
 		# TODO: ConditionTemplate.match() should returns a decoded message, too
-		return (template.match(message, path), message, path)
+		if template.__class__ in _TerminalConditionClasses:
+			def matchTerminalCondition(message, path):
+				return (template.match(message), message, path)
+			return matchTerminalCondition
+		def matchCondition(message, path):
+			return (template.match(message, _pathToString(path)), message, path)
+		return matchCondition
 	
 	# Simple types
-	return (message == template, message, path)
+	def matchValue(message, path):
+		return (message == template, message, path)
+	return matchValue
 
 def _is_any_or_none(template):
 	"""
@@ -3109,115 +3248,109 @@ def _is_any_or_none(template):
 	else:
 		return False
 
-def _templateMatch_list(message, template, path):
+def _compileTemplate_list(template):
 	"""
-	both message and template are lists.
+	Compiles a list template.
 	
-	Semi-recursive implementation.
+	Semi-recursive implementation, walking the template
+	and the message from indexes instead of slicing them.
 	De-recursived on wildcard * only.
 	"""
-	logInternal("Trying to match %s with %s" % (repr(message), repr(template)))
 	# match(message, *|template) =
 	#  matched = False
 	#  i = 0
 	#  while not matched and message[i:]:
 	#   matched = match(message[i:], template)
+
+	# (matcher, is any or none, is ifpresent) for each template element
+	elements = [ (_compileTemplate(t), _is_any_or_none(t), isinstance(t, ifpresent)) for t in template ]
+	templateLength = len(elements)
 	
-	# An empty template can only match an empty message
-	if not template:
-		if not message:
-			return (True, [], path)
-		else:
-			return (False, [], path)
-
-	# The contrary is false. A non-empty template
-	# may match an empty message (wilcards, ifpresent elements, etc)
-
-	# template header|trail	
-	th, tt = (template[0], template[1:])
-	
-	if not message:
-		if _is_any_or_none(th):
-			# matched
-			logInternal("_templateMatch_list matched: [] against [*]")
-			return (True, [], path)
-		elif isinstance(th, ifpresent):
-			# discard the optional element, check with the others
-			ret, decoded, path = _templateMatch_list(message, tt, path)
-			return (ret, decoded, path)
-		else:
-			# Other templates: no match, missing mandatory elements to match
-			return (False, [], path)
-	
-	# message header|trail
-	mh, mt = (message[0], message[1:])
+	def matchList(message, mi, ti, path):
+		"""
+		Matches message[mi:] against template[ti:].
+		"""
+		# An empty template can only match an empty message
+		if ti == templateLength:
+			if mi == len(message):
+				return (True, [], path)
+			else:
+				return (False, [], path)
 
-	if _is_any_or_none(th):
-		if not tt:
-			logInternal("_templateMatch_list matched: %s against %s ([*])" % (repr(message), repr(template)))
-			return (True, message, path)
-		matched = False
-		decodedList = []
-		trailingDecodedList = []
-		i = 0
-		mismatchedPath = path
-		while not matched and message[i:]:
-			(matched, trailingDecodedList, p) = _templateMatch_list(message[i:], tt, path)
-			if not matched:
-				mismatchedPath = p
-				decodedList.append(message[i])
-			i += 1
-		logInternal("_templateMatch_list res %s: %s against %s ([*])" % (matched, repr(message), repr(template)))
-		# decodedList += trailingDecodedList
-		for e in trailingDecodedList:
-			decodedList.append(e)
-		return (matched, decodedList, mismatchedPath)
-	else:
-		# Recursive approach:
-		# we match the same element first element, and the trailing list should match, too
-		decodedList = []
-		result = True
-		(ret, decodedAttemptedElement, mismatchedPath) = _templateMatch(mh, th, u'%s.*' % path)
-
-		if not ret and not isinstance(th, ifpresent):
-			# mismatch on non-optional/if present element
-			logInternal("_templateMatch_list mismatched on first element: %s against %s " % (repr(message), repr(template)))
-			result = False
-			# Display why we didn't match our element
-			decodedList.append(decodedAttemptedElement)
-			# Complete with undecoded message
-			decodedList += mt
-		elif not ret:
-			# not matching, but it was an optional/ifpresent element.
-			# We just bypass this template element and try to match the
-			# trailing template only
-			
-			# Display why we didn't match our element
-			# This may cause duplicated list elements in the 'decoded message',
-			# in particular in the cases where multiple optional matches are 
-			# attempted in a row. Actually, the same element will be matched
-			# against each optional template elements, making it appear multiple
-			# time in the final 'decoded' message used for template matching.
-			
-			# This basically leads to "expand" the message so that it contains
-			# a number of elements that can be mapped with the optional/ifpresent
-			# template elements.
-			decodedList.append(decodedAttemptedElement)
-
-			logInternal("_templateMatch_list mismatched on first optional element: %s against %s " % (repr(message), repr(template)))
-			(ret, decoded, mismatchedPath) = _templateMatch_list(message, tt, path)
-			result = ret
-			decodedList += decoded
+		# The contrary is false. A non-empty template
+		# may match an empty message (wilcards, ifpresent elements, etc)
+
+		# template header
+		(matcher, isAnyOrNone, isIfpresent) = elements[ti]
+		
+		if mi == len(message):
+			if isAnyOrNone:
+				# matched
+				return (True, [], path)
+			elif isIfpresent:
+				# discard the optional element, check with the others
+				return matchList(message, mi, ti + 1, path)
+			else:
+				# Other templates: no match, missing mandatory elements to match
+				return (False, [], path)
+		
+		if isAnyOrNone:
+			if ti + 1 == templateLength:
+				return (True, message[mi:], path)
+			matched = False
+			decodedList = []
+			trailingDecodedList = []
+			i = mi
+			mismatchedPath = path
+			while not matched and i < len(message):
+				(matched, trailingDecodedList, p) = matchList(message, i, ti + 1, path)
+				if not matched:
+					mismatchedPath = p
+					decodedList.append(message[i])
+				i += 1
+			decodedList += trailingDecodedList
+			return (matched, decodedList, mismatchedPath)
 		else:
+			# Recursive approach:
+			# we match the same element first element, and the trailing list should match, too
+			(ret, decodedAttemptedElement, mismatchedPath) = matcher(message[mi], (path, u'.*'))
 			# Display why we didn't match our element
-			decodedList.append(decodedAttemptedElement)
-			logInternal("_templateMatch_list matched on first element: %s against %s " % (repr(message), repr(template)))
-			(ret, decoded, mismatchedPath) = _templateMatch_list(mt, tt, path)
-			result = ret
+			decodedList = [ decodedAttemptedElement ]
+
+			if not ret and not isIfpresent:
+				# mismatch on non-optional/if present element
+				if isLogLevelEnabled('internal'):
+					logInternal("_templateMatch_list mismatched on first element at %s" % _pathToString(path))
+				# Complete with undecoded message
+				decodedList += message[mi+1:]
+				return (False, decodedList, mismatchedPath)
+			elif not ret:
+				# not matching, but it was an optional/ifpresent element.
+				# We just bypass this template element and try to match the
+				# trailing template only
+				
+				# This may cause duplicated list elements in the 'decoded message',
+				# in particular in the cases where multiple optional matches are 
+				# attempted in a row. Actually, the same element will be matched
+				# against each optional template elements, making it appear multiple
+				# time in the final 'decoded' message used for template matching.
+				
+				# This basically leads to "expand" the message so that it contains
+				# a number of elements that can be mapped with the optional/ifpresent
+				# template elements.
+				(ret, decoded, mismatchedPath) = matchList(message, mi, ti + 1, path)
+			else:
+				(ret, decoded, mismatchedPath) = matchList(message, mi + 1, ti + 1, path)
 			decodedList += decoded
+			return (ret, decodedList, mismatchedPath)
 
-#		logInternal("_templateMatch_list res %s: %s against %s ([*])" % (result, repr(message), repr(template)))
-		return (result, decodedList, mismatchedPath)
+	def matchListTemplate(message, path):
+		if not isinstance(message, list):
+			if isLogLevelEnabled('internal'):
+				logInternal("mismatch: %s: expected a list" % _pathToString(path))
+			return (False, message, path)
+		return matchList(message, 0, 0, path)
+	return matchListTemplate
 
 
 ################################################################################
@@ -3503,6 +3636,18 @@ def disable_logs():
 def enable_logs():
 	TestermanTCI.enableLogs()
 
+def enable_pipelined_send(window = 32):
+	"""
+	Messages sent through remote probes no longer wait for the probe
+	acknowledgement, up to window unacknowledged messages.
+	Send failures are then reported as user logs, asynchronously,
+	instead of raising an exception in send().
+	"""
+	TestermanSA.setPipelinedSend(window)
+
+def disable_pipelined_send():
+	TestermanSA.setPipelinedSend(0)
+
 ################################################################################
 # Convenience functions: TTCN-3 "extensions"
 ################################################################################
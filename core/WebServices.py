@@ -855,20 +855,25 @@ def getDependencies(path, recursive = False):
 	getLogger().info(">> getDependencies(%s, %s)" % (path, recursive))
 	if not path.startswith('/'): path = '/' + path
 
-	res = []
+	res = None
 	try:
-		source = FileSystemManager.instance().read(path)
-		if source is None:
-			raise Exception('Cannot find %s' % path)
-		
-		if path.endswith('.py'):
-			res = DependencyResolver.python_getDependencyFilenames(source, path, recursive)
-		elif path.endswith('.ats'):
-			res = DependencyResolver.python_getDependencyFilenames(source, path, recursive)
-		elif path.endswith('.campaign'):	
-			res = DependencyResolver.campaign_getDependencyFilenames(source, os.path.split(path)[0], recursive, path)
-		else:
-			raise Exception('Unsupported file format, cannot resolve dependencies')
+		if path.endswith('.py') or path.endswith('.ats'):
+			# Looked up in the repository-wide import graph (None if not indexed)
+			res = DependencyResolver.instance().getDependencies(path, recursive)
+
+		if res is None:
+			source = FileSystemManager.instance().read(path)
+			if source is None:
+				raise Exception('Cannot find %s' % path)
+			
+			if path.endswith('.py'):
+				res = DependencyResolver.python_getDependencyFilenames(source, path, recursive)
+			elif path.endswith('.ats'):
+				res = DependencyResolver.python_getDependencyFilenames(source, path, recursive)
+			elif path.endswith('.campaign'):	
+				res = DependencyResolver.campaign_getDependencyFilenames(source, os.path.split(path)[0], recursive, path)
+			else:
+				raise Exception('Unsupported file format, cannot resolve dependencies')
 		
 	except Exception, e:
 		e =  Exception("Unable to perform operation: %s\n%s" % (str(e), Tools.getBacktrace()))
@@ -910,16 +915,8 @@ def getReverseDependencies(path):
 			raise Exception('Cannot find %s' % path)
 		
 		if path.endswith('.py'):
-			# Well, we need to scan all our python and ATS files into our repository (the candidate)
-			# do a:
-			# candidateSource = getFile(candidatePath)
-			# try:
-			# 	deps = DependencyResolver.python_getDependencyFilenames(candidateSource, candidatePath, recursive = False)
-			# except:
-			#		deps = []
-			# if path in deps and candidatePath not in res:
-			#  res.append(candidatePath)
-			res = []
+			# Looked up in the repository-wide import graph
+			res = DependencyResolver.instance().getReverseDependencies(path)
 		else:
 			# Reverse dependencies is not supported on something that is not a module
 			res = []
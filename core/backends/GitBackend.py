@@ -21,19 +21,35 @@
 #
 # Files are locally managed into a working dir.
 # Write operations trigger GIT actions.
+#
+# File revisions are retrieved from a per-path index of the history,
+# saved under testerman.var_root by default.
 ##
 
+import ConfigManager
 import FileSystemBackend
 import FileSystemBackendManager
 
 import dulwich
 
+import cPickle as pickle
 import glob
 import logging
 import os
 import shutil
+import stat
+import threading
 import time
 
+try:
+	import hashlib
+	shaclass = hashlib.sha1
+except:
+	import sha
+	shaclass = sha.sha
+
+cm = ConfigManager.instance()
+
 ################################################################################
 # Logging
 ################################################################################
@@ -49,11 +65,236 @@ def fileExists(path):
 	except:
 		return False
 
+################################################################################
+# Revision index
+################################################################################
+
+class RevisionIndex:
+	"""
+	A per-path index of the file changes along the history of the
+	repository head, so that the revisions of a file are not computed
+	by traversing the trees of all the commits.
+
+	The commits are indexed in chronological order, each one being compared
+	to the previous one by diffing their trees (unchanged subtrees are skipped).
+	New commits since the last indexed head are indexed incrementally;
+	the index is rebuilt if the history was rewritten or if a new commit
+	is older than the last indexed one.
+
+	The index is saved to a file (pickled) after each update, if provided.
+	"""
+	VERSION = 1
+	# Maximum number of trees kept in memory while indexing
+	TREE_CACHE_SIZE = 10000
+
+	def __init__(self, repo, filename = None):
+		self._mutex = threading.RLock()
+		self._repo = repo
+		self._filename = filename
+		self._reset()
+		if filename and fileExists(filename):
+			try:
+				self._load()
+			except Exception, e:
+				getLogger().warning("Unable to load the revision index %s, rebuilding it: %s" % (filename, str(e)))
+				self._reset()
+
+	def _lock(self):
+		self._mutex.acquire()
+
+	def _unlock(self):
+		self._mutex.release()
+
+	def _reset(self):
+		# The last indexed commit id, and its tree id
+		self._head = None
+		self._tree = None
+		# (message, committer, commit time) of the indexed commits, in chronological order
+		self._commits = []
+		# Indexed commit ids
+		self._commitIds = {}
+		# List of (commit index, change, blob id), indexed by path
+		self._changes = {}
+		# Entries of the recently diffed trees, indexed by tree id
+		self._treeEntries = {}
+
+	def _load(self):
+		f = open(self._filename, 'rb')
+		try:
+			(version, self._head, self._tree, self._commits, self._commitIds, self._changes) = pickle.load(f)
+			self._treeEntries = {}
+		finally:
+			f.close()
+		if version != self.VERSION:
+			raise Exception("unsupported index version %s" % version)
+
+	def _save(self):
+		try:
+			os.makedirs(os.path.split(self._filename)[0])
+		except:
+			pass
+		tmpFilename = self._filename + '.tmp'
+		f = open(tmpFilename, 'wb')
+		try:
+			pickle.dump((self.VERSION, self._head, self._tree, self._commits, self._commitIds, self._changes), f, 2)
+		finally:
+			f.close()
+		os.rename(tmpFilename, self._filename)
+
+	def _getNewCommits(self, head):
+		"""
+		Returns the commits reachable from head that are not indexed yet,
+		in chronological order, and whether they only extend the indexed history.
+		"""
+		commits = []
+		fastForward = True
+		visited = {}
+		pending = [ head ]
+		while pending:
+			commitId = pending.pop()
+			if visited.has_key(commitId):
+				continue
+			visited[commitId] = None
+			if self._commitIds.has_key(commitId):
+				if commitId != self._head:
+					fastForward = False
+				continue
+			commit = self._repo.get_object(commitId)
+			commits.append(commit)
+			pending += commit.parents
+		# Chronological order; the discovery order is reversed so that
+		# parents come first for commits with the same commit time
+		commits.reverse()
+		commits.sort(lambda x, y: cmp(x.commit_time, y.commit_time))
+		if self._commits and commits and commits[0].commit_time < self._commits[-1][2]:
+			fastForward = False
+		if self._head and not visited.has_key(self._head):
+			fastForward = False
+		return (commits, fastForward)
+
+	def _getTreeEntries(self, treeId):
+		if not treeId:
+			return {}
+		ret = self._treeEntries.get(treeId)
+		if ret is None:
+			if len(self._treeEntries) >= self.TREE_CACHE_SIZE:
+				self._treeEntries.clear()
+			ret = {}
+			for (name, mode, sha) in self._repo.get_object(treeId).iteritems():
+				ret[name] = (mode, sha)
+			self._treeEntries[treeId] = ret
+		return ret
+
+	def _diffTrees(self, oldTreeId, newTreeId, prefix, changes):
+		"""
+		Appends the (path, old blob id, new blob id) of the files that differ
+		between two trees to changes.
+		"""
+		if oldTreeId == newTreeId:
+			return
+		oldEntries = self._getTreeEntries(oldTreeId)
+		newEntries = self._getTreeEntries(newTreeId)
+		names = oldEntries.copy()
+		names.update(newEntries)
+		for name in names.keys():
+			old = oldEntries.get(name)
+			new = newEntries.get(name)
+			if old == new:
+				continue
+			path = prefix + name
+			oldBlob = oldTree = newBlob = newTree = None
+			if old:
+				if stat.S_ISDIR(old[0]):
+					oldTree = old[1]
+				else:
+					oldBlob = old[1]
+			if new:
+				if stat.S_ISDIR(new[0]):
+					newTree = new[1]
+				else:
+					newBlob = new[1]
+			if oldBlob != newBlob:
+				changes.append((path, oldBlob, newBlob))
+			if oldTree != newTree:
+				self._diffTrees(oldTree, newTree, path + '/', changes)
+
+	def _index(self, commit):
+		changes = []
+		self._diffTrees(self._tree, commit.tree, '', changes)
+		index = len(self._commits)
+		self._commits.append((commit.message, commit.committer, commit.commit_time))
+		self._commitIds[commit.id] = index
+		for (path, oldBlob, newBlob) in changes:
+			if not oldBlob:
+				change = (index, "added", newBlob)
+			elif not newBlob:
+				# Identified by the last revision of the file
+				change = (index, "deleted", oldBlob)
+			else:
+				change = (index, "updated", newBlob)
+			self._changes.setdefault(path, []).append(change)
+		self._head = commit.id
+		self._tree = commit.tree
+
+	def update(self):
+		"""
+		Indexes the commits added since the last update.
+		"""
+		self._lock()
+		try:
+			try:
+				head = self._repo.head()
+			except KeyError:
+				# No commit yet
+				return
+			if head == self._head:
+				return
+			start = time.time()
+			(commits, fastForward) = self._getNewCommits(head)
+			if not fastForward:
+				getLogger().info("Repository history changed, rebuilding the revision index")
+				self._reset()
+				(commits, fastForward) = self._getNewCommits(head)
+			for commit in commits:
+				self._index(commit)
+			self._head = head
+			getLogger().info("Revision index updated: %d commits indexed in %.2fs" % (len(commits), time.time() - start))
+			if self._filename:
+				try:
+					self._save()
+				except Exception, e:
+					getLogger().warning("Unable to save the revision index %s: %s" % (self._filename, str(e)))
+		finally:
+			self._unlock()
+
+	def getRevisions(self, localname):
+		"""
+		Returns the changes of a file, in chronological order,
+		as GitBackend.revisions().
+		"""
+		self.update()
+		self._lock()
+		try:
+			ret = []
+			for (index, change, sha) in self._changes.get(localname, []):
+				(message, committer, date) = self._commits[index]
+				ret.append(dict(message = message, committer = committer, date = date, id = sha, change = change))
+			return ret
+		finally:
+			self._unlock()
+
+
+################################################################################
+# The backend
+################################################################################
+
 class GitBackend(FileSystemBackend.FileSystemBackend):
 	"""
 	Properties:
 	- working_dir: the working directory the GIT repo is initially cloned.
 	- repository: 
+	- revision_index: the file the revision index is saved to
+	  (default: a file under testerman.var_root/git_revision_index)
 	"""
 	def logged(fn, *args, **kw):
 		"""
@@ -76,6 +317,8 @@ class GitBackend(FileSystemBackend.FileSystemBackend):
 
 		# Mandatory properties (defined here to serve as documentation)
 		self.setProperty('repository', None)
+		# Optional properties
+		self.setProperty('revision_index', None)
 
 	
 	def initialize(self):
@@ -88,6 +331,11 @@ class GitBackend(FileSystemBackend.FileSystemBackend):
 
 		self._repo = dulwich.repo.Repo(self['repository'])
 		self._defaultCommitter = self['default_committer']
+
+		revisionIndexFilename = self['revision_index']
+		if not revisionIndexFilename and cm.get('testerman.var_root'):
+			revisionIndexFilename = '%s/git_revision_index/%s.dump' % (cm.get('testerman.var_root'), shaclass(os.path.realpath(self['repository'])).hexdigest())
+		self._revisionIndex = RevisionIndex(self._repo, revisionIndexFilename)
 			
 		return True
 	
@@ -403,61 +651,9 @@ class GitBackend(FileSystemBackend.FileSystemBackend):
 		
 		localname = filename
 		
-		ret = []
-		
 		# Only get history from the head, not from another branch yet.
-		
-		# Strategy: traverse our commits in chronological order.
-		# For each commit, check if the file is in the tree.
-		# Based on its pushed id, we will then be able to 
-		# see if the file was changed, unchanged, added, or removed, from
-		# one commit to another.
 		# There is no rename detection for now (could be done backward, based on the same sha).
-		commits = self._repo.revision_history(self._repo.head())
-		commits.reverse()
-		
-		lastchange = None
-		for c in commits:
-			# Check if the file was included in this commit
-			tree = self._repo.tree(c.tree)
-			in_this_commit = False
-			
-			# We have to traverse the tree, recursively if needed (if the localname contains directories)
-			# (here this is an iterative implementation)
-			elements = localname.split('/')
-			for i in range(len(elements)):
-				finalElement = (i == len(elements)-1)
-				for (mode, path, sha) in tree.entries():
-					if path == elements[i]:
-						# The element was in this commit
-						
-						if not finalElement:
-							tree = self._repo.tree(sha)
-							break
-						
-						# OK, final element, we have our file
-						in_this_commit = True
-
-						if lastchange:
-							if lastchange[1] == sha:
-								# no change
-								continue
-							else:
-								# file updated
-								lastchange = (dict(message = c.message, committer = c.committer, date = c.commit_time, id = sha, change = "updated"), sha)
-								ret.append(lastchange[0])
-						else:
-							# file added (or newborn)
-							lastchange = (dict(message = c.message, committer = c.committer, date = c.commit_time, id = sha, change = "added"), sha)
-							ret.append(lastchange[0])
-						break
-					
-			if not in_this_commit and lastchange:
-				# The file was seen at least once, and was deleted in this commit
-				lastchange = None
-				ret.append(dict(message = c.message, committer = c.committer, date = c.commit_time, id = sha, change = "deleted"))
-
-		return ret
+		return self._revisionIndex.getRevisions(localname)
 
 	
 	def isdir(self, path):
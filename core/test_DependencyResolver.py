@@ -0,0 +1,257 @@
+##
+# DependencyResolver import graph test tool.
+#
+# Checks that the import graph follows the files written, deleted and
+# renamed through the FileSystemManager, then measures the dependency
+# lookups on a synthetic repository of 5000 modules (50 directories of
+# chains of 10 modules, all importing a shared module) and 100 ATSes.
+#
+# Reference figures (Python 2.7.18, single-core Linux VM):
+# - reverse dependencies by scanning and parsing each file, as required
+#   before the import graph: 6.4s
+# - graph built in background: 3.5s (a module written meanwhile: 2 ms),
+#   0.41s with the imported modules cache filled (by a previous run)
+# - getReverseDependencies(): 2 us for a module, 1.8 ms for the module
+#   imported by the 5000 other ones
+# - getDependencies() from the graph: 6 us direct, 19 us recursive
+# - a module written, graph updated: 2 ms
+# - python_getDependencyFilenames() for an ATS, recursive: 13.5 ms / 4.9 ms
+#   without/with the imported modules cached
+##
+
+import sys
+sys.path.append('../common')
+
+import ConfigManager
+import DependencyResolver
+import EventManager
+import FileSystemBackendManager
+import FileSystemManager
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+cm = ConfigManager.instance()
+cm.register("testerman.document_root", "/tmp")
+cm.register("testerman.var_root", "")
+cm.set_transient("ts.server_root", os.getcwd())
+
+
+class NullEventManager:
+	"""
+	Discards the file system notifications.
+	"""
+	def dispatchNotification(self, notification):
+		pass
+
+EventManager.TheManager = NullEventManager()
+
+MODULE = """# %s
+import common
+import shared.util
+%s
+class Step%d:
+	def __init__(self, value):
+		self.value = value
+
+	def run(self, context):
+		for key in context.keys():
+			if key.startswith('_'):
+				continue
+			context[key] = shared.util.transform(context[key], self.value)
+		return common.check(context)
+
+def helper(x, y = 2):
+	return [ i * y for i in range(x) if i %% 3 ]
+"""
+
+ATS = """import %s
+
+log("starting")
+testcase = %s.Step%d(1)
+"""
+
+
+def setUpRepository(directory):
+	"""
+	Mounts directory as the document root.
+	"""
+	os.makedirs(os.path.join(directory, 'docroot', 'repository'))
+	cm.set_actual("testerman.document_root", os.path.join(directory, 'docroot'))
+	cm.set_actual("testerman.var_root", directory)
+	FileSystemManager.TheFileSystemManager = FileSystemManager.FileSystemManager()
+	FileSystemBackendManager.scanFileSystemBackends()
+	FileSystemBackendManager.Mountpoints.clear()
+	FileSystemBackendManager.mountRoot()
+
+def write(filename, content):
+	FileSystemManager.instance().write(filename, content, notify = False)
+
+def test_maintenance():
+	"""
+	The graph follows the changes made through the FileSystemManager.
+	"""
+	directory = tempfile.mkdtemp()
+	setUpRepository(directory)
+	write('/repository/libs/a.py', 'import b\n')
+	write('/repository/libs/b.py', 'X = 1\n')
+	write('/repository/samples/test.ats', 'import libs.a\n')
+	graph = DependencyResolver.ImportGraph()
+
+	assert(graph.getDependencies('/repository/samples/test.ats') == [ '/repository/libs/a.py' ])
+	assert(graph.getDependencies('/repository/samples/test.ats', recursive = True) == [ '/repository/libs/a.py', '/repository/libs/b.py' ])
+	assert(graph.getReverseDependencies('/repository/libs/b.py') == [ '/repository/libs/a.py' ])
+
+	# A new import
+	write('/repository/libs/b.py', 'import c\n')
+	try:
+		graph.getDependencies('/repository/samples/test.ats', recursive = True)
+		assert(False)
+	except Exception, e:
+		assert(str(e).startswith('Missing module: c'))
+	# ... then the missing module
+	write('/repository/libs/c.py', 'X = 1\n')
+	assert(graph.getReverseDependencies('/repository/libs/c.py') == [ '/repository/libs/b.py' ])
+	assert(graph.getDependencies('/repository/samples/test.ats', recursive = True) == [ '/repository/libs/a.py', '/repository/libs/b.py', '/repository/libs/c.py' ])
+
+	# Deleted, then renamed modules
+	FileSystemManager.instance().unlink('/repository/libs/c.py', notify = False)
+	assert(graph.getReverseDependencies('/repository/libs/c.py') == [])
+	write('/repository/libs/d.py', 'X = 1\n')
+	FileSystemManager.instance().rename('/repository/libs/d.py', 'c.py')
+	assert(graph.getReverseDependencies('/repository/libs/c.py') == [ '/repository/libs/b.py' ])
+
+	# Packages: modules are searched from their src dir
+	write('/repository/pkg/src/p.py', 'import libs.a\n')
+	assert(graph.getDependencies('/repository/pkg/src/p.py') == [ '/repository/libs/a.py' ])
+	write('/repository/pkg/src/libs/a.py', 'X = 1\n')
+	write('/repository/pkg/package.xml', '<package/>\n')
+	assert(graph.getDependencies('/repository/pkg/src/p.py') == [ '/repository/pkg/src/libs/a.py' ])
+	assert(graph.getReverseDependencies('/repository/libs/a.py') == [ '/repository/samples/test.ats' ])
+
+	# Deleted package
+	for filename in [ 'src/p.py', 'src/libs/a.py', 'package.xml' ]:
+		FileSystemManager.instance().unlink('/repository/pkg/' + filename, notify = False)
+	for path in [ 'src/libs', 'src', '' ]:
+		FileSystemManager.instance().rmdir('/repository/pkg/' + path, notify = False)
+	assert(graph.getDependencies('/repository/pkg/src/p.py') is None)
+	assert(graph.getReverseDependencies('/repository/libs/a.py') == [ '/repository/samples/test.ats' ])
+	assert(graph.getStatistics()['files'] == 4)
+
+	# The imported modules cache is saved and restored
+	DependencyResolver.finalize()
+	size = len(DependencyResolver._importedModulesCache)
+	DependencyResolver._importedModulesCache.clear()
+	DependencyResolver.initialize()
+	assert(len(DependencyResolver._importedModulesCache) == size)
+	shutil.rmtree(directory)
+	print "import graph maintenance: OK"
+
+def createRepository(directory):
+	repository = os.path.join(directory, 'docroot', 'repository')
+	os.makedirs(os.path.join(repository, 'shared'))
+	os.makedirs(os.path.join(repository, 'ats'))
+	open(os.path.join(repository, 'common.py'), 'w').write('def check(context):\n\treturn True\n')
+	open(os.path.join(repository, 'shared', 'util.py'), 'w').write('def transform(x, y):\n\treturn x\n')
+	for d in range(50):
+		os.makedirs(os.path.join(repository, 'lib%02d' % d))
+		for i in range(100):
+			if i % 10 != 9:
+				next = 'import m%03d\n' % (i + 1)
+			else:
+				next = ''
+			open(os.path.join(repository, 'lib%02d' % d, 'm%03d.py' % i), 'w').write(MODULE % ('lib%02d/m%03d' % (d, i), next, i))
+	for n in range(100):
+		module = 'lib%02d.m%03d' % (n % 50, (n * 10) % 100)
+		open(os.path.join(repository, 'ats', 't%03d.ats' % n), 'w').write(ATS % (module, module, (n * 10) % 100))
+
+def measure(fn, count):
+	start = time.time()
+	for i in range(count):
+		fn()
+	return (time.time() - start) / count
+
+def test_large_repository():
+	directory = tempfile.mkdtemp()
+	setUpRepository(directory)
+	createRepository(directory)
+
+	# What a reverse dependencies lookup required without the graph
+	start = time.time()
+	graph = DependencyResolver.ImportGraph()
+	reverseDependencies = []
+	filenames = []
+	graph._scan('/repository', filenames)
+	for filename in filenames:
+		source = FileSystemManager.instance().read(filename)
+		DependencyResolver._importedModulesCache.clear()
+		if '/repository/common.py' in DependencyResolver.python_getDependencyFilenames(source, filename, recursive = False):
+			reverseDependencies.append(filename)
+	print "reverse dependencies of a module by scanning the repository: %.2fs" % (time.time() - start)
+	assert(len(reverseDependencies) == 5000)
+	reverseDependencies.sort()
+
+	# Built in background: file system writes do not wait for it
+	DependencyResolver._importedModulesCache.clear()
+	start = time.time()
+	graph = DependencyResolver.ImportGraph()
+	builder = threading.Thread(target = graph.build)
+	builder.start()
+	time.sleep(0.5)
+	writeStart = time.time()
+	write('/repository/lib09/m009.py', MODULE % ('lib09/m009', 'import lib08.m009\n', 9))
+	writeDuration = time.time() - writeStart
+	builder.join()
+	print "import graph built in %.2fs, module written meanwhile in %.1f ms" % (time.time() - start, writeDuration * 1000)
+	assert(writeDuration < 0.5)
+	assert(graph.getReverseDependencies('/repository/common.py') == reverseDependencies)
+	dependencies = graph.getDependencies('/repository/lib09/m009.py')
+	dependencies.sort()
+	assert(dependencies == [ '/repository/common.py', '/repository/lib08/m009.py', '/repository/shared/util.py' ])
+	start = time.time()
+	graph = DependencyResolver.ImportGraph()
+	assert(graph.getReverseDependencies('/repository/common.py') == reverseDependencies)
+	print "import graph built in %.2fs, imported modules cached" % (time.time() - start)
+	assert(graph.getStatistics()['files'] == 5102)
+
+	d = measure(lambda: graph.getReverseDependencies('/repository/lib07/m004.py'), 1000)
+	print "getReverseDependencies(): %d us" % (d * 1000000)
+	assert(graph.getReverseDependencies('/repository/lib07/m004.py') == [ '/repository/lib07/m003.py' ])
+	d = measure(lambda: graph.getReverseDependencies('/repository/common.py'), 100)
+	print "getReverseDependencies(), 5000 importers: %.2f ms" % (d * 1000)
+	d = measure(lambda: graph.getDependencies('/repository/ats/t012.ats'), 1000)
+	print "getDependencies(): %d us" % (d * 1000000)
+	d = measure(lambda: graph.getDependencies('/repository/ats/t012.ats', recursive = True), 1000)
+	print "getDependencies(), recursive: %d us" % (d * 1000000)
+	dependencies = graph.getDependencies('/repository/ats/t012.ats', recursive = True)
+	assert(len(dependencies) == 12)
+
+	source = FileSystemManager.instance().read('/repository/lib07/m004.py')
+	start = time.time()
+	write('/repository/lib07/m004.py', source.replace('import m005', 'import m005\nimport lib08.m004'))
+	print "module written, import graph updated in %.1f ms" % ((time.time() - start) * 1000)
+	assert(graph.getReverseDependencies('/repository/lib08/m004.py') == [ '/repository/lib07/m004.py', '/repository/lib08/m003.py' ])
+
+	source = FileSystemManager.instance().read('/repository/ats/t012.ats')
+	DependencyResolver._importedModulesCache.clear()
+	start = time.time()
+	res = DependencyResolver.python_getDependencyFilenames(source, '/repository/ats/t012.ats')
+	print "python_getDependencyFilenames(): %.1f ms" % ((time.time() - start) * 1000)
+	d = measure(lambda: DependencyResolver.python_getDependencyFilenames(source, '/repository/ats/t012.ats'), 10)
+	print "python_getDependencyFilenames(), imports cached: %.1f ms" % (d * 1000)
+	res.sort()
+	dependencies.sort()
+	assert(res == dependencies)
+	shutil.rmtree(directory)
+	print "large repository: OK"
+
+def test():
+	test_maintenance()
+	test_large_repository()
+
+if __name__ == '__main__':
+	test()
@@ -0,0 +1,144 @@
+##
+# EventManager notification fan-out test tool.
+#
+# Dispatches events to 50 healthy Xc subscribers and a stalled one
+# (that never reads its socket), and checks that the healthy subscribers
+# are not delayed, according to the send queue overflow policies.
+##
+
+import sys
+sys.path.append('../common')
+
+import EventManager
+import TestermanMessages as Messages
+import TestermanNodes as Nodes
+
+import re
+import socket
+import threading
+import time
+
+
+URI = 'system:test'
+EVENT_COUNT = 1000
+BODY = 'x' * 4096
+
+
+class Subscriber(threading.Thread):
+	"""
+	A raw Xc client, subscribing to URI, then reading (unless stalled)
+	and checking the sequence numbers of the received events.
+	"""
+	def __init__(self, address, stalled = False):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		if stalled:
+			self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+		self.socket.connect(address)
+		self.stalled = stalled
+		self.received = 0
+		self.ordered = True
+		self.disconnected = False
+		subscription = Messages.Notification("SUBSCRIBE", URI, "Xc", "1.0")
+		subscription.setHeader("Transaction-Id", 1)
+		subscription.makeNotification()
+		self.socket.sendall(str(subscription) + '\x00')
+
+	def getChannel(self):
+		return self.socket.getsockname()
+
+	def run(self):
+		if self.stalled:
+			return
+		buf = ''
+		while 1:
+			data = self.socket.recv(65536)
+			if not data:
+				self.disconnected = True
+				return
+			packets = (buf + data).split('\x00')
+			buf = packets.pop()
+			for packet in packets:
+				m = re.search(r'Seq: ([0-9]+)', packet)
+				if not m:
+					# keep-alive
+					continue
+				if int(m.group(1)) != self.received:
+					self.ordered = False
+				self.received += 1
+
+	def isStalledDisconnected(self):
+		"""
+		Reads what the server sent, until the end of the stream (True)
+		or a timeout (False).
+		"""
+		self.socket.settimeout(5.0)
+		try:
+			while self.socket.recv(65536):
+				pass
+		except socket.timeout:
+			return False
+		except socket.error:
+			pass
+		return True
+
+
+def dispatchEvents(policy, port):
+	"""
+	Returns the manager, the healthy subscribers, the stalled one,
+	and the dispatching duration.
+	"""
+	manager = EventManager.Manager(('127.0.0.1', port), ('127.0.0.1', port + 1), maxSendQueueSize = 100, sendQueueOverflowPolicy = policy)
+	manager.start()
+	time.sleep(0.5)
+	stalled = Subscriber(('127.0.0.1', port), stalled = True)
+	healthy = [ Subscriber(('127.0.0.1', port)) for i in range(50) ]
+	for s in healthy:
+		s.start()
+	# Wait for the subscriptions
+	time.sleep(1.0)
+
+	start = time.time()
+	for i in range(EVENT_COUNT):
+		notification = Messages.Notification("EVENT", URI, "Xc", "1.0")
+		notification.setHeader("Seq", i)
+		notification.setBody(BODY)
+		manager.dispatchNotification(notification)
+	deadline = time.time() + 30.0
+	while [ s for s in healthy if s.received < EVENT_COUNT ] and time.time() < deadline:
+		time.sleep(0.01)
+	duration = time.time() - start
+	return (manager, healthy, stalled, duration)
+
+
+def test_drop():
+	(manager, healthy, stalled, duration) = dispatchEvents(Nodes.SendQueue.DROP, 48181)
+	dropped = manager.getDroppedEventCount(stalled.getChannel())
+	print "drop policy: %d events of %d bytes to 50 subscribers in %.2fs, %d events dropped for the stalled subscriber" % (EVENT_COUNT, len(BODY), duration, dropped)
+	for s in healthy:
+		assert(s.received == EVENT_COUNT)
+		assert(s.ordered)
+	assert(dropped > 0)
+	for s in healthy:
+		assert(manager.getDroppedEventCount(s.getChannel()) == 0)
+	manager.stop()
+	print "drop policy: OK"
+
+def test_disconnect():
+	(manager, healthy, stalled, duration) = dispatchEvents(Nodes.SendQueue.DISCONNECT, 48191)
+	print "disconnect policy: %d events of %d bytes to 50 subscribers in %.2fs" % (EVENT_COUNT, len(BODY), duration)
+	for s in healthy:
+		assert(s.received == EVENT_COUNT)
+		assert(s.ordered)
+		assert(not s.disconnected)
+	assert(stalled.isStalledDisconnected())
+	manager.stop()
+	print "disconnect policy: OK"
+
+def test():
+	test_drop()
+	test_disconnect()
+
+if __name__ == '__main__':
+	test()
@@ -0,0 +1,504 @@
+##
+# JobManager indexes and scheduler test tool.
+#
+# Checks that the waiting jobs are started on time, in order, once,
+# including when rescheduled, and measures the job lookups and scheduler
+# checks with 100000 jobs in the queue.
+#
+# Reference figures (Python 2.7.18, single-core Linux VM), 100000 complete
+# jobs and 100 waiting ones in the queue, before/after indexing them:
+# - getJobInfo(id): 45 ms / 4 us
+# - getWaitingRootJobs(): 320 ms / 55 us
+# - scheduler check: 300 ms / 3 us (was done every ts.jobscheduler.interval)
+#
+# Also checks the job queue persistence (snapshot and journal) and its
+# recovery after a crash. Reference figures: a state change, including its
+# journal record, costs 190 us with 1000 jobs in the queue, 250 us with
+# 100000 jobs; a snapshot of 100000 jobs takes 2.75s, written in background
+# when compacting the journal (a state change meanwhile: 14 ms at most).
+#
+# And the TE build cache: a change in a dependency invalidates its entries.
+# Reference figures: prepare() takes 74 ms when building the TE of a small
+# ATS with one dependency, 5.5 ms when cached.
+##
+
+import sys
+sys.path.append('../common')
+
+import ConfigManager
+import EventManager
+import FileSystemBackendManager
+import FileSystemManager
+import JobManager
+
+import copy_reg
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+
+cm = ConfigManager.instance()
+cm.register("ts.jobscheduler.interval", 1000, dynamic = True)
+cm.register("ts.jobqueue.compaction_threshold", 10000, dynamic = True)
+cm.register("testerman.var_root", "")
+cm.register("ts.te_build_cache.max_size", 100*1024*1024)
+# Used to build TEs
+cm.register("testerman.document_root", "/tmp")
+cm.register("tacs.ip", "127.0.0.1")
+cm.register("tacs.port", 8087)
+cm.register("interface.il.ip", "0.0.0.0")
+cm.register("interface.il.port", 8082)
+cm.register("ts.name", "test")
+cm.register("testerman.te.codec_paths", "")
+cm.register("testerman.te.probe_paths", "")
+cm.register("testerman.te.python.ttcn3module", "TestermanTTCN3")
+cm.register("testerman.te.log.max_payload_size", 64*1024)
+cm.read("../conf/language-apis.conf", autoRegister = True)
+cm.set_transient("ts.server_root", os.getcwd())
+cm.set_transient("constants.repository", "repository")
+# As JobManager.initialize() does
+copy_reg.pickle(threading._RLock, lambda x: (threading._RLock, (None,)))
+
+class NullEventManager:
+	"""
+	Discards the job event notifications.
+	"""
+	def dispatchNotification(self, notification):
+		pass
+
+EventManager.TheManager = NullEventManager()
+
+
+class TestJob(JobManager.Job):
+	"""
+	A job that records its start time.
+	"""
+	_type = "test"
+
+	def __init__(self, name, started = None):
+		JobManager.Job.__init__(self, name)
+		self.startTimes = []
+		self._started = started
+
+	def prepare(self):
+		self.setState(self.STATE_WAITING)
+
+	def run(self, inputSession = {}):
+		self.startTimes.append(time.time())
+		if self._started is not None:
+			self._started.append(self)
+		self.setState(self.STATE_RUNNING)
+		self.setState(self.STATE_COMPLETE)
+
+
+def createManager():
+	manager = JobManager.JobManager()
+	JobManager.TheJobManager = manager
+	return manager
+
+def restoreManager(directory):
+	"""
+	Creates a manager persisting its queue in directory,
+	restoring what it contains, as on a server (re)start.
+	"""
+	cm.set_actual("testerman.var_root", directory)
+	manager = createManager()
+	manager.restore()
+	return manager
+
+def getJournalSize(directory):
+	return os.stat(os.path.join(directory, 'jobqueue.journal')).st_size
+
+def waitCompaction(manager):
+	thread = manager._compactionThread
+	if thread:
+		thread.join()
+
+def fillQueue(manager, count):
+	"""
+	Registers count complete jobs.
+	"""
+	now = time.time()
+	for i in range(count):
+		job = TestJob('done%d' % i)
+		job._state = job.STATE_COMPLETE
+		job._startTime = now - 2.0
+		job._stopTime = now - 1.0
+		manager.registerJob(job)
+
+def test_scheduling():
+	"""
+	Jobs are started on time, in order of their scheduled start time.
+	"""
+	manager = createManager()
+	manager.start()
+	started = []
+	now = time.time()
+	jobs = []
+	for delay in [ 0.3, 0.1, 0.2, 0.5 ]:
+		job = TestJob('job', started)
+		job.setScheduledStartTime(now + delay)
+		manager.submitJob(job)
+		jobs.append(job)
+	# The last one is rescheduled earlier, the first one later
+	assert(jobs[3].reschedule(now + 0.15))
+	assert(jobs[0].reschedule(now + 0.4))
+	time.sleep(0.6)
+	manager.stop()
+	assert(started == [ jobs[1], jobs[3], jobs[2], jobs[0] ])
+	for job in jobs:
+		assert(len(job.startTimes) == 1)
+		assert(job.startTimes[0] - job.getScheduledStartTime() < 0.05)
+	assert(manager.getWaitingRootJobs() == [])
+	assert(len(manager.getJobsByState(JobManager.Job.STATE_COMPLETE)) == 4)
+	print "scheduling: OK"
+
+def test_large_queue():
+	"""
+	Lookups and scheduling with 100000 jobs in the queue.
+	"""
+	manager = createManager()
+	start = time.time()
+	fillQueue(manager, 100000)
+	print "100000 complete jobs registered in %.2fs" % (time.time() - start)
+	waiting = []
+	for i in range(100):
+		job = TestJob('waiting%d' % i)
+		job.setScheduledStartTime(time.time() + 3600 + i)
+		manager.submitJob(job)
+		waiting.append(job)
+
+	ids = [ waiting[i % 100].getId() for i in range(10000) ]
+	start = time.time()
+	for id_ in ids:
+		assert(manager.getJobInfo(id_)[0]['id'] == id_)
+	duration = time.time() - start
+	print "getJobInfo(id): %.1f us per call" % (duration * 100)
+
+	start = time.time()
+	for i in range(1000):
+		assert(len(manager.getWaitingRootJobs()) == 100)
+	duration = time.time() - start
+	print "getWaitingRootJobs(): %.1f us per call" % (duration * 1000)
+
+	start = time.time()
+	for i in range(10000):
+		(jobs, nextStartTime) = manager.popDueJobs(time.time())
+		assert(jobs == [])
+		assert(nextStartTime == waiting[0].getScheduledStartTime())
+	duration = time.time() - start
+	print "scheduler check: %.1f us per call" % (duration * 100)
+
+	# Purging the completed jobs keeps the waiting ones
+	assert(manager.purgeJobs(time.time()) == 100000)
+	assert(len(manager.getJobInfo()) == 100)
+	assert(manager.getJob(waiting[0].getId()) is waiting[0])
+	print "large queue: OK"
+
+def test_restore():
+	"""
+	The queue is restored from the journal after a crash,
+	including the job tree links and the purged jobs.
+	"""
+	directory = tempfile.mkdtemp()
+	manager = restoreManager(directory)
+	campaign = TestJob('campaign')
+	child = TestJob('child')
+	campaign.addChild(child, JobManager.Job.BRANCH_SUCCESS)
+	campaign.setScheduledStartTime(time.time() + 3600)
+	manager.submitJob(campaign)
+	manager.registerJob(child)
+	child.setState(child.STATE_RUNNING)
+	complete = TestJob('complete')
+	manager.submitJob(complete)
+	complete.setResult(0)
+	complete.setState(complete.STATE_COMPLETE)
+	purged = TestJob('purged')
+	manager.submitJob(purged)
+	purged.setState(purged.STATE_COMPLETE)
+	purged._stopTime = time.time() - 10.0
+	assert(manager.purgeJobs(time.time() - 5.0) == 1)
+	assert(campaign.reschedule(time.time() + 7200))
+	assert(getJournalSize(directory) > 0)
+	# No persist(): crash
+
+	restored = restoreManager(directory)
+	assert([ job.getName() for job in restored._jobQueue ] == [ 'campaign', 'child', 'complete' ])
+	rCampaign = restored.getJob(campaign.getId())
+	rChild = restored.getJob(child.getId())
+	rComplete = restored.getJob(complete.getId())
+	assert(rCampaign.getState() == JobManager.Job.STATE_WAITING)
+	assert(rCampaign.getScheduledStartTime() == campaign.getScheduledStartTime())
+	assert(rChild.getState() == JobManager.Job.STATE_CRASHED)
+	assert(rChild.getParent() is rCampaign)
+	assert(rCampaign._childBranches[JobManager.Job.BRANCH_SUCCESS] == [ rChild ])
+	assert(rComplete.getState() == JobManager.Job.STATE_COMPLETE)
+	assert(rComplete.getResult() == 0)
+	assert(rComplete._stopTime == complete._stopTime)
+	assert(restored.getJob(purged.getId()) is None)
+	assert(restored.popDueJobs(time.time() + 7201)[0] == [ rCampaign ])
+	assert(JobManager.getNewId() > complete.getId())
+	# Restarted from a snapshot
+	assert(getJournalSize(directory) == 0)
+
+	# And once more, with the crashed state coming from the snapshot
+	restored = restoreManager(directory)
+	assert(restored.getJob(child.getId()).getState() == JobManager.Job.STATE_CRASHED)
+	assert(restored.getJob(child.getId()).getParent() is restored.getJob(campaign.getId()))
+	shutil.rmtree(directory)
+	print "restore: OK"
+
+def test_torn_record():
+	"""
+	A record partially written, or corrupted, ends the journal.
+	"""
+	directory = tempfile.mkdtemp()
+	manager = restoreManager(directory)
+	jobs = []
+	for i in range(3):
+		job = TestJob('job%d' % i)
+		manager.submitJob(job)
+		jobs.append(job)
+	size = getJournalSize(directory)
+	jobs[2].setState(JobManager.Job.STATE_COMPLETE)
+	# Corrupt the last record (one byte of its payload)
+	f = open(os.path.join(directory, 'jobqueue.journal'), 'r+b')
+	f.seek(-1, 2)
+	c = f.read(1)
+	f.seek(-1, 2)
+	f.write(chr(ord(c) ^ 0xff))
+	f.close()
+	manager._store.close()
+	restored = restoreManager(directory)
+	assert([ job.getState() for job in restored._jobQueue ] == [ JobManager.Job.STATE_WAITING ] * 3)
+
+	# Crash in the middle of a record
+	job = TestJob('job3')
+	restored.submitJob(job)
+	restored._store.close()
+	f = open(os.path.join(directory, 'jobqueue.journal'), 'r+b')
+	f.truncate(getJournalSize(directory) - 5)
+	f.close()
+	restored = restoreManager(directory)
+	assert(len(restored._jobQueue) == 4)
+	# Registered, but not prepared
+	assert(restored.getJob(job.getId()).getState() == JobManager.Job.STATE_CRASHED)
+	# The journal was truncated after its last valid record: new records are readable
+	job = TestJob('job4')
+	restored.submitJob(job)
+	restored._store.close()
+	restored = restoreManager(directory)
+	assert(restored.getJob(job.getId()).getState() == JobManager.Job.STATE_WAITING)
+	shutil.rmtree(directory)
+	print "torn record: OK"
+
+def test_compaction():
+	"""
+	The journal is compacted after ts.jobqueue.compaction_threshold records.
+	A crash during a compaction loses nothing.
+	"""
+	directory = tempfile.mkdtemp()
+	cm.set_actual("ts.jobqueue.compaction_threshold", 10)
+	manager = restoreManager(directory)
+	for i in range(12):
+		job = TestJob('job%d' % i)
+		manager.submitJob(job)
+		waitCompaction(manager)
+	# 24 records: compacted after the 10th and the 20th ones
+	assert(manager._store.getJournalRecordCount() == 4)
+	assert(not os.path.isfile(os.path.join(directory, 'jobqueue.journal.previous')))
+
+	# Crash before the new snapshot was renamed
+	snapshot = open(os.path.join(directory, 'jobqueue.dump'), 'rb').read()
+	open(os.path.join(directory, 'jobqueue.dump.tmp'), 'wb').write(snapshot[:len(snapshot) / 2])
+	manager._store.close()
+	restored = restoreManager(directory)
+	assert([ job.getName() for job in restored._jobQueue ] == [ 'job%d' % i for i in range(12) ])
+
+	# Crash after the snapshot was renamed, before the journal was reset
+	for job in restored._jobQueue[:5]:
+		job.setState(JobManager.Job.STATE_COMPLETE)
+	journal = open(os.path.join(directory, 'jobqueue.journal'), 'rb').read()
+	restored.persist()
+	restored._store.close()
+	assert(getJournalSize(directory) == 0)
+	open(os.path.join(directory, 'jobqueue.journal'), 'wb').write(journal)
+	restored = restoreManager(directory)
+	assert([ job.getName() for job in restored._jobQueue ] == [ 'job%d' % i for i in range(12) ])
+	assert([ job.getState() for job in restored._jobQueue ] == [ JobManager.Job.STATE_COMPLETE ] * 5 + [ JobManager.Job.STATE_WAITING ] * 7)
+
+	# Crash after the journal was rotated, before the new snapshot was written,
+	# with records appended meanwhile
+	seq = restored._store.rotate()
+	for job in restored._jobQueue[5:8]:
+		job.setState(JobManager.Job.STATE_COMPLETE)
+	restored._store.close()
+	restored = restoreManager(directory)
+	assert([ job.getState() for job in restored._jobQueue ] == [ JobManager.Job.STATE_COMPLETE ] * 8 + [ JobManager.Job.STATE_WAITING ] * 4)
+	assert(not os.path.isfile(os.path.join(directory, 'jobqueue.journal.previous')))
+	# ... and with an older snapshot written after a more recent one
+	seq = restored._store.rotate()
+	queue = restored._jobQueue[:]
+	restored._jobQueue[8].setState(JobManager.Job.STATE_COMPLETE)
+	restored.persist()
+	restored._store.writeSnapshot(seq, queue)
+	restored._store.close()
+	restored = restoreManager(directory)
+	assert([ job.getState() for job in restored._jobQueue ] == [ JobManager.Job.STATE_COMPLETE ] * 9 + [ JobManager.Job.STATE_WAITING ] * 3)
+	restored._store.close()
+	cm.set_actual("ts.jobqueue.compaction_threshold", 10000)
+	shutil.rmtree(directory)
+	print "compaction: OK"
+
+def test_persistence_cost():
+	"""
+	The cost of persisting a state change does not depend on the queue size.
+	"""
+	cm.set_actual("ts.jobqueue.compaction_threshold", 1000000)
+	for count in [ 1000, 100000 ]:
+		directory = tempfile.mkdtemp()
+		manager = restoreManager(directory)
+		fillQueue(manager, count)
+		manager.persist()
+		jobs = [ TestJob('job%d' % i) for i in range(1000) ]
+		for job in jobs:
+			manager.registerJob(job)
+		start = time.time()
+		for job in jobs:
+			job.setState(JobManager.Job.STATE_WAITING)
+		duration = time.time() - start
+		start = time.time()
+		manager.persist()
+		print "%d jobs in the queue: %.0f us per state change (including the journal record), %.2fs per snapshot" % (count, duration * 1000, time.time() - start)
+		# Compacted in background: the state changes do not wait for the snapshot
+		cm.set_actual("ts.jobqueue.compaction_threshold", 500)
+		durations = []
+		for job in jobs:
+			start = time.time()
+			job.setState(JobManager.Job.STATE_COMPLETE)
+			durations.append(time.time() - start)
+		waitCompaction(manager)
+		print "%d jobs in the queue: %.1f ms max per state change, journal compacted meanwhile" % (count, max(durations) * 1000)
+		cm.set_actual("ts.jobqueue.compaction_threshold", 1000000)
+		manager._store.close()
+		shutil.rmtree(directory)
+	cm.set_actual("ts.jobqueue.compaction_threshold", 10000)
+
+ATS = """# __METADATA__BEGIN__
+# <?xml version="1.0" encoding="utf-8" ?>
+# <metadata version="1.0">
+# <description>TE build cache test</description>
+# <prerequisites></prerequisites>
+# <api>1</api>
+# <parameters>
+# </parameters>
+# </metadata>
+# __METADATA__END__
+import mylib
+
+class TC_VERDICT(TestCase):
+	def body(self):
+		setverdict(mylib.VERDICT)
+
+TC_VERDICT().execute()
+"""
+
+def setUpRepository(directory):
+	"""
+	Mounts directory as the document root, with an ATS and the userland
+	module it imports.
+	"""
+	os.makedirs(os.path.join(directory, 'docroot', 'repository', 'samples'))
+	open(os.path.join(directory, 'docroot', 'repository', 'samples', 'cached.ats'), 'w').write(ATS)
+	open(os.path.join(directory, 'docroot', 'repository', 'samples', 'mylib.py'), 'w').write('VERDICT = "pass"\n')
+	cm.set_actual("testerman.document_root", os.path.join(directory, 'docroot'))
+	cm.set_actual("testerman.var_root", os.path.join(directory, 'var'))
+	FileSystemManager.TheFileSystemManager = FileSystemManager.FileSystemManager()
+	FileSystemBackendManager.scanFileSystemBackends()
+	FileSystemBackendManager.mountRoot()
+
+def prepareAtsJob():
+	"""
+	Returns the content of mylib in the prepared egg, and its inode.
+	"""
+	job = JobManager.AtsJob('samples/cached', ATS, '/repository/samples/cached.ats')
+	job.prepare()
+	assert(job.getState() == job.STATE_WAITING)
+	eggFilename = os.path.join(job._tePreparedPackageDirectory, 'ats.egg')
+	egg = zipfile.ZipFile(eggFilename)
+	ret = (egg.read('ats/repository/samples/mylib.py'), os.stat(eggFilename).st_ino)
+	egg.close()
+	shutil.rmtree(job._tePreparedPackageDirectory)
+	return ret
+
+def test_te_build_cache():
+	"""
+	A TE is built once, until one of its dependencies changes.
+	"""
+	directory = tempfile.mkdtemp()
+	setUpRepository(directory)
+	createManager()
+	cache = JobManager.getTeBuildCache()
+
+	(content, inode) = prepareAtsJob()
+	assert(content.endswith('VERDICT = "pass"\n'))
+	assert(cache.getStatistics()['misses'] == 1)
+	start = time.time()
+	for i in range(10):
+		assert(prepareAtsJob() == (content, inode))
+	print "cached TE: %.1f ms per prepare" % ((time.time() - start) * 100)
+	assert(cache.getStatistics()['hits'] == 10)
+
+	# Changing the dependency invalidates the cached TE
+	open(os.path.join(directory, 'docroot', 'repository', 'samples', 'mylib.py'), 'w').write('VERDICT = "fail"\n')
+	start = time.time()
+	(newContent, newInode) = prepareAtsJob()
+	print "built TE: %.1f ms per prepare" % ((time.time() - start) * 1000)
+	assert(newContent.endswith('VERDICT = "fail"\n'))
+	assert(newInode != inode)
+	stats = cache.getStatistics()
+	assert(stats['misses'] == 2)
+	assert(stats['entries'] == 2)
+	assert(prepareAtsJob() == (newContent, newInode))
+	shutil.rmtree(directory)
+	print "TE build cache: OK"
+
+def test_te_build_cache_eviction():
+	"""
+	The least recently used entries are evicted.
+	"""
+	directory = tempfile.mkdtemp()
+	cache = JobManager.TeBuildCache(os.path.join(directory, 'cache'), 3000)
+	for key in [ 'a', 'b', 'c' ]:
+		open(os.path.join(directory, key), 'w').write(key * 1000)
+		cache.put(key, os.path.join(directory, key))
+		time.sleep(0.01)
+	assert(cache.get('a', os.path.join(directory, 'a.copy')))
+	open(os.path.join(directory, 'd'), 'w').write('d' * 1000)
+	cache.put('d', os.path.join(directory, 'd'))
+	assert(not cache.get('b', os.path.join(directory, 'b.copy')))
+	assert(cache.getStatistics() == { 'hits': 1, 'misses': 1, 'evictions': 1, 'entries': 3, 'size': 3000 })
+	# The copies are not affected by the evictions
+	assert(open(os.path.join(directory, 'a.copy')).read() == 'a' * 1000)
+	# Entries are kept across restarts
+	cache = JobManager.TeBuildCache(os.path.join(directory, 'cache'), 2000)
+	assert(cache.getStatistics()['entries'] == 2)
+	assert(cache.get('d', os.path.join(directory, 'd.copy')))
+	shutil.rmtree(directory)
+	print "TE build cache eviction: OK"
+
+def test():
+	test_scheduling()
+	test_large_queue()
+	test_restore()
+	test_torn_record()
+	test_compaction()
+	test_persistence_cost()
+	test_te_build_cache()
+	test_te_build_cache_eviction()
+
+if __name__ == '__main__':
+	test()
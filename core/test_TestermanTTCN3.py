@@ -0,0 +1,142 @@
+##
+# Template matchers cache and alt() notifiers test tool.
+#
+# Checks that a template modified in place after being matched is
+# recompiled, and that one-shot templates do not evict the cached ones.
+#
+# Then checks that the PTCs that ended are no longer notified
+# by the system queue.
+#
+# Reference figures (Python 2.7.18, single-core Linux VM), SIP-sized
+# dict template (see samples/testerman/template_match_perf.ats):
+# - cached matcher: 40 us/match, including 17 us to check the template contents
+# - compiled at each match: 80 us/match
+##
+
+import sys
+sys.path.append('../common')
+
+import TestermanPA
+import TestermanTCI
+import TestermanTTCN3 as T
+
+import time
+
+
+def mw_invite():
+	return {
+		'method': 'INVITE', 'uri': T.pattern('^sip:bob@'), 'version': 'SIP/2.0',
+		'headers': {
+			'via': [ T.any_or_none(), T.pattern('branch=z9hG4bK') ], 'max-forwards': T.any(), 'to': T.pattern('bob'), 'from': T.any(),
+			'call-id': T.any(), 'cseq': T.pattern('INVITE$'), 'contact': T.any(), 'content-type': 'application/sdp',
+			'route': T.omit(), 'content-length': T.any(),
+		},
+		'body': T.any_or_none(),
+	}
+
+def m_invite():
+	return {
+		'method': 'INVITE', 'uri': 'sip:bob@biloxi.example.com', 'version': 'SIP/2.0',
+		'headers': {
+			'via': [ 'SIP/2.0/UDP pc33.atlanta.example.com;branch=z9hG4bK776asdhds', 'SIP/2.0/UDP 10.0.0.1;branch=z9hG4bK4b43c2ff8.1' ],
+			'max-forwards': '70', 'to': 'Bob <sip:bob@biloxi.example.com>', 'from': 'Alice <sip:alice@atlanta.example.com>;tag=1928301774',
+			'call-id': 'a84b4c76e66710@pc33.atlanta.example.com', 'cseq': '314159 INVITE', 'contact': '<sip:alice@pc33.atlanta.example.com>',
+			'content-type': 'application/sdp', 'content-length': '142',
+		},
+		'body': 'v=0\r\n',
+	}
+
+
+def test_modified_template():
+	"""
+	A template modified in place is matched according to its new contents.
+	"""
+	t = { 'a': 1, 'b': [ 1, 2 ], 'c': ('x', { 'd': 'e' }) }
+	message = { 'a': 1, 'b': [ 1, 2 ], 'c': ('x', { 'd': 'e' }) }
+	for i in range(3):
+		assert(T.templateMatch(message, t)[0])
+	t['a'] = 5
+	assert(not T.templateMatch(message, t)[0])
+	assert(T.templateMatch({ 'a': 5, 'b': [ 1, 2 ], 'c': ('x', { 'd': 'e' }) }, t)[0])
+	t['a'] = 1
+	assert(T.templateMatch(message, t)[0])
+	# Nested modifications
+	t['b'].append(3)
+	assert(not T.templateMatch(message, t)[0])
+	t['b'].pop()
+	t['c'][1]['d'] = T.pattern('^f')
+	assert(not T.templateMatch(message, t)[0])
+	del t['c']
+	assert(T.templateMatch(message, t)[0])
+	print "modified template: OK"
+
+def test_one_shot_templates():
+	"""
+	Templates used once are not cached, and do not evict the others.
+	"""
+	template = mw_invite()
+	message = m_invite()
+	T.templateMatch(message, template)
+	T.templateMatch(message, template)
+	assert(T._TemplateMatchers.has_key(id(template)))
+	size = len(T._TemplateMatchers)
+	# Kept referenced, so that their ids are not reused
+	templates = [ { 'a': i } for i in range(3 * T._TemplateMatchersMaxSize) ]
+	for t in templates:
+		assert(T.templateMatch({ 'a': 1 }, t)[0] == (t['a'] == 1))
+	assert(len(T._TemplateMatchers) == size)
+	assert(T._TemplateMatchers.has_key(id(template)))
+	print "one-shot templates: OK"
+
+def measure(fn, count):
+	start = time.time()
+	for i in range(count):
+		fn()
+	return (time.time() - start) / count
+
+def test_performance():
+	template = mw_invite()
+	message = m_invite()
+	assert(T.templateMatch(message, template)[0])
+	d = measure(lambda: T.templateMatch(message, template), 10000)
+	print "cached matcher: %.1f us/match" % (d * 1000000)
+	d = measure(lambda: T._getTemplateSignature(template), 10000)
+	print "template contents check: %.1f us" % (d * 1000000)
+	d = measure(lambda: T._compileTemplate(template)(message, u'template'), 10000)
+	print "compiled at each match: %.1f us/match" % (d * 1000000)
+
+class Waiter(T.Behaviour):
+	def body(self):
+		t = T.Timer(0.01)
+		t.start()
+		T.alt([[ t.TIMEOUT ]])
+
+class TC_PTC_LISTENERS(T.TestCase):
+	def body(self, listeners):
+		for i in range(50):
+			ptc = self.create()
+			ptc.start(Waiter())
+			T.alt([[ ptc.DONE ]])
+		listeners.append(len(T._getSystemQueue()._listeners))
+
+def test_ptc_listeners():
+	"""
+	The notifiers of the ended PTCs are unregistered from the system queue.
+	"""
+	TestermanTCI.initialize('/dev/null')
+	TestermanTCI.disableLogs()
+	TestermanPA.initialize()
+	listeners = []
+	TC_PTC_LISTENERS().execute(listeners = listeners)
+	# The MTC only
+	assert(listeners == [ 1 ])
+	print "PTC listeners: OK"
+
+def test():
+	test_modified_template()
+	test_one_shot_templates()
+	test_performance()
+	test_ptc_listeners()
+
+if __name__ == '__main__':
+	test()
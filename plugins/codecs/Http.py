@@ -32,6 +32,165 @@ def chunk(body):
 	return "%x\r\n%s\r\n0\r\n" % (len(body), body)
 
 
+class HttpDecodingSession(CodecManager.DecodingSession):
+	"""
+	Stateful decoding session, common to HTTP requests and responses.
+	
+	The message is parsed as the data are fed: the start and header lines
+	once they are complete, then the body (or its chunks) whose parts are
+	only joined once the message is complete.
+	
+	As with the stateless decoders, the data received after the end of
+	a message (in the same segment) are dropped.
+	"""
+	# Parsing states
+	START_LINE = 0
+	HEADERS = 1
+	BODY = 2 # up to the content-length, or up to the end of the stream
+	CHUNK_SIZE = 3
+	CHUNK_DATA = 4
+	CHUNK_BOUNDARY = 5
+
+	def __init__(self, codec):
+		CodecManager.DecodingSession.__init__(self, codec)
+		self.reset()
+	
+	def feed(self, data):
+		if data:
+			self._received.append(data)
+			self._pending.append(data)
+
+	def hasData(self):
+		return self._received != []
+	
+	def reset(self):
+		self._received = [] # raw data of the current message
+		self._pending = [] # fed data, not parsed yet
+		self._state = self.START_LINE
+		self._message = None
+		self._body = []
+		self._remaining = None # body or chunk bytes still expected, if known
+
+	def decodeNext(self, complete):
+		data = ''.join(self._pending)
+		self._pending = []
+		pos = 0
+		while 1:
+			if self._state in (self.START_LINE, self.HEADERS, self.CHUNK_SIZE):
+				end = data.find('\r\n', pos)
+				if end < 0:
+					break
+				line = data[pos:end]
+				pos = end + 2
+				if self._state == self.START_LINE:
+					self._message = self.decodeStartLine(line)
+					self._message['headers'] = {}
+					self._state = self.HEADERS
+				elif self._state == self.HEADERS:
+					if not line:
+						self._startBody()
+						continue
+					l = line.strip()
+					m = HEADERLINE_REGEXP.match(l)
+					if m:
+						self._message['headers'][m.group('header').lower()] = m.group('value')
+					else:
+						raise Exception("Invalid header in message (%s)" % str(l))
+				else:
+					chunkSize = int(line.strip(), 16)
+					if chunkSize == 0:
+						return self._decoded()
+					self._remaining = chunkSize
+					self._state = self.CHUNK_DATA
+
+			elif self._state == self.CHUNK_BOUNDARY:
+				if len(data) - pos < 2:
+					break
+				if data[pos:pos+2] != '\r\n':
+					raise Exception("No chunk boundary at the end of the chunk. Invalid data.")
+				pos += 2
+				self._state = self.CHUNK_SIZE
+			
+			elif self._remaining is None:
+				# Body without length: up to the end of the stream
+				self._body.append(data[pos:])
+				pos = len(data)
+				if self.isCompleteWithoutLength(self._message, complete):
+					return self._decoded()
+				break
+			
+			else:
+				# Body with content-length, or chunk data
+				part = data[pos:pos+self._remaining]
+				self._body.append(part)
+				pos += len(part)
+				self._remaining -= len(part)
+				if self._remaining:
+					break
+				if self._state == self.BODY:
+					return self._decoded()
+				self._state = self.CHUNK_BOUNDARY
+
+		if pos < len(data):
+			self._pending.append(data[pos:])
+		return self.needMoreData()
+
+	def _startBody(self):
+		headers = self._message['headers']
+		if headers.get('transfer-encoding', None) == 'chunked':
+			self._state = self.CHUNK_SIZE
+		else:
+			self._state = self.BODY
+			contentLength = headers.get('content-length', None)
+			if contentLength is not None:
+				self._remaining = int(contentLength)
+	
+	def _decoded(self):
+		message = self._message
+		message['body'] = ''.join(self._body)
+		payload = ''.join(self._received)
+		self.reset()
+		return self.decoded(message, self.getCodec().getSummary(message), payload)
+
+	# To reimplement for requests/responses
+	def decodeStartLine(self, line):
+		"""
+		Returns the message dict initialized from the request or status line.
+		"""
+		raise Exception("Not implemented")
+
+	def isCompleteWithoutLength(self, message, complete):
+		"""
+		Tells if a message without content-length nor chunked transfer-encoding
+		is complete, with the body received so far.
+		"""
+		raise Exception("Not implemented")
+
+
+class HttpRequestDecodingSession(HttpDecodingSession):
+	def decodeStartLine(self, line):
+		m = REQUESTLINE_REGEXP.match(line)
+		if not m:
+			raise Exception("Invalid request line (%s)"% line)
+		return { 'method': m.group('method'), 'url': m.group('url'), 'version': m.group('version') }
+
+	def isCompleteWithoutLength(self, message, complete):
+		# The body is what was received with the headers
+		return True
+
+
+class HttpResponseDecodingSession(HttpDecodingSession):
+	def decodeStartLine(self, line):
+		m = STATUSLINE_REGEXP.match(line)
+		if not m:
+			raise Exception("Invalid status line")
+		return { 'version': m.group('version'), 'status': int(m.group('status')), 'reason': m.group('reason') }
+
+	def isCompleteWithoutLength(self, message, complete):
+		# Maybe this is normal (204, 304 and 1xx) or we wait until the end of the connection
+		return complete or message['status'] in [204, 304] or message['status'] <= 199
+
+
 class HttpRequestCodec(CodecManager.IncrementalCodec):
 	"""
 	= Identification and Properties =
@@ -60,7 +219,8 @@ class HttpRequestCodec(CodecManager.IncrementalCodec):
 	
 	...
 	
-	This is an incremental decoder.
+	This is an incremental decoder, with a stateful decoding session
+	for streams (only analyzing the newly received data).
 
 	It automatically waits for a complete payload before passing it to
 	your application, supporting content-length header (if present)
@@ -255,6 +415,9 @@ class HttpRequestCodec(CodecManager.IncrementalCodec):
 		
 		return self.decoded(ret, self.getSummary(ret))
 
+	def createDecodingSession(self):
+		return HttpRequestDecodingSession(self)
+
 	def getSummary(self, template):
 		"""
 		Returns the summary of the template representing an RTSP message.
@@ -293,7 +456,8 @@ class HttpResponseCodec(CodecManager.IncrementalCodec):
 	
 	...
 	
-	This is an incremental decoder.
+	This is an incremental decoder, with a stateful decoding session
+	for streams (only analyzing the newly received data).
 
 	It automatically waits for a complete payload before passing it to
 	your application, supporting content-length header (if present)
@@ -488,6 +652,9 @@ class HttpResponseCodec(CodecManager.IncrementalCodec):
 		
 		return self.decoded(ret, self.getSummary(ret))
 
+	def createDecodingSession(self):
+		return HttpResponseDecodingSession(self)
+
 	def getSummary(self, template):
 		"""
 		Returns the summary of the template representing an RTSP message.
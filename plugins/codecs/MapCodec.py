@@ -15,47 +15,46 @@
 
 ##
 # MAP (2+) Codec
-# To compile MapAsn: cd ber && ./py_output.py asn/AMP-All.asn > MapAsn.py
+# To compile MapAsn: cd ber && ./py_output.py --implicit --spec=MapAsn.spec asn/MAP-All.asn > MapAsn.py
 ##
 
 import CodecManager
 
 import ber.BerCodec as BerCodec
-import ber.MapAsn as MapAsn
 
 # SMS management: SRI and MT Forward
 class RoutingInfoForSM_ArgCodec(BerCodec.BerCodec):
-	PDU = MapAsn.RoutingInfoForSM_Arg
+	PDU = 'MapAsn.RoutingInfoForSM_Arg'
 	def getSummary(self, message): return 'RoutingInfoForSM-Arg'
 CodecManager.registerCodecClass('map.RoutingInfoForSM-Arg', RoutingInfoForSM_ArgCodec)
 
 class RoutingInfoForSM_ResCodec(BerCodec.BerCodec):
-	PDU = MapAsn.RoutingInfoForSM_Res
+	PDU = 'MapAsn.RoutingInfoForSM_Res'
 	def getSummary(self, message): return 'RoutingInfoForSM-Res'
 CodecManager.registerCodecClass('map.RoutingInfoForSM-Res', RoutingInfoForSM_ResCodec)
 
 class MT_ForwardSM_ArgCodec(BerCodec.BerCodec):
-	PDU = MapAsn.MT_ForwardSM_Arg
+	PDU = 'MapAsn.MT_ForwardSM_Arg'
 	def getSummary(self, message): return 'MT-ForwardSM-Arg'
 CodecManager.registerCodecClass('map.MT-ForwardSM-Arg', MT_ForwardSM_ArgCodec)
 
 class MT_ForwardSM_ResCodec(BerCodec.BerCodec):
-	PDU = MapAsn.MT_ForwardSM_Res
+	PDU = 'MapAsn.MT_ForwardSM_Res'
 	def getSummary(self, message): return 'MT-ForwardSM-Res'
 CodecManager.registerCodecClass('map.MT-ForwardSM-Res', MT_ForwardSM_ResCodec)
 
 class MO_ForwardSM_ArgCodec(BerCodec.BerCodec):
-	PDU = MapAsn.MO_ForwardSM_Arg
+	PDU = 'MapAsn.MO_ForwardSM_Arg'
 	def getSummary(self, message): return 'MO-ForwardSM-Arg'
 CodecManager.registerCodecClass('map.MO-ForwardSM-Arg', MO_ForwardSM_ArgCodec)
 
 class MO_ForwardSM_ResCodec(BerCodec.BerCodec):
-	PDU = MapAsn.MO_ForwardSM_Res
+	PDU = 'MapAsn.MO_ForwardSM_Res'
 	def getSummary(self, message): return 'MO-ForwardSM-Res'
 CodecManager.registerCodecClass('map.MO-ForwardSM-Res', MO_ForwardSM_ResCodec)
 
 class MAP_DialoguePDUCodec(BerCodec.BerCodec):
-	PDU = MapAsn.MAP_DialoguePDU
+	PDU = 'MapAsn.MAP_DialoguePDU'
 	def getSummary(self, message): return 'MAP-DialoguePDU'
 CodecManager.registerCodecClass('map.MAP-DialoguePDU', MAP_DialoguePDUCodec)
 
@@ -876,6 +876,96 @@ def encodeMessage(p):
 	return '\r\n'.join(ret)
 
 
+##
+# Stream decoding (SIP over TCP)
+##
+
+class SipDecodingSession(CodecManager.DecodingSession):
+	"""
+	Stateful decoding session, identifying SIP messages in a stream:
+	waits for the end of the headers, then for Content-Length body bytes.
+	Without Content-Length header, the body is empty on a stream (the header
+	is mandatory on stream transports, RFC 3261 18.3), or extends to the end
+	of the data when they are complete (datagrams).
+
+	The headers are searched for in the new data only, and the body parts
+	are only joined once the message is complete.
+	The data received after a message are kept for the next one.
+	Empty lines between messages (CRLF keep-alives) are skipped.
+	"""
+	def __init__(self, codec):
+		CodecManager.DecodingSession.__init__(self, codec)
+		self.reset()
+	
+	def feed(self, data):
+		if data:
+			self._pending.append(data)
+
+	def hasData(self):
+		return self._pending != [] or self._headers is not None
+	
+	def reset(self):
+		self._pending = [] # fed data, not parsed yet
+		self._searchFrom = 0 # where to search for the end of the headers in the pending data
+		self._headers = None # raw start line and headers, including the empty line
+		self._contentLength = None
+		self._body = []
+		self._bodyLength = 0
+
+	def decodeNext(self, complete):
+		data = ''.join(self._pending)
+		self._pending = []
+
+		if self._headers is None:
+			start = 0
+			while data.startswith('\r\n', start):
+				start += 2
+			if start:
+				data = data[start:]
+				self._searchFrom = 0
+			end = data.find('\r\n\r\n', self._searchFrom)
+			if end < 0:
+				if data:
+					self._pending.append(data)
+					self._searchFrom = max(0, len(data) - 3)
+				return self.needMoreData()
+			self._headers = data[:end+4]
+			for line in self._headers.split('\r\n')[1:]:
+				if line and not line[0] in ' \t' and ':' in line:
+					(fieldName, value) = line.split(':', 1)
+					if fieldNameToName(fieldName.strip()) == 'ContentLength':
+						try:
+							self._contentLength = int(value.strip())
+						except ValueError:
+							return self.decodingError()
+			data = data[end+4:]
+
+		if self._contentLength is None:
+			if complete:
+				# Up to the end of the datagram
+				self._body.append(data)
+				data = ''
+		else:
+			part = data[:self._contentLength - self._bodyLength]
+			self._body.append(part)
+			self._bodyLength += len(part)
+			data = data[len(part):]
+			if self._bodyLength < self._contentLength:
+				return self.needMoreData()
+
+		payload = self._headers + ''.join(self._body)
+		self.reset()
+		if data:
+			self._pending.append(data)
+		try:
+			(message, summary) = self.getCodec().decode(payload)
+		except Exception:
+			return self.decodingError()
+		if message is None:
+			return self.decodingError()
+		return self.decoded(message, summary, payload)
+
+
 ##
 # The Testerman codec interface to the codec
 ##
@@ -887,6 +977,9 @@ class SipCodec(CodecManager.Codec):
 	def decode(self, data):
 		return (decodeMessage(data), 'SIP message')
 
+	def createDecodingSession(self):
+		return SipDecodingSession(self)
+
 if __name__ != '__main__':
 	CodecManager.registerCodecClass('sip', SipCodec)
 
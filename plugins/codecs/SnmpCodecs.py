@@ -15,14 +15,12 @@
 
 ##
 # SNMP v1 codecs.
-# To compile Snmpv1Asn: ./py_output.py --explicit asn/RFC1157-SMI.asn > Snmpv1Asn.py
+# To compile Snmpv1Asn: ./py_output.py --explicit --spec=Snmpv1Asn.spec asn/RFC1157-SMI.asn > Snmpv1Asn.py
 ##
 
 import CodecManager
 
 import ber.BerCodec as BerCodec
-import ber.Snmpv1Asn as Snmpv1Asn
-import ber.Snmpv2cAsn as Snmpv2cAsn
 
 class Snmpv1Codec(BerCodec.BerCodec):
 	"""
@@ -56,7 +54,7 @@ class Snmpv1Codec(BerCodec.BerCodec):
 	The mapping between ASN.1 and Testerman structures is documented [Asn1ToTesterman here].
 
 	"""
-	PDU = Snmpv1Asn.Message
+	PDU = 'Snmpv1Asn.Message'
 
 	def getSummary(self, message):
 		try:
@@ -100,7 +98,7 @@ class Snmpv2cCodec(BerCodec.BerCodec):
 	The mapping between ASN.1 and Testerman structures is documented [Asn1ToTesterman here].
 
 	"""
-	PDU = Snmpv2cAsn.Message
+	PDU = 'Snmpv2cAsn.Message'
 
 	def getSummary(self, message):
 		try:
@@ -238,16 +238,7 @@ class SoapDigitalSignatureCodec(CodecManager.Codec):
 		if not isinstance(template, basestring):
 			raise Exception('This codec requires a string')
 		
-		pemcert = self.getProperty('signing_certificate')
-		if not pemcert:
-			pemcert = DEFAULT_SIGNING_CERTIFICATE
-		pemkey = self.getProperty('signing_key')
-		if not pemkey:
-			pemkey = DEFAULT_SIGNING_PRIVATE_KEY
-		cert, ski = SoapSecurity.loadCertFromPem(pemcert)
-		privkey = SoapSecurity.loadKeyFromPem(pemkey)
-		
-		self.log("Signing certificate & private keys loaded")
+		(cert, privkey) = self._getSigningCredentials()
 		doc = libxml2.parseDoc(template)
 		# Sign the body only
 		xpc = doc.xpathNewContext()
@@ -273,13 +264,7 @@ class SoapDigitalSignatureCodec(CodecManager.Codec):
 		"""
 		doc = libxml2.parseDoc(data)
 		
-		certificates = self.getProperty("expected_certificates", [ DEFAULT_SIGNING_CERTIFICATE ])
-		certificatesDb = {}
-		for c in certificates:
-			cert, ski = SoapSecurity.loadCertFromPem(c)
-			certificatesDb[ski] = cert
-		
-		cert = SoapSecurity.verifyMessage(doc, certificatesDb = certificatesDb)
+		cert = SoapSecurity.verifyMessage(doc, certificatesDb = self._getCertificatesDb())
 		
 		if not cert:
 			raise Exception("This message has not been signed by the claimed party.")
@@ -289,6 +274,32 @@ class SoapDigitalSignatureCodec(CodecManager.Codec):
 		ret['signedBy'] = ('certificate', cert.as_pem().strip())			
 		return (ret, "XML data verified as signed by '%s'" % cert.get_subject().as_text())
 
+	# The codec instance is reused with the same properties:
+	# certificates and keys are only loaded once.
+	def _getSigningCredentials(self):
+		if getattr(self, '_signingCredentials', None) is None:
+			pemcert = self.getProperty('signing_certificate')
+			if not pemcert:
+				pemcert = DEFAULT_SIGNING_CERTIFICATE
+			pemkey = self.getProperty('signing_key')
+			if not pemkey:
+				pemkey = DEFAULT_SIGNING_PRIVATE_KEY
+			cert, ski = SoapSecurity.loadCertFromPem(pemcert)
+			privkey = SoapSecurity.loadKeyFromPem(pemkey)
+			self.log("Signing certificate & private keys loaded")
+			self._signingCredentials = (cert, privkey)
+		return self._signingCredentials
+
+	def _getCertificatesDb(self):
+		if getattr(self, '_certificatesDb', None) is None:
+			certificates = self.getProperty("expected_certificates", [ DEFAULT_SIGNING_CERTIFICATE ])
+			certificatesDb = {}
+			for c in certificates:
+				cert, ski = SoapSecurity.loadCertFromPem(c)
+				certificatesDb[ski] = cert
+			self._certificatesDb = certificatesDb
+		return self._certificatesDb
+
 	
 
 CodecManager.registerCodecClass('soap11.ds', SoapDigitalSignatureCodec)
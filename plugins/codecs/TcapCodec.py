@@ -15,14 +15,12 @@
 
 ##
 # TCAP (itu-t) Codec
-# To compile TcapAsn: ./py_output.py --explicit asn/tcap.asn > TcapAsn.py
+# To compile TcapAsn: ./py_output.py --explicit --spec=TcapAsn.spec asn/tcap.asn > TcapAsn.py
 ##
 
 import CodecManager
 
 import ber.BerCodec as BerCodec
-import ber.TcapAsn as TcapAsn
-import ber.TcapDialoguePdusAsn as TcapDialoguePdusAsn
 
 class TcapCodec(BerCodec.BerCodec):
 	"""
@@ -57,7 +55,7 @@ class TcapCodec(BerCodec.BerCodec):
 	The mapping between ASN.1 and Testerman structures is documented [Asn1ToTesterman here].
 
 	"""
-	PDU = TcapAsn.TCMessage
+	PDU = 'TcapAsn.TCMessage'
 
 	def getSummary(self, message):
 		try:
@@ -69,7 +67,7 @@ class TcapCodec(BerCodec.BerCodec):
 CodecManager.registerCodecClass('tcap', TcapCodec)
 
 class DialoguePDUCodec(BerCodec.BerCodec):
-	PDU = TcapDialoguePdusAsn.DialoguePDU
+	PDU = 'TcapDialoguePdusAsn.DialoguePDU'
 	def getSummary(self, message): return 'DialoguePDU'
 CodecManager.registerCodecClass('tcap.DialoguePDU', DialoguePDUCodec)
 
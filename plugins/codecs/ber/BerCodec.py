@@ -29,21 +29,36 @@ class BerCodec(CodecManager.Codec):
 	"""
 	Just subclass this codec to create your own BER-based
 	codec,
-	and set the 'pdu' member class to the PDU that
+	and set the 'PDU' member class to the PDU that
 	should be decoded to/encoded from.
 	
+	The PDU may be given as a 'GeneratedModule.TypeName' string
+	(for instance 'MapAsn.MT_ForwardSM_Arg'): the generated ASN.1
+	spec is then only loaded when the codec is first used,
+	from its serialized form if available (see Yapasn1.load_spec).
+	
 	You may also reimplement getSummary if
 	you have more accurate message summaries to provide.
 	"""
 	PDU = None
 	
+	def getPdu(self):
+		"""
+		Returns the PDU syntax node, loading its spec if needed.
+		"""
+		pdu = self.PDU
+		if isinstance(pdu, basestring):
+			(module, name) = pdu.split('.', 1)
+			pdu = asn1.load_spec(module)[name]
+		return pdu
+	
 	def encode(self, template):
 		summary = self.getSummary(template)
-		e = asn1.encode(self.PDU, template)
+		e = asn1.encode(self.getPdu(), template)
 		return (e, summary)
 	
 	def decode(self, data):
-		d = asn1.decode(self.PDU, data)
+		d = asn1.decode(self.getPdu(), data)
 		summary = self.getSummary(d)
 		return (d, summary)
 	
@@ -54,7 +69,7 @@ class BerCodec(CodecManager.Codec):
 		@type  message: Testerman userland message
 		@param message: decoded message corresponding to your PDU
 		"""
-		return str(self.PDU.__class__)
+		return str(self.getPdu().__class__)
 
 """
 # Example:
@@ -66,10 +81,9 @@ class BerCodec(CodecManager.Codec):
 import CodecManager
 
 import ber.BerCodec as BerCodec
-import ber.TcapAsn as TcapAsn
 
 class TcapCodec(BerCodec.BerCodec):
-	PDU = TcapAsn.TCMessage
+	PDU = 'TcapAsn.TCMessage'
 
 	def getSummary(self, message):
 		try:
@@ -99,6 +99,16 @@
 
 import math
 import binascii
+import marshal
+import os
+import sys
+import threading
+import types
+
+try:
+	from hashlib import md5
+except ImportError:
+	from md5 import new as md5
 
 # Traces
 trace_extraction = False
@@ -190,14 +200,14 @@ def encode_tag_ber(tag, orig_flags = None):
 		l += l2
 	return l
 
-def decode_tag_ber(buf):
+def decode_tag_ber(buf, offset = 0):
 	"""
-	Reads the tag at the beginning of buf.
+	Reads the tag at buf[offset] (by default, at the beginning of buf).
 	Returns the read tag and the number of consumed bytes.
 	"""
 	if trace_debug:
-		print "DEBUG: decoding tag from %s" % binascii.hexlify(buf)
-	i = 0
+		print "DEBUG: decoding tag from %s" % binascii.hexlify(buf[offset:])
+	i = offset
 	c = ord(buf[i])
 	flags = c & 0xe0
 	value = c & 0x1f
@@ -208,7 +218,7 @@ def decode_tag_ber(buf):
 			c = ord(buf[i])
 			value = value * 128 + c & 0x7f
 			i += 1
-	return ((flags, value), i)
+	return ((flags, value), i - offset)
 
 def tag_str(tag, verbose = True):
 	flags, value = tag
@@ -229,6 +239,46 @@ def tag_str(tag, verbose = True):
 
 	return "[%s %s%s]" % (label, value, v)
 
+class TagDispatchTable:
+	"""
+	A tag -> component indexes table for a constructed syntax node
+	(sequence fields, choice alternatives), so that the components
+	matching a seen tag are found without calling match_tag()
+	on each of them.
+	
+	lookup(tag) returns the same indexes, in the same order, as:
+	[ i for i in range(len(nodes)) if nodes[i].match_tag(tag) ]
+	"""
+	def __init__(self, nodes):
+		# (class, tag number) -> indexes
+		self._exact = {}
+		# class -> indexes of the nodes matching any tag number in this class
+		self._any = {}
+		for i in range(len(nodes)):
+			for flags, value in nodes[i].get_match_tags():
+				cls = flags & ~CONS_FLAG
+				if value == ANY_TAG:
+					indexes = self._any.setdefault(cls, [])
+				else:
+					indexes = self._exact.setdefault((cls, value), [])
+				if not indexes or indexes[-1] != i:
+					indexes.append(i)
+		for (cls, value), indexes in self._exact.items():
+			if self._any.has_key(cls):
+				indexes = list(set(indexes + self._any[cls]))
+				indexes.sort()
+				self._exact[(cls, value)] = indexes
+
+	def lookup(self, tag):
+		"""
+		Returns the (ordered) indexes of the nodes matching a seen tag.
+		"""
+		cls = tag[0] & ~CONS_FLAG
+		indexes = self._exact.get((cls, tag[1]))
+		if indexes is None:
+			indexes = self._any.get(cls, [])
+		return indexes
+
 ##
 # Low level coders
 ##
@@ -251,22 +301,24 @@ def encode_base128(val):
 	l.reverse()
 	return ''.join(map(chr, l))
 
-def read_base128(buf):
+def read_base128(buf, offset = 0):
 	"""
 	Decodes/reads an integer value coded in pseudo-base128 from a buffer
 	@type  buf: string/buffer
+	@type  offset: integer
+	@param offset: the position of the value in buf
 	@rtype: (integer, integer)
-	@returns: (value, offset) where offset is the number of consumed bytes.
+	@returns: (value, consumed) where consumed is the number of consumed bytes.
 	"""
 	val = 0
-	offset = 0
+	i = offset
 	while 1:
-		b = ord(buf[offset])
-		offset += 1
+		b = ord(buf[i])
+		i += 1
 		val = val * 128 + (b & 0x7F)
 		if b & 0x80 == 0:
 			break
-	return (val, offset)
+	return (val, i - offset)
 
 
 def extract_bits(val, lo_bit, hi_bit):
@@ -307,13 +359,13 @@ def encode_len_ber(mylen):
 		l.reverse ()
 		return ''.join(map(chr, l))
 
-def decode_len_ber(buf):
+def decode_len_ber(buf, offset = 0):
 	"""
-	Reads the len at the beginning of buf.
+	Reads the len at buf[offset] (by default, at the beginning of buf).
 	Returns the read len and the number of consumed bytes.
 	the read len is None for end-of-content marked contents.
 	"""
-	c = ord(buf[0])
+	c = ord(buf[offset])
 	if c > 128:
 		# bit 8 was set. Bit 7-1 indicate the number of bytes
 		# coding the len
@@ -323,9 +375,9 @@ def decode_len_ber(buf):
 		else:
 			# let's read n additional bytes
 			value = 0
-			if len(buf) < 1 + n:
-				raise BerDecodingError("Unable to decode length: expected %s bytes to code the length, only %s available" % (n+1, len(buf)))
-			for c in buf[1:1+n]:
+			if len(buf) < offset + 1 + n:
+				raise BerDecodingError("Unable to decode length: expected %s bytes to code the length, only %s available" % (n+1, len(buf) - offset))
+			for c in buf[offset+1:offset+1+n]:
 				value = value * 256 + ord(c)
 			return (value, 1 + n)
 	else:
@@ -438,36 +490,68 @@ class SyntaxNode:
 		else:
 			return match_tag(self._base_tag, tag)
 
+	def get_match_tags(self):
+		"""
+		Returns the tags accepted by match_tag() for this node,
+		used to build the tag dispatch tables of the constructed nodes.
+		A tag number set to ANY_TAG matches any tag number in its class.
+		"""
+		if self._explicit_tag:
+			return [ self._explicit_tag ]
+		elif self._implicit_tag:
+			return [ self._implicit_tag ]
+		else:
+			return [ self._base_tag ]
+
 	def extract_element(self, buf):
 		"""
 		Reads a buffer assumed to start with a tag
 		Returns a tag + content + number of consumed bytes.
 		Checks the length.
 		"""
+		(tag, start, stop, next_offset) = self.extract_element_at(buf, 0, len(buf))
+		return (tag, buf[start:stop], next_offset)
+
+	def extract_element_at(self, buf, offset, end):
+		"""
+		Reads the element starting at buf[offset], that must be contained
+		in buf[offset:end].
+		Returns a tag + the content boundaries in buf (start, stop) + the offset
+		of the next element, without copying the content.
+		Checks the length.
+		"""
 		if trace_extraction:
-			print "%s: extracting element from %s" % (str(self), binascii.hexlify(buf))
-		(tag, tagbytes) = decode_tag_ber(buf)
-		buf = buf[tagbytes:]
-		(length, lenbytes) = decode_len_ber(buf)
-		content = buf[lenbytes:]
+			print "%s: extracting element from %s" % (str(self), binascii.hexlify(buf[offset:end]))
+		# Fast path for the most common case: single byte tag and length
+		c = ord(buf[offset])
+		if c & 0x1f != 0x1f:
+			tag = (c & 0xe0, c & 0x1f)
+			start = offset + 1
+		else:
+			(tag, tagbytes) = decode_tag_ber(buf, offset)
+			start = offset + tagbytes
+		c = ord(buf[start])
+		if c <= 128:
+			length = c & 0x7f
+			start += 1
+		else:
+			(length, lenbytes) = decode_len_ber(buf, start)
+			start += lenbytes
 		if length is None:
 			# undefined form. Search an EOC ("\0\0")
-			f = buf.find('\0\0')
-			if f < 0:
+			stop = buf.find('\0\0', start, end)
+			if stop < 0:
 				raise BerDecodingError("%s: no End-Of-Content found in current buffer for undefinite length for tag %s." % (str(self), tag_str(tag)))
-			else:
-				content = content[:f]
-				lenbytes += 2 # the EOC bytes are consumed, too
-		elif length > len(buf):
-			raise BerDecodingError("%s: Missing bytes when decoding tag %s: expected %s, available %s" % (str(self), tag_str(tag), length, len(buf)))
+			next_offset = stop + 2 # the EOC bytes are consumed, too
+		elif start + length > end:
+			raise BerDecodingError("%s: Missing bytes when decoding tag %s: expected %s, available %s" % (str(self), tag_str(tag), length, end - start))
 		else:
-			content = content[:length]
+			stop = start + length
+			next_offset = stop
 
-		totalbytes = tagbytes + lenbytes + len(content)		
-		
 		if trace_extraction:
-			print "%s: extracted element %s, %s bytes consumed, len %s:\n%s" % (str(self), tag_str(tag), totalbytes, len(content), binascii.hexlify(content))
-		return (tag, content, totalbytes)
+			print "%s: extracted element %s, %s bytes consumed, len %s:\n%s" % (str(self), tag_str(tag), next_offset - offset, stop - start, binascii.hexlify(buf[start:stop]))
+		return (tag, start, stop, next_offset)
 		
 	def decode_ber(self, tag, buf, context):
 		"""
@@ -484,18 +568,24 @@ class SyntaxNode:
 		However, if this syntaxnode is explicitly tagged, you should expect a
 		the base_tag + length as first bytes of the given buf.
 		"""
+		return self.decode_ber_at(tag, buf, 0, len(buf), context)
+
+	def decode_ber_at(self, tag, buf, start, end, context):
+		"""
+		Same as decode_ber, for the buffer buf[start:end],
+		so that the constructed nodes can decode their components in place
+		(without copying the remaining bytes for each component).
+		"""
 		if self._explicit_tag:
 			# Check that we have the base tag construct
-			(tag, content, consumedbytes) = self.extract_element(buf)
+			(tag, start, end, _) = self.extract_element_at(buf, start, end)
 			if not match_tag(tag, self._base_tag):
 				# In some samples, I ran into the following cases: a sequence was both explicit and implicitly tagged.
 				# Normally, since it is explicitly tagged it should be useless to check the base tag.
 				# But when checked, we got this error.
 				raise BerDecodingError("%s: expected base tag %s, got %s" % (str(self), tag_str(self._base_tag), tag_str(tag)))
-		else:
-			content = buf	
 		# OK, now we can decode the content.
-		return self.decode_content_ber(tag, content, context)
+		return self.decode_content_ber_at(tag, buf, start, end, context)
 	
 	##
 	# To reimplement
@@ -515,6 +605,16 @@ class SyntaxNode:
 		"""
 		raise BerDecodingError("%s: Content decoding not implemented" % str(self))
 
+	def decode_content_ber_at(self, tag, buf, start, end, context):
+		"""
+		Same as decode_content_ber, for the content buf[start:end].
+		
+		By default, extracts the content and calls decode_content_ber.
+		Reimplemented in constructed SyntaxNodes to decode their
+		components in place.
+		"""
+		return self.decode_content_ber(tag, buf[start:end], context)
+
 	def value_from_str(self, s):
 		"""
 		Returns a structured value from a ASN.1 value representation.
@@ -781,15 +881,18 @@ class OctetstringSyntaxNode(SyntaxNode):
 		self._length_constraint = length_constraint
 
 	def decode_content_ber(self, tag, buf, context):
+		return self.decode_content_ber_at(tag, buf, 0, len(buf), context)
+
+	def decode_content_ber_at(self, tag, buf, start, end, context):
 		if is_construct(tag):
 			ret = []
-			while buf:
-				(t, element, length) = self.extract_element(buf)
-				buf = buf[length:]
-				ret.append(self.decode_content_ber(t, element, context))
+			offset = start
+			while offset < end:
+				(t, cstart, cstop, offset) = self.extract_element_at(buf, offset, end)
+				ret.append(self.decode_content_ber_at(t, buf, cstart, cstop, context))
 			return ''.join(ret)
 		else:
-			return self.from_buf(buf)
+			return self.from_buf(buf[start:end])
 	
 	def encode_content_ber(self, content, context):
 		if not isinstance(content, basestring):
@@ -867,36 +970,47 @@ class SequenceSyntaxNode(SyntaxNode):
 	def __init__(self, name):
 		SyntaxNode.__init__(self, base_tag = (UNIVERSAL_FLAG | CONS_FLAG, SEQUENCE_TAG), name = name)
 		self._fields = []
+		# Built on first decoding, once the syntax tree is complete
+		self._tag_table = None
 	
 	def addField(self, name, syntaxNode, optional = False, default = None):
 		"""
 		Declare a new field in the sequence.
 		"""
 		self._fields.append((name, syntaxNode, optional, (default is not None and syntaxNode.value_from_str(default)) or None))
+		self._tag_table = None
+
+	def _get_tag_table(self):
+		if self._tag_table is None:
+			self._tag_table = TagDispatchTable([ sn for _, sn, _, _ in self._fields ])
+		return self._tag_table
 	
 	def decode_content_ber(self, tag, buf, context):
+		return self.decode_content_ber_at(tag, buf, 0, len(buf), context)
+
+	def decode_content_ber_at(self, tag, buf, start, end, context):
 		"""
 		While contents remain, read the tag + length, call the associated decoder, etc.
 		"""
 		ret = {}
 		last_field_index = 0
+		table = self._get_tag_table()
 		
-		while buf:
-			(tag, content, consumedbytes) = self.extract_element(buf)
-			buf = buf[consumedbytes:]
+		offset = start
+		while offset < end:
+			(tag, cstart, cstop, offset) = self.extract_element_at(buf, offset, end)
 			# Now match the tag against one of our possible field - order matters
 			found = False
-			i = 0
-			for name, sn, _, _ in self._fields[last_field_index:]:
-				i += 1
-				if sn.match_tag(tag):
+			for i in table.lookup(tag):
+				if i >= last_field_index:
+					name, sn, _, _ = self._fields[i]
 					if trace_decoding:
 						print "%s: found field '%s', decoding..." % (str(self), name)
-					ret[name] = sn.decode_ber(tag, content, context)
+					ret[name] = sn.decode_ber_at(tag, buf, cstart, cstop, context)
 					if trace_decoding:
 						print "%s: field '%s' decoded" % (str(self), name)
 					found = True
-					last_field_index = last_field_index + i # Make sure we detect the field only once and in the correct order.
+					last_field_index = i + 1 # Make sure we detect the field only once and in the correct order.
 					break
 
 			if not found:
@@ -948,17 +1062,21 @@ class SequenceOfSyntaxNode(SyntaxNode):
 		self._syntaxNode = syntaxNode
 	
 	def decode_content_ber(self, tag, buf, context):
+		return self.decode_content_ber_at(tag, buf, 0, len(buf), context)
+
+	def decode_content_ber_at(self, tag, buf, start, end, context):
 		"""
 		While contents remain, read the tag + length, call the associated decoder, etc.
 		"""
 		ret = []
+		sn = self._syntaxNode
 		
-		while buf:
-			(tag, content, consumedbytes) = self.extract_element(buf)
-			buf = buf[consumedbytes:]
-			if not self._syntaxNode.match_tag(tag):
+		offset = start
+		while offset < end:
+			(tag, cstart, cstop, offset) = self.extract_element_at(buf, offset, end)
+			if not sn.match_tag(tag):
 				raise BerDecodingError("%s: invalid element in SEQUENCE OF: got %s" % (str(self), tag_str(tag)))
-			ret.append(self._syntaxNode.decode_ber(tag, content, context))
+			ret.append(sn.decode_ber_at(tag, buf, cstart, cstop, context))
 		
 		# OK
 		return ret
@@ -983,9 +1101,17 @@ class ChoiceSyntaxNode(SyntaxNode):
 		"""
 		SyntaxNode.__init__(self, base_tag = (0, -1), name = name)
 		self._choices = []
+		# Built on first decoding, once the syntax tree is complete
+		self._tag_table = None
 	
 	def addChoice(self, name, syntaxNode):
 		self._choices.append((name, syntaxNode))
+		self._tag_table = None
+
+	def _get_tag_table(self):
+		if self._tag_table is None:
+			self._tag_table = TagDispatchTable([ sn for _, sn in self._choices ])
+		return self._tag_table
 	
 	def match_tag(self, tag):
 		"""
@@ -995,10 +1121,18 @@ class ChoiceSyntaxNode(SyntaxNode):
 		if self._explicit_tag:
 			return match_tag(self._explicit_tag, tag)
 		else:
-			for name, sn in self._choices:
-				if sn.match_tag(tag):
-					return True
+			if self._get_tag_table().lookup(tag):
+				return True
 			return False
+
+	def get_match_tags(self):
+		if self._explicit_tag:
+			return [ self._explicit_tag ]
+		else:
+			ret = []
+			for name, sn in self._choices:
+				ret += sn.get_match_tags()
+			return ret
 	
 	def set_implicit_tag(self, tag):
 		# A choice cannot be implicitly tagged. Even in implicit tag environnments,
@@ -1006,10 +1140,14 @@ class ChoiceSyntaxNode(SyntaxNode):
 		return self.set_explicit_tag(tag)
 
 	def decode_content_ber(self, tag, buf, context):
+		return self.decode_content_ber_at(tag, buf, 0, len(buf), context)
+
+	def decode_content_ber_at(self, tag, buf, start, end, context):
 		# The tag is the seen (base) tag, i.e. it selects the choice.
-		for name, sn in self._choices:
-			if sn.match_tag(tag):
-				return (name, sn.decode_ber(tag, buf, context))
+		indexes = self._get_tag_table().lookup(tag)
+		if indexes:
+			name, sn = self._choices[indexes[0]]
+			return (name, sn.decode_ber_at(tag, buf, start, end, context))
 		# No match - either an invalid choice or an open choice. For now, not open.
 		raise BerDecodingError("%s: Unsupported tag %s in choice" % (str(self), tag_str(tag)))
 	
@@ -1071,7 +1209,7 @@ class ObjectIdentifierSyntaxNode(SyntaxNode):
 		start = 1
 		mylen = len(buf)
 		while start < mylen:
-			val, consumed = read_base128(buf[start:])
+			val, consumed = read_base128(buf, start)
 			start += consumed
 			oid.append(val)
 		return '.'.join(map(str, oid))
@@ -1099,7 +1237,7 @@ class AnySyntaxNode(SyntaxNode):
 	def __init__(self):
 		SyntaxNode.__init__(self, base_tag = (UNIVERSAL_FLAG, ANY_TAG))
 	
-	def decode_ber(self, tag, buf, context):
+	def decode_ber_at(self, tag, buf, start, end, context):
 		"""
 		Overrides the SyntaxNode complete decoding. 
 		If we are EXPLICIT tagged, buf contains the base_tag.
@@ -1108,11 +1246,11 @@ class AnySyntaxNode(SyntaxNode):
 		get the raw buffer can manage it.
 		"""
 		if not self._explicit_tag:
-			l = encode_len_ber(len(buf))
+			l = encode_len_ber(end - start)
 			i = encode_tag_ber(tag)
-			return i + l + buf
+			return i + l + buf[start:end]
 		else:
-			return buf
+			return buf[start:end]
 	
 	def encode_ber(self, content, context):
 		"""
@@ -1171,10 +1309,202 @@ def encode(syntax, content):
 	return syntax.encode_ber(content, None)
 
 def decode(syntax, buf):
-	(tag, content, _) = syntax.extract_element(buf)
+	(tag, start, end, _) = syntax.extract_element_at(buf, 0, len(buf))
 	if not syntax.match_tag(tag):
 		raise BerDecodingError("The root PDU is incorrect, mismatching tags")
-	return syntax.decode_ber(tag, content, None)
+	return syntax.decode_ber_at(tag, buf, start, end, None)
+
+################################################################################
+# Serialized specs.
+# Building the syntax tree of a large spec by importing its generated module
+# (MapAsn: more than 1000 syntax nodes) takes a while, so the resolved syntax
+# nodes can be serialized to a <module>.spec file, written by the compiler
+# (py_output.py --spec=<file>) or on first load_spec().
+#
+# The serialized form is a marshalled table of the syntax nodes attributes,
+# where the references to other syntax nodes are replaced by their indexes
+# in the table.
+#
+# A serialized spec is only used if it was created from the current generated
+# module source, with the current Yapasn1 source and Python version;
+# otherwise it is rebuilt.
+################################################################################
+
+SPEC_MAGIC = 'YAPASN1-SPEC-1\n'
+
+# Loaded specs, by generated module name
+_specs = {}
+_specs_mutex = threading.Lock()
+
+_yapasn1_digest = None
+
+def _get_digest(filename):
+	"""
+	Returns the md5 digest of a file content, or None if it cannot be read.
+	"""
+	try:
+		f = open(filename, 'rb')
+		try:
+			return md5(f.read()).hexdigest()
+		finally:
+			f.close()
+	except IOError:
+		return None
+
+def _get_spec_key(source_digest):
+	"""
+	Returns what a serialized spec depends on.
+	"""
+	global _yapasn1_digest
+	if _yapasn1_digest is None:
+		_yapasn1_digest = _get_digest(os.path.splitext(os.path.abspath(__file__))[0] + '.py')
+	return (tuple(sys.version_info[:2]), _yapasn1_digest, source_digest)
+
+def dump_spec(namespace, source, filename):
+	"""
+	Serializes the syntax nodes of a generated spec module.
+	
+	@type  namespace: dict
+	@param namespace: the generated module namespace. Only its syntax nodes are serialized.
+	@type  source: string
+	@param source: the generated module source, used to detect outdated serialized specs
+	@type  filename: string
+	@param filename: the serialized spec file to write
+	"""
+	indexes = {}
+	nodes = []
+	def get_index(node):
+		i = indexes.get(id(node))
+		if i is None:
+			i = len(nodes)
+			indexes[id(node)] = i
+			nodes.append(node)
+		return i
+
+	names = {}
+	for name, value in namespace.items():
+		if isinstance(value, SyntaxNode):
+			names[name] = get_index(value)
+	table = []
+	# nodes grows while iterating, as referenced nodes are discovered
+	i = 0
+	while i < len(nodes):
+		node = nodes[i]
+		state = node.__dict__.copy()
+		if state.has_key('_fields'):
+			state['_fields'] = [ (n, get_index(sn), optional, default) for (n, sn, optional, default) in state['_fields'] ]
+		if state.has_key('_choices'):
+			state['_choices'] = [ (n, get_index(sn)) for (n, sn) in state['_choices'] ]
+		if state.has_key('_syntaxNode'):
+			state['_syntaxNode'] = get_index(state['_syntaxNode'])
+		if state.has_key('_tag_table'):
+			state['_tag_table'] = None
+		table.append((node.__class__.__name__, state))
+		i += 1
+
+	data = SPEC_MAGIC + marshal.dumps(_get_spec_key(md5(source).hexdigest())) + marshal.dumps((table, names))
+	# Written to a temporary file first, so that a concurrent load_spec() never reads a partial file
+	tmp = '%s.%s.tmp' % (filename, os.getpid())
+	f = open(tmp, 'wb')
+	try:
+		f.write(data)
+	finally:
+		f.close()
+	os.rename(tmp, filename)
+
+def _read_spec(filename, source_digest):
+	"""
+	Returns the syntax nodes from a serialized spec, or None if the file
+	is missing or outdated.
+	"""
+	try:
+		f = open(filename, 'rb')
+	except IOError:
+		return None
+	try:
+		data = f.read()
+	finally:
+		f.close()
+	header = SPEC_MAGIC + marshal.dumps(_get_spec_key(source_digest))
+	if not data.startswith(header):
+		return None
+	(table, names) = marshal.loads(data[len(header):])
+
+	nodes = []
+	for (class_name, state) in table:
+		cls = globals().get(class_name)
+		if not (isinstance(cls, types.ClassType) and issubclass(cls, SyntaxNode)):
+			raise BerDecodingError("Invalid serialized spec %s: %s is not a syntax node class" % (filename, class_name))
+		# Instantiated without calling __init__
+		nodes.append(types.InstanceType(cls, state))
+	for node in nodes:
+		state = node.__dict__
+		if state.has_key('_fields'):
+			state['_fields'] = [ (n, nodes[i], optional, default) for (n, i, optional, default) in state['_fields'] ]
+		elif state.has_key('_choices'):
+			state['_choices'] = [ (n, nodes[i]) for (n, i) in state['_choices'] ]
+		elif state.has_key('_syntaxNode'):
+			state['_syntaxNode'] = nodes[state['_syntaxNode']]
+	ret = {}
+	for name, i in names.items():
+		ret[name] = nodes[i]
+	return ret
+
+def _load_spec(name):
+	basename = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+	source_digest = _get_digest(basename + '.py')
+	if source_digest is not None:
+		try:
+			nodes = _read_spec(basename + '.spec', source_digest)
+			if nodes is not None:
+				return nodes
+		except Exception:
+			# Corrupted spec file: rebuilt below
+			pass
+
+	module = __import__(name, globals(), locals(), [])
+	nodes = {}
+	for k, v in module.__dict__.items():
+		if isinstance(v, SyntaxNode):
+			nodes[k] = v
+	if source_digest is not None:
+		try:
+			f = open(basename + '.py', 'rb')
+			try:
+				source = f.read()
+			finally:
+				f.close()
+			dump_spec(nodes, source, basename + '.spec')
+		except Exception:
+			# Not writable: the module will be imported again next time
+			pass
+	return nodes
+
+def load_spec(name):
+	"""
+	Returns the syntax nodes defined by a generated spec module
+	(located in the Yapasn1 directory), as a dict name: syntax node.
+	
+	Loads them from the serialized spec (<name>.spec) if it is up to date,
+	which is much faster than importing the generated module.
+	Otherwise, imports the module and (re)writes the serialized spec,
+	if possible.
+	Each spec is loaded once.
+	
+	@type  name: string
+	@param name: the generated module name, for instance 'MapAsn'
+	@rtype: dict of string: SyntaxNode
+	@returns: the syntax nodes, by (Python) type name
+	"""
+	_specs_mutex.acquire()
+	try:
+		nodes = _specs.get(name)
+		if nodes is None:
+			nodes = _load_spec(name)
+			_specs[name] = nodes
+		return nodes
+	finally:
+		_specs_mutex.release()
 
 ################################################################################
 # Compatibility with Z3950's ASN.1 compiler's output:
@@ -1194,10 +1524,12 @@ def IMPLICIT(value, cls = CONTEXT_FLAG):
 import copy 
 
 def TYPE(tag, syntaxNode):
-	# creates a copy of the syntax node to turns into a particular tagged syntax node
+	# creates a copy of the syntax node to turns into a particular tagged syntax node.
+	# Syntax nodes are not modified once the tree is built, so the copy
+	# can share its components with the original one.
 	if trace_debug:
 		print "DEBUG: tagging %s with %s..." % (syntaxNode, tag)
-	sn = copy.deepcopy(syntaxNode)
+	sn = copy.copy(syntaxNode)
 	explicit, flags, value = tag
 	if explicit:
 		sn.set_explicit_tag((flags, value))
@@ -15,6 +15,7 @@ import sys
 import visitor
 import compiler
 import time
+import StringIO
 
 class Visitor:
 	def __init__ (self, defined_dict, source_name, indent = 0, tags_def = 'EXPLICIT'):
@@ -270,12 +271,25 @@ import Yapasn1 as asn1""" % (time_str, sys.argv[0], tags_def, fn)
 		visit_instance.finish ()
 
 
+def write_spec(source, filename):
+	"""
+	Builds the syntax tree defined by the generated source,
+	and writes its serialized form (see Yapasn1.load_spec).
+	"""
+	import Yapasn1
+	namespace = {}
+	exec source in namespace
+	Yapasn1.dump_spec(namespace, source, filename)
+
 def usage():
 	print "Usage:"
-	print " %s --explicit|--implicit <files> ..."
+	print " %s --explicit|--implicit [--spec=<file>] <files> ..."
 	print 
 	print "Generates a Yapasn1-compatible syntax tree definition file, using"
 	print "either EXPLICIT or IMPLICIT default tags"
+	print "If --spec is provided, also writes the serialized syntax tree to <file>,"
+	print "to load with Yapasn1.load_spec (the definition file must be saved"
+	print "as is, next to it)"
 	sys.exit(1)
 
 if __name__ == '__main__':
@@ -290,12 +304,31 @@ if __name__ == '__main__':
 	if not default_tag in [ 'explicit', 'implicit' ]:
 		usage()
 
-	defined_dict = {}
-	for fn in sys.argv [2:]:
-		f = open (fn, "r")
-		parse_and_output (f.read (), fn, defined_dict, default_tag)
-		f.close ()
-		compiler.lexer.lineno = 1
+	spec_filename = None
+	filenames = sys.argv[2:]
+	if filenames[0].startswith('--spec='):
+		spec_filename = filenames[0][len('--spec='):]
+		filenames = filenames[1:]
+		if not filenames:
+			usage()
+
+	# The generated source is collected first, so that it can be serialized, too
+	stdout = sys.stdout
+	sys.stdout = StringIO.StringIO()
+	try:
+		defined_dict = {}
+		for fn in filenames:
+			f = open (fn, "r")
+			parse_and_output (f.read (), fn, defined_dict, default_tag)
+			f.close ()
+			compiler.lexer.lineno = 1
+		source = sys.stdout.getvalue()
+	finally:
+		sys.stdout = stdout
+	sys.stdout.write(source)
+
+	if spec_filename:
+		write_spec(source, spec_filename)
 
 
 
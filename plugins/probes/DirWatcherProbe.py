@@ -22,10 +22,13 @@
 
 
 import ProbeImplementationManager
+import Inotify
 
+import bisect
 import os
 import re
 import threading
+import time
 
 class DirWatcherProbe(ProbeImplementationManager.ProbeImplementation):
 	"""
@@ -64,9 +67,11 @@ When the file ``'/var/lock/testerman.lock'`` is removed, expect:
 
   ('removed', {'dir': '/var/lock', 'name': 'testerman.lock', 'mached_application': 'testerman'})
 
-On start watching, the probe checks for changes in the monitored dirss each second (by default). The interval
+On Linux, the probe is notified by the kernel (inotify) whenever an entry is created or removed in the
+monitored dirs. On other platforms, or for dirs that do not exist yet, the probe checks for changes in the
+monitored dirs each second (by default). The interval
 between two checks can be configured via the ``interval`` startWatchingFiles field. The probe is aware of reset/recreated
-or new born dirs (when monitoring a dir that has not been created yet). Be aware that you may miss notifications
+or new born dirs (when monitoring a dir that has not been created yet). Be aware that, when polling, you may miss notifications
 if some files are created/deleted faster than the interval allows to detect.
 
 When you do not need to watch these dirs any more, send a stopWatchingDirs command. 
@@ -87,7 +92,7 @@ Possible use cases for this probe:
 Availability
 ~~~~~~~~~~~~
 
-All platforms.
+All platforms. Uses inotify on Linux (Python 2.5+).
 
 Dependencies
 ~~~~~~~~~~~~
@@ -177,7 +182,10 @@ The test system interface port bound to such a probe complies with the `DirWatch
 	def startWatching(self, dirs, interval, patterns):
 		self.stopWatching()
 		self._lock()
-		self._watchingThread = WatchingThread(self, dirs, interval, patterns)
+		if Inotify.isAvailable():
+			self._watchingThread = InotifyWatchingThread(self, dirs, interval, patterns)
+		else:
+			self._watchingThread = WatchingThread(self, dirs, interval, patterns)
 		self._watchingThread.start()
 		self._unlock()
 	
@@ -190,6 +198,9 @@ The test system interface port bound to such a probe complies with the `DirWatch
 			t.stop()
 
 class WatchingThread(threading.Thread):
+	"""
+	Polls the watched directories every interval.
+	"""
 	def __init__(self, probe, dirs, interval, patterns):
 		threading.Thread.__init__(self)
 		self._probe = probe
@@ -237,17 +248,128 @@ class WatchingThread(threading.Thread):
 		
 		for (label, l) in [ ('added', added), ('removed', removed) ]:
 			for entryname in l:
-				for pattern in self._patterns:
-					m = pattern.match(entryname)
-					if m:
-						attr = { 'dir': directory, 'name': entryname }
-						for k, v in m.groupdict().items():
-							attr['matched_%s' % k] = v
-						event = (label, attr)
-						self._probe.triEnqueueMsg(event)			
-						# A name can be matched only once.
-						break
-					# else no match
+				self._notify(label, directory, entryname)
+
+	def _notify(self, label, directory, entryname):
+		for pattern in self._patterns:
+			m = pattern.match(entryname)
+			if m:
+				attr = { 'dir': directory, 'name': entryname }
+				for k, v in m.groupdict().items():
+					attr['matched_%s' % k] = v
+				event = (label, attr)
+				self._probe.triEnqueueMsg(event)			
+				# A name can be matched only once.
+				break
+			# else no match
+
+
+class InotifyWatchingThread(WatchingThread):
+	"""
+	Watches the directories with inotify: the added and removed entries
+	are notified as reported by the kernel.
+
+	Directories that cannot be watched (not existing yet, or removed)
+	are polled every interval, until they can be watched.
+	"""
+	MASK = Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_MOVE_SELF | Inotify.IN_DELETE_SELF
+
+	def __init__(self, probe, dirs, interval, patterns):
+		WatchingThread.__init__(self, probe, dirs, interval, patterns)
+		self._inotify = Inotify.Inotify()
+		#: watched directories, indexed by watch descriptor
+		self._watchDescriptors = {}
+		#: directories that could not be watched yet
+		self._unwatchedDirs = []
+
+	def run(self):
+		self._probe.getLogger().debug("Starting watching dirs %s with %s using inotify" % (self._dirs, self._patterns))
+		self._watchedDirs = {}
+		self._unwatchedDirs = list(self._dirs)
+		self._watchDirs()
+
+		lastPoll = time.time()
+		while not self._stopEvent.isSet():
+			timeout = None
+			if self._unwatchedDirs:
+				timeout = max(0, lastPoll + self._interval - time.time())
+			try:
+				events = self._inotify.waitEvents(timeout)
+			except Exception, e:
+				self._probe.getLogger().warning("Error while waiting for directory events: %s" % str(e))
+				self._stopEvent.wait(self._interval)
+				events = []
+			if self._stopEvent.isSet():
+				break
+
+			self._onEvents(events)
+
+			if timeout is not None and time.time() >= lastPoll + self._interval:
+				lastPoll = time.time()
+				self._watchDirs()
+
+		self._inotify.close()
+
+	def stop(self):
+		self._stopEvent.set()
+		self._inotify.wakeup()
+		self.join()
+		self._probe.getLogger().debug("Watching thread stopped")
+
+	def _watchDirs(self):
+		"""
+		Tries to watch the directories that are not watched yet,
+		then checks them (first snapshot, or changes since they were
+		last watched).
+		"""
+		for directory in self._unwatchedDirs[:]:
+			try:
+				wd = self._inotify.addWatch(directory, self.MASK | Inotify.IN_ONLYDIR)
+				self._watchDescriptors[wd] = directory
+				self._unwatchedDirs.remove(directory)
+				self._checkDir(directory)
+			except Exception, e:
+				self._probe.getLogger().debug("Unable to watch directory %s: %s" % (directory, str(e)))
+
+	def _onEvents(self, events):
+		for (wd, mask, cookie, name) in events:
+			if mask & Inotify.IN_Q_OVERFLOW:
+				self._probe.getLogger().warning("Too many directory events, checking all the watched directories")
+				for directory in self._watchDescriptors.values():
+					try:
+						self._checkDir(directory)
+					except Exception, e:
+						self._probe.getLogger().debug("Unable to watch directory %s: %s" % (directory, str(e)))
+				continue
+
+			directory = self._watchDescriptors.get(wd)
+			if directory is None:
+				continue
+			if mask & Inotify.IN_IGNORED:
+				# The directory was deleted or unmounted
+				self._probe.getLogger().debug("Directory %s not watched anymore" % directory)
+				del self._watchDescriptors[wd]
+				self._unwatchedDirs.append(directory)
+				continue
+			if mask & Inotify.IN_MOVE_SELF:
+				# We don't know the new path of the directory: watch its previous path
+				self._inotify.removeWatch(wd)
+				continue
+			if not name:
+				continue
+
+			# Keep the directory snapshot up to date, in case we have to poll it
+			entries = self._watchedDirs.setdefault(directory, [])
+			i = bisect.bisect_left(entries, name)
+			present = i < len(entries) and entries[i] == name
+			if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+				if not present:
+					entries.insert(i, name)
+				self._notify('added', directory, name)
+			elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+				if present:
+					del entries[i]
+				self._notify('removed', directory, name)
 
 		
 
@@ -24,12 +24,15 @@
 
 
 import ProbeImplementationManager
+import Inotify
 
+import fnmatch
 import glob
 import os
 import os.path
 import re
 import threading
+import time
 
 class FileWatcherProbe(ProbeImplementationManager.ProbeImplementation):
 	"""
@@ -54,12 +57,18 @@ as in ``r'resource (?P<name>.*) played'``. In this example, if a line matching t
 in one of the watched files, you will receive a notification containing the source file filename, the
 complete line that matched the pattern, and an additional ``matched_name`` string entry containing the matched group.
 
-On start watching, the probe checks for new lines in the monitored files each second (by default). The interval
+On Linux, the probe is notified by the kernel (inotify) whenever a file is created, deleted or modified
+in the directories of the monitored files, and checks for new lines in the changed files immediately.
+On other platforms, or for files whose directory contains wildcards or does not exist yet,
+the probe checks for new lines in the monitored files each second (by default). The interval
 between two checks can be configured via the ``interval`` startWatchingFiles field. The probe is aware of reset/recreated
 or new born files (when monitoring a file that has not been created yet). In case of a file reset, you may miss some
 matching lines if new lines are created and the file is reset before the next file check, but this should not be a show-stopper
 considering the typical use cases for this probe.
 
+A line is notified once complete, i.e. when its end of line is written, when the file is closed (inotify)
+or when the file did not change since the last check.
+
 When you do not need to watch these files anymore, send a stopWatchingFiles command. 
 
 The probe automatically stops watching files on unmap and when the current test case is over. 
@@ -93,10 +102,13 @@ in the following case:
 In this case, only the delta lines between the old file and the new ones are
 reported, instead of reporting all the lines of the file.
 
+When the file's directory is watched with inotify, a file removed (or renamed)
+then recreated is always detected, though.
+
 Availability
 ~~~~~~~~~~~~
 
-All platforms.
+All platforms. Uses inotify on Linux (Python 2.5+).
 
 Dependencies
 ~~~~~~~~~~~~
@@ -178,7 +190,10 @@ The test system interface port bound to such a probe complies with the `FileWatc
 	def startWatching(self, files, interval, patterns):
 		self.stopWatching()
 		self._lock()
-		self._watchingThread = WatchingThread(self, files, interval, patterns)
+		if Inotify.isAvailable():
+			self._watchingThread = InotifyWatchingThread(self, files, interval, patterns)
+		else:
+			self._watchingThread = WatchingThread(self, files, interval, patterns)
 		self._watchingThread.start()
 		self._unlock()
 	
@@ -191,6 +206,9 @@ The test system interface port bound to such a probe complies with the `FileWatc
 			t.stop()
 
 class WatchingThread(threading.Thread):
+	"""
+	Polls the watched files every interval.
+	"""
 	def __init__(self, probe, files, interval, patterns):
 		threading.Thread.__init__(self)
 		self._probe = probe
@@ -198,13 +216,28 @@ class WatchingThread(threading.Thread):
 		self._files = files
 		self._interval = interval
 		self._patterns = patterns
-		#: last file info indexed by absolute filename
+		#: last file info and read offset (os.stat(), offset) indexed by absolute filename
 		self._watchedFiles = {}
-	
+
 	def run(self):
 		self._probe.getLogger().debug("Starting watching files %s with %s every %ss" % (self._files, self._patterns, self._interval))
+		self._registerFiles()
+
+		# Now, watch for file changes / reset / new files
+		while not self._stopEvent.isSet():
+			self._checkFiles(self._files)
+			self._stopEvent.wait(self._interval)
+
+	def stop(self):
+		self._stopEvent.set()
+		self.join()
+		self._probe.getLogger().debug("Watching thread stopped")
+
+	def _registerFiles(self):
+		"""
+		First pass: register watched files at the moment we start watching
+		"""
 		self._watchedFiles = {}
-		# First pass: register watched files at the moment we start watching
 		try:
 			for f in self._files:
 				for filename in glob.glob(f):
@@ -212,33 +245,33 @@ class WatchingThread(threading.Thread):
 						# First look at the file. Just reference file info
 						try:
 							if os.path.isfile(filename):
-								self._watchedFiles[filename] = os.stat(filename)
+								current = os.stat(filename)
+								self._watchedFiles[filename] = (current, current.st_size)
 								self._probe.getLogger().debug("New file %s registered for watching" % filename)
 						except Exception, e:
 							self._probe.getLogger().debug("Unable to registered file %s: %s" % (filename, str(e)))
 		except Exception, e:
 			self._probe.getLogger().debug("Error while registered watched files: %s" % str(e))
 
-		# Now, watch for file changes / reset / new files	
-		while not self._stopEvent.isSet():
-			try:
-				for f in self._files:
-					# Glob it - enabling to poll for new files with unknown names in a dir
-					for filename in glob.glob(f):
-						try:
-							self._checkFile(filename)
-						except Exception, e:
-							self._probe.getLogger().debug("Unable to watch file %s: %s" % (filename, str(e)))
-			except Exception, e:
-				self._probe.getLogger().debug("Error while watching files: %s" % str(e))
-			self._stopEvent.wait(self._interval)
-	
-	def stop(self):
-		self._stopEvent.set()
-		self.join()
-		self._probe.getLogger().debug("Watching thread stopped")
-	
-	def _checkFile(self, filename):
+	def _checkFiles(self, files):
+		try:
+			for f in files:
+				# Glob it - enabling to poll for new files with unknown names in a dir
+				for filename in glob.glob(f):
+					try:
+						self._checkFile(filename)
+					except Exception, e:
+						self._probe.getLogger().debug("Unable to watch file %s: %s" % (filename, str(e)))
+		except Exception, e:
+			self._probe.getLogger().debug("Error while watching files: %s" % str(e))
+
+	def _checkFile(self, filename, flush = False):
+		"""
+		Notifies the new lines of a file.
+
+		An incomplete last line is kept for the next check, unless flush
+		is set, or the file did not change since the last check.
+		"""
 		# Let's compute what we miss since the last watch
 		# The offset in bytes, from the start of the file,
 		# containing missed data
@@ -249,16 +282,15 @@ class WatchingThread(threading.Thread):
 			if os.path.isfile(filename):
 				# First look at the file. Just reference file info
 				current = os.stat(filename)
-				self._watchedFiles[filename] = current
 				self._probe.getLogger().debug("New file %s created since the last tick" % filename)
 				offset = 0
-		
+
 		else:
 			# The file already existed during the last tick
-			ref = self._watchedFiles[filename]
+			(ref, refOffset) = self._watchedFiles[filename]
 			current = os.stat(filename)
-			self._watchedFiles[filename] = current
-		
+			self._watchedFiles[filename] = (current, refOffset)
+
 			# If the file was recreated in the meanwhile,
 			# we should consider its whole content again.
 			# The problem is to detect the file was recreated.
@@ -270,14 +302,18 @@ class WatchingThread(threading.Thread):
 				if current.st_ctime != ref.st_ctime:
 					self._probe.getLogger().debug("File %s recreated since the last tick" % filename)
 					offset = 0
+				elif refOffset < current.st_size:
+					# same size and same ctime: no change, but an incomplete line to notify
+					offset = refOffset
+					flush = True
 				# same size and same ctime: no change
 			elif current.st_size > ref.st_size:
 				# Problem here.
 				# The file may have been fully reset (with a larger content)
 				# or just continued
-				
+
 				# The ctime test is not safe here; some write() op updates the ctime too
-				
+
 				# We try a inode test, but it is not perfect
 				# On some filesystems (ext3...), we miss the recreation event
 				if current.st_ino != ref.st_ino:
@@ -286,37 +322,204 @@ class WatchingThread(threading.Thread):
 				else:
 					self._probe.getLogger().debug("File %s has new data since the last tick" % filename)
 					# Not recreated, but increased in size
-					offset = ref.st_size
+					offset = refOffset
 			elif current.st_size < ref.st_size:
 				self._probe.getLogger().debug("File %s was reset (content replaced) or recreated since the last tick" % filename)
 				# Not recreated, but reset in the meanwhile
 				offset = 0
-		
+
 		if offset is None:
 			# Nothing to do for the file
 			return
-		
+
 		# OK, scan the file to get matching new lines
 		self._probe.getLogger().debug("File %s changed since the last tick, starting at %d" % (filename, offset))
 		f = open(filename, 'r')
 		f.seek(offset)
-		newlines = f.readlines()
+		data = f.read()
 		f.close()
-		# Technically, the file may have grown since we took the ref size
-		# We should lock the file until we complete our analysis and reading
-		# but the current implementation should be enough for typical probe usages
-		
-		for line in newlines:
+		# The file may have grown since we took the ref size:
+		# we only consume complete lines, and keep track of what we actually read
+		if not flush:
+			data = data[:data.rfind('\n') + 1]
+		self._watchedFiles[filename] = (current, offset + len(data))
+
+		for line in data.splitlines(True):
 			for pattern in self._patterns:
 				m = pattern.match(line)
 				if m:
 					event = { 'filename': filename, 'line': line.strip() } # Should we strip the line ?
 					for k, v in m.groupdict().items():
 						event['matched_%s' % k] = v
-					self._probe.triEnqueueMsg(event)			
+					self._probe.triEnqueueMsg(event)
 					# A line can be matched only once.
 					break
 				# else no match
-		
+
+
+class InotifyWatchingThread(WatchingThread):
+	"""
+	Watches the directories containing the watched files with inotify,
+	checking the files only when the kernel reports a change.
+
+	Files whose directory cannot be watched (wildcards in the directory
+	part, not existing directory) are polled every interval, until
+	their directory can be watched.
+	"""
+	MASK = Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVE_SELF | Inotify.IN_DELETE_SELF
+	#: Maximum delay, in s, added to the notification of new lines
+	COALESCING_DELAY = 0.01
+
+	def __init__(self, probe, files, interval, patterns):
+		WatchingThread.__init__(self, probe, files, interval, patterns)
+		self._inotify = Inotify.Inotify()
+		#: file patterns (with wildcards), indexed by their directory
+		self._filesByDir = {}
+		#: file patterns that are always polled
+		self._polledFiles = []
+		for f in files:
+			directory = os.path.dirname(f)
+			if glob.has_magic(directory):
+				self._polledFiles.append(f)
+			else:
+				self._filesByDir.setdefault(directory, []).append(f)
+		#: watched directories, indexed by watch descriptor
+		self._watchedDirs = {}
+		#: directories that could not be watched yet
+		self._unwatchedDirs = self._filesByDir.keys()
+		#: (wd, name) -> watched file name, or None if not watched
+		self._filenames = {}
+
+	def run(self):
+		self._probe.getLogger().debug("Starting watching files %s with %s using inotify" % (self._files, self._patterns))
+		# Watch the directories first, so that we don't miss any change
+		self._watchDirs()
+		self._registerFiles()
+
+		lastPoll = time.time()
+		while not self._stopEvent.isSet():
+			timeout = None
+			if self._polledFiles or self._unwatchedDirs:
+				timeout = max(0, lastPoll + self._interval - time.time())
+			try:
+				events = self._inotify.waitEvents(timeout)
+				if events:
+					# Let the events of files written in several
+					# chunks accumulate, so that we read them once
+					time.sleep(self.COALESCING_DELAY)
+					events += self._inotify.waitEvents(0)
+			except Exception, e:
+				self._probe.getLogger().warning("Error while waiting for file events: %s" % str(e))
+				self._stopEvent.wait(self._interval)
+				events = []
+			if self._stopEvent.isSet():
+				break
+
+			self._onEvents(events)
+
+			if timeout is not None and time.time() >= lastPoll + self._interval:
+				lastPoll = time.time()
+				self._checkFiles(self._polledFiles)
+				# The directories that can now be watched are checked once
+				self._checkFiles(self._watchDirs())
+				for directory in self._unwatchedDirs:
+					self._checkFiles(self._filesByDir[directory])
+
+		self._inotify.close()
+
+	def stop(self):
+		self._stopEvent.set()
+		self._inotify.wakeup()
+		self.join()
+		self._probe.getLogger().debug("Watching thread stopped")
+
+	def _watchDirs(self):
+		"""
+		Tries to watch the directories that are not watched yet.
+		Returns the file patterns of the newly watched directories.
+		"""
+		ret = []
+		for directory in self._unwatchedDirs[:]:
+			try:
+				wd = self._inotify.addWatch(directory or os.curdir, self.MASK)
+			except Exception, e:
+				self._probe.getLogger().debug("Unable to watch directory %s, polling its files: %s" % (directory, str(e)))
+				continue
+			self._watchedDirs[wd] = directory
+			self._unwatchedDirs.remove(directory)
+			ret += self._filesByDir[directory]
+		return ret
+
+	def _onEvents(self, events):
+		# Changed files, in event order, checked once per batch
+		changed = []
+		changedSet = {}
+		closed = {}
+		for (wd, mask, cookie, name) in events:
+			if mask & Inotify.IN_Q_OVERFLOW:
+				self._probe.getLogger().warning("Too many file events, checking all the watched files")
+				for files in self._filesByDir.values():
+					self._checkFiles(files)
+				continue
+
+			directory = self._watchedDirs.get(wd)
+			if directory is None:
+				continue
+			if mask & Inotify.IN_IGNORED:
+				# The directory was deleted or unmounted
+				self._probe.getLogger().debug("Directory %s not watched anymore" % directory)
+				del self._watchedDirs[wd]
+				self._unwatchedDirs.append(directory)
+				self._filenames = {}
+				continue
+			if mask & Inotify.IN_MOVE_SELF:
+				# We don't know the new path of the directory: watch its previous path
+				self._inotify.removeWatch(wd)
+				continue
+			if not name:
+				continue
+
+			key = (wd, name)
+			if self._filenames.has_key(key):
+				filename = self._filenames[key]
+			else:
+				filename = None
+				if self._isWatchedFile(directory, name):
+					filename = os.path.join(directory, name)
+				if len(self._filenames) > 10000:
+					# Many short-lived files in the watched directories
+					self._filenames = {}
+				self._filenames[key] = filename
+			if filename is None:
+				continue
+			if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+				# New (or removed) file: its whole content will be considered
+				if self._watchedFiles.has_key(filename):
+					del self._watchedFiles[filename]
+			if mask & Inotify.IN_CLOSE_WRITE:
+				closed[filename] = True
+			if not changedSet.has_key(filename):
+				changedSet[filename] = True
+				changed.append(filename)
+
+		for filename in changed:
+			try:
+				self._checkFile(filename, flush = closed.has_key(filename))
+			except Exception, e:
+				self._probe.getLogger().debug("Unable to watch file %s: %s" % (filename, str(e)))
+
+	def _isWatchedFile(self, directory, name):
+		"""
+		Checks if a file name in a directory matches a watched file pattern,
+		as glob.glob() would.
+		"""
+		for f in self._filesByDir[directory]:
+			pattern = os.path.basename(f)
+			if name.startswith('.') and not pattern.startswith('.'):
+				continue
+			if fnmatch.fnmatch(name, pattern):
+				return True
+		return False
+
 
 ProbeImplementationManager.registerProbeImplementationClass("watcher.file", FileWatcherProbe)
@@ -215,34 +215,35 @@ class ResponseThread(threading.Thread):
 		self._stopEvent = threading.Event()
 	
 	def run(self):
-		buf = ''
+		# The session only parses the newly received data
+		session = CodecManager.createDecodingSession('http.response')
 		while not self._stopEvent.isSet():
 			try:
 				r, w, e = select.select([self._socket], [], [], 0.1)
 				if self._socket in r:
 					read = self._socket.recv(1024*1024)
-					buf += read
+					session.feed(read)
 					
 					decodedMessage = None
 
-					self._probe.getLogger().debug('data received (bytes %d), decoding attempt...' % len(buf))
+					self._probe.getLogger().debug('data received (bytes %d), decoding attempt...' % len(read))
 					# If we are not disconnected, notify that the codec can still expect more data (complete = False)
-					(status, _, decodedMessage, summary) = CodecManager.incrementalDecode('http.response', buf, complete = (not read))
+					(status, payload, decodedMessage, summary) = session.decode(complete = (not read))
 
-					if status == CodecManager.IncrementalCodec.DECODING_NEED_MORE_DATA:
+					if status == CodecManager.DecodingSession.DECODING_NEED_MORE_DATA:
 						if not read:
 							# We are disconnected.
 							raise Exception('Unable to decode response: additional data required, but connection lost')
 						else:
 							# Just wait
 							self._probe.getLogger().info('Waiting for additional data...')
-					elif status == CodecManager.IncrementalCodec.DECODING_ERROR:
+					elif status == CodecManager.DecodingSession.DECODING_ERROR:
 						raise Exception('Unable to decode response: decoding error')
 					else:
 						# DECODING_OK
 						fromAddr = "%s:%s" % (self._probe['host'], self._probe['port'])
 						self._probe.getLogger().debug('message decoded, enqueuing...')
-						self._probe.logReceivedPayload(summary, buf, fromAddr)
+						self._probe.logReceivedPayload(summary, payload, fromAddr)
 						self._probe.triEnqueueMsg(decodedMessage, fromAddr)
 						self._stopEvent.set()
 			except Exception, e:
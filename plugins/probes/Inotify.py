@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+##
+# This file is part of Testerman, a test automation system.
+# Copyright (c) 2008,2009,2010 Sebastien Lefevre and other contributors
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+##
+
+##
+# Linux inotify support, through ctypes (no additional dependency),
+# shared by the file and directory watcher probes.
+# This is not a probe.
+##
+
+import errno
+import os
+import select
+import struct
+import sys
+
+
+# Events (from linux/inotify.h)
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+# Always sent
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+# Flags
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+
+# struct inotify_event header: wd, mask, cookie, len
+EVENT_HEADER_FORMAT = 'iIII'
+EVENT_HEADER_SIZE = struct.calcsize(EVENT_HEADER_FORMAT)
+
+
+_libc = None
+try:
+	if sys.platform.startswith('linux'):
+		import ctypes
+		import ctypes.util
+		try:
+			_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+		except TypeError:
+			# Python 2.5: no use_errno
+			_libc = ctypes.CDLL(ctypes.util.find_library('c'))
+		_libc.inotify_init
+		_libc.inotify_add_watch
+		_libc.inotify_rm_watch
+except Exception:
+	_libc = None
+
+
+def isAvailable():
+	"""
+	Returns True if inotify can be used on this host.
+	"""
+	return _libc is not None
+
+def _getErrno():
+	try:
+		return ctypes.get_errno()
+	except Exception:
+		return 0
+
+
+class Inotify:
+	"""
+	An inotify instance, watching any number of files or directories.
+
+	waitEvents() blocks until events are available, or until wakeup()
+	is called from another thread.
+	"""
+	def __init__(self):
+		if not isAvailable():
+			raise OSError(errno.ENOSYS, "inotify is not available on this host")
+		self._fd = _libc.inotify_init()
+		if self._fd < 0:
+			e = _getErrno()
+			raise OSError(e, "inotify_init failed: %s" % os.strerror(e))
+		# Used to interrupt waitEvents()
+		self._wakeupPipe = os.pipe()
+
+	def addWatch(self, path, mask):
+		"""
+		Starts watching a file or directory.
+		Watching an already watched path updates its mask.
+
+		@type  path: string
+		@param path: the path to watch
+		@type  mask: integer
+		@param mask: the IN_* events to watch
+
+		@throws OSError: if the path cannot be watched (typically, does not exist)
+
+		@rtype: integer
+		@returns: the watch descriptor
+		"""
+		if isinstance(path, unicode):
+			path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+		wd = _libc.inotify_add_watch(self._fd, path, mask)
+		if wd < 0:
+			e = _getErrno()
+			raise OSError(e, "Unable to watch %s: %s" % (path, os.strerror(e)))
+		return wd
+
+	def removeWatch(self, wd):
+		"""
+		Stops watching a file or directory.
+		An IN_IGNORED event is then received for this watch descriptor.
+		"""
+		_libc.inotify_rm_watch(self._fd, wd)
+
+	def waitEvents(self, timeout = None):
+		"""
+		Waits for events.
+
+		@type  timeout: float, or None
+		@param timeout: the maximum time to wait for events, in s. None means no timeout.
+
+		@rtype: list of (integer, integer, integer, string)
+		@returns: the received events as (wd, mask, cookie, name), name being
+		          an empty string for events related to the watched path itself.
+		          Empty on timeout or wakeup.
+		"""
+		try:
+			r, w, e = select.select([ self._fd, self._wakeupPipe[0] ], [], [], timeout)
+		except select.error, e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		if self._wakeupPipe[0] in r:
+			os.read(self._wakeupPipe[0], 4096)
+		if not self._fd in r:
+			return []
+
+		data = os.read(self._fd, 65536)
+		events = []
+		offset = 0
+		while offset + EVENT_HEADER_SIZE <= len(data):
+			(wd, mask, cookie, length) = struct.unpack(EVENT_HEADER_FORMAT, data[offset:offset+EVENT_HEADER_SIZE])
+			offset += EVENT_HEADER_SIZE
+			name = data[offset:offset+length].split('\0', 1)[0]
+			offset += length
+			events.append((wd, mask, cookie, name))
+		return events
+
+	def wakeup(self):
+		os.write(self._wakeupPipe[1], 'w')
+
+	def close(self):
+		os.close(self._fd)
+		for fd in self._wakeupPipe:
+			os.close(fd)
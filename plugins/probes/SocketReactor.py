@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+##
+# This file is part of Testerman, a test automation system.
+# Copyright (c) 2008,2009,2010 Sebastien Lefevre and other contributors
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+##
+
+##
+# A socket reactor, shared by the TCP and UDP probes.
+#
+# A single thread waits for the events of all the registered sockets,
+# using epoll when available (Linux, Python 2.6+), select() otherwise,
+# and calls the handlers registered with each socket.
+# This is not a probe.
+##
+
+import errno
+import os
+import select
+import threading
+import time
+
+
+# Errors meaning that a non-blocking socket operation should be retried later
+RETRY_ERRORS = [ errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK) ]
+
+
+class Reactor(threading.Thread):
+	"""
+	Dispatches the readiness events of the registered sockets from a single
+	thread, without any polling timeout.
+
+	The handlers are called in the reactor thread:
+	- onReadable() when the socket can be read (or accepted) without blocking,
+	  or is in error,
+	- onWritable() when the socket can be written without blocking,
+	  only if the write interest was enabled with setWritable().
+
+	Sockets may be registered and unregistered from any thread,
+	and should be unregistered before being closed.
+
+	With the select() fallback, the number of sockets is limited
+	by FD_SETSIZE (usually 1024).
+	"""
+	def __init__(self, logger):
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+		self._logger = logger
+		self._mutex = threading.RLock()
+		self._stopped = False
+		#: dict[fd] = (onReadable, onWritable)
+		self._handlers = {}
+		#: fds with a write interest (select() fallback only)
+		self._writable = {}
+
+		self._epoll = None
+		if hasattr(select, 'epoll'):
+			self._epoll = select.epoll()
+
+		# Used to wake the reactor up when stopping it, or when the
+		# select() fallback should take new registrations into account.
+		# Not available on Windows: the select() fallback then
+		# checks them periodically.
+		self._wakeupPipe = None
+		if os.name == 'posix':
+			import fcntl
+			self._wakeupPipe = os.pipe()
+			for fd in self._wakeupPipe:
+				fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+			if self._epoll:
+				self._epoll.register(self._wakeupPipe[0], select.EPOLLIN)
+
+	def register(self, sock, onReadable, onWritable = None):
+		"""
+		Starts watching a socket.
+
+		@type  sock: socket
+		@param sock: the socket to watch
+		@type  onReadable: callable()
+		@param onReadable: called when the socket is readable
+		@type  onWritable: callable()
+		@param onWritable: called when the socket is writable, if enabled with setWritable()
+		"""
+		fd = sock.fileno()
+		self._mutex.acquire()
+		self._handlers[fd] = (onReadable, onWritable)
+		self._mutex.release()
+		if self._epoll:
+			self._epoll.register(fd, select.EPOLLIN)
+		else:
+			self._wakeup()
+
+	def unregister(self, sock):
+		"""
+		Stops watching a socket. To call before closing it.
+		"""
+		try:
+			fd = sock.fileno()
+		except Exception:
+			return
+		self._mutex.acquire()
+		registered = self._handlers.has_key(fd)
+		if registered:
+			del self._handlers[fd]
+		if self._writable.has_key(fd):
+			del self._writable[fd]
+		self._mutex.release()
+		if registered and self._epoll:
+			try:
+				self._epoll.unregister(fd)
+			except Exception:
+				pass
+
+	def setWritable(self, sock, enabled):
+		"""
+		Enables or disables the onWritable() notifications for a registered socket.
+		Keep them enabled only while there are pending data to write.
+		"""
+		fd = sock.fileno()
+		if self._epoll:
+			if enabled:
+				self._epoll.modify(fd, select.EPOLLIN | select.EPOLLOUT)
+			else:
+				self._epoll.modify(fd, select.EPOLLIN)
+		else:
+			self._mutex.acquire()
+			if enabled:
+				self._writable[fd] = True
+			elif self._writable.has_key(fd):
+				del self._writable[fd]
+			self._mutex.release()
+			self._wakeup()
+
+	def stop(self):
+		"""
+		Stops the reactor thread, and releases its resources.
+		The registered sockets are not closed.
+		"""
+		self._stopped = True
+		self._wakeup()
+		if self.isAlive() and threading.currentThread() is not self:
+			self.join()
+		if self._epoll:
+			self._epoll.close()
+		if self._wakeupPipe:
+			for fd in self._wakeupPipe:
+				os.close(fd)
+			self._wakeupPipe = None
+
+	def _wakeup(self):
+		if self._wakeupPipe:
+			try:
+				os.write(self._wakeupPipe[1], 'w')
+			except OSError:
+				# Full pipe: the reactor will wake up anyway
+				pass
+
+	def _getHandlers(self, fd):
+		self._mutex.acquire()
+		handlers = self._handlers.get(fd, (None, None))
+		self._mutex.release()
+		return handlers
+
+	def _dispatch(self, handler):
+		try:
+			handler()
+		except Exception, e:
+			import traceback
+			self._logger.warning("exception while handling a socket event: %s\n%s" % (str(e), traceback.format_exc()))
+
+	def _pollEpoll(self):
+		try:
+			events = self._epoll.poll(-1)
+		except IOError, e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		ret = []
+		for (fd, event) in events:
+			ret.append((fd, event & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP), event & select.EPOLLOUT))
+		return ret
+
+	def _pollSelect(self):
+		self._mutex.acquire()
+		rset = self._handlers.keys()
+		wset = self._writable.keys()
+		self._mutex.release()
+		timeout = None
+		if self._wakeupPipe:
+			rset.append(self._wakeupPipe[0])
+		else:
+			# No way to be notified of new registrations
+			timeout = 0.05
+			if not rset and not wset:
+				time.sleep(timeout)
+				return []
+		try:
+			r, w, e = select.select(rset, wset, [], timeout)
+		except select.error, e:
+			if e.args[0] == errno.EINTR:
+				return []
+			raise
+		ret = [ (fd, True, False) for fd in r ]
+		ret += [ (fd, False, True) for fd in w ]
+		return ret
+
+	def run(self):
+		if self._epoll:
+			poll = self._pollEpoll
+		else:
+			poll = self._pollSelect
+
+		while not self._stopped:
+			try:
+				events = poll()
+			except Exception, e:
+				if self._stopped:
+					break
+				self._logger.warning("exception while polling sockets: %s" % str(e))
+				# Avoid 100% CPU usage when the poller raises an error
+				time.sleep(0.01)
+				continue
+
+			for (fd, readable, writable) in events:
+				if self._wakeupPipe and fd == self._wakeupPipe[0]:
+					try:
+						while os.read(fd, 4096):
+							pass
+					except OSError:
+						pass
+					continue
+				if readable:
+					onReadable = self._getHandlers(fd)[0]
+					if onReadable:
+						self._dispatch(onReadable)
+				if writable:
+					onWritable = self._getHandlers(fd)[1]
+					if onWritable:
+						self._dispatch(onWritable)
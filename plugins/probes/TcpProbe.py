@@ -20,12 +20,12 @@
 
 import ProbeImplementationManager
 import CodecManager
+import SocketReactor
 
-import select
+import errno
 import socket
 import sys
 import threading
-import time
 import tempfile
 import os
 
@@ -75,8 +75,10 @@ class Connection:
 		self.socket = None
 		self.incoming = False
 		self.peerAddress = None
+		self.ssl = False
 		self.buffer = '' # raw buffer
-		self.decodingBuffer = '' # accumulation of raw buffers for incremental decoding
+		self.outputBuffer = [] # data waiting for the socket to be writable
+		self.decodingSession = None # incremental decoding session for the default decoder, created on first use
 
 class TcpProbe(ProbeImplementationManager.ProbeImplementation):
 	"""
@@ -126,10 +128,20 @@ The probe first waits for ``size`` bytes (if the ``size`` property is set) or (e
 If none of those properties are set, the probe only considers what it read in the stream (which is system-dependent).
 
 Then, the default decoder, if set, tries to decode this first raw segment. If it needs more input, it waits for the next raw segment. If multiple APDUs are detected, multiple incoming messages are raised.
-If undecodable data is detected, the raw segment is ignored.
+If undecodable data is detected, the data buffered for the connection are ignored.
+
+The decoder keeps a decoding session per connection. Codecs with a stateful decoding session (such as ``http.request``, ``http.response`` or ``sip``)
+only analyze the newly received segments; other incremental codecs are called again with all the data received since the last decoded APDU.
 
 If no decoder is set, the raw segment is raised as raw data.
 
+Connections Handling
+~~~~~~~~~~~~~~~~~~~~
+
+All the connections of a probe are handled by a single thread, waiting for socket events with epoll (Linux, Python 2.6+) or select() (other platforms, limited to about 1000 connections).
+
+Outgoing data that cannot be sent immediately are buffered per connection, and sent as soon as the peer can receive them. Pending data are sent before a local disconnection (waiting up to ``connection_timeout``).
+
 Basic SSL Support
 ~~~~~~~~~~~~~~~~~
 
@@ -216,7 +228,7 @@ The test system interface port bound to such a probe complies with the ``Transpo
 
 		self._listeningSocket = None
 		self._connections = {} # Connections() indexed by peer address (ip, port)
-		self._pollingThread = None
+		self._reactor = None
 		self.setDefaultProperty('local_ip', '')
 		self.setDefaultProperty('local_port', 0)
 		self.setDefaultProperty('listening_port', 0) # 0 means: not listening
@@ -237,11 +249,11 @@ The test system interface port bound to such a probe complies with the ``Transpo
 	# ProbeImplementation reimplementation
 	def onTriMap(self):
 		self._reset()
+		self._startReactor()
 		# Should we start listening here ??
 		port = self['listening_port']
 		if port:
 			self._startListening()
-		self._startPollingThread()
 	
 	def onTriUnmap(self):
 		self._reset()
@@ -254,8 +266,10 @@ The test system interface port bound to such a probe complies with the ``Transpo
 
 	# Specific implementation
 	def _reset(self):	
-		self._stopPollingThread()
+		# Stopped first, so that no connection is accepted meanwhile
+		self._stopReactor()
 		self._stopListening()
+		self._disconnectIncomingConnections()
 		self._disconnectOutgoingConnections()
 
 	def _checkSutAddress(self, sutAddress):
@@ -400,7 +414,7 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			if self['use_ssl']:
 				sock = self._toSsl(sock, serverSide = False)
 				self.getLogger().debug("SSL client socket initialized.")
-			conn = self._registerOutgoingConnection(sock, to)
+			conn = self._registerConnection(sock, to, incoming = False)
 		except Exception, e:
 			self.getLogger().info("Connection to %s failed: %s" % (str(to), str(e)))
 			if self['enable_notifications']:
@@ -416,23 +430,20 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			self.getLogger().info("Connected to %s" % str(to))
 		return conn
 	
-	def _registerOutgoingConnection(self, sock, addr):
-		c = Connection()
-		c.socket = sock
-		c.peerAddress = addr
-		c.incoming = False
-		self._lock()
-		self._connections[addr] = c
-		self._unlock()
-		return c
-	
-	def _registerIncomingConnection(self, sock, addr):
+	def _registerConnection(self, sock, addr, incoming):
 		c = Connection()
 		c.socket = sock
 		c.peerAddress = addr
-		c.incoming = True
+		c.incoming = incoming
+		c.ssl = bool(self['use_ssl'])
+		if not c.ssl:
+			# SSL sockets keep blocking reads and writes
+			sock.setblocking(0)
 		self._lock()
 		self._connections[addr] = c
+		# Unmapped probe: not watched, and disconnected on the next mapping
+		if self._reactor:
+			self._reactor.register(sock, lambda: self._onConnectionReadable(c), lambda: self._onConnectionWritable(c))
 		self._unlock()
 		return c
 	
@@ -454,7 +465,41 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			self.logSentPayload(summary, data, "%s:%s" % conn.socket.getpeername())
 		else:
 			self.logSentPayload("TCP data", data, "%s:%s" % conn.socket.getpeername())
-		conn.socket.send(data)
+		if conn.ssl:
+			conn.socket.sendall(data)
+			return
+
+		# Non-blocking write: what cannot be sent now is sent
+		# by the reactor once the socket is writable.
+		self._lock()
+		try:
+			if not conn.outputBuffer:
+				try:
+					sent = conn.socket.send(data)
+				except socket.error, e:
+					if e.args[0] not in SocketReactor.RETRY_ERRORS:
+						raise
+					sent = 0
+				data = data[sent:]
+			if data:
+				conn.outputBuffer.append(data)
+				if len(conn.outputBuffer) == 1 and self._reactor:
+					self._reactor.setWritable(conn.socket, True)
+		finally:
+			self._unlock()
+
+	def _flush(self, conn):
+		"""
+		Sends the pending output data of a connection before closing it,
+		blocking for up to connection_timeout.
+		"""
+		self._lock()
+		data = ''.join(conn.outputBuffer)
+		conn.outputBuffer = []
+		self._unlock()
+		if data:
+			conn.socket.settimeout(float(self['connection_timeout']))
+			conn.socket.sendall(data)
 
 	def _disconnect(self, addr, reason):
 		self.getLogger().info("Disconnectiong from %s, reason: %s" % (addr, reason))
@@ -466,6 +511,13 @@ The test system interface port bound to such a probe complies with the ``Transpo
 		self._unlock()
 
 		if conn:
+			if self._reactor:
+				self._reactor.unregister(conn.socket)
+			if conn.outputBuffer:
+				try:
+					self._flush(conn)
+				except Exception, e:
+					self.getLogger().warning("Unable to send pending data to %s: %s" % (addr, str(e)))
 			try:
 				conn.socket.close()
 			except Exception, e:
@@ -508,7 +560,10 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			self._listeningSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
 			self._listeningSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 			self._listeningSocket.bind(addr)
-			self._listeningSocket.listen(10)
+			self._listeningSocket.listen(socket.SOMAXCONN)
+			self._listeningSocket.setblocking(0)
+			if self._reactor:
+				self._reactor.register(self._listeningSocket, self._onListeningReadable)
 		except Exception, e:
 			self._unlock()
 			raise e
@@ -521,6 +576,8 @@ The test system interface port bound to such a probe complies with the ``Transpo
 		try:
 			if self._listeningSocket:
 				self.getLogger().info("Stopping listening...")
+				if self._reactor:
+					self._reactor.unregister(self._listeningSocket)
 				self._listeningSocket.close()
 				self._listeningSocket = None
 				self.getLogger().info("Stopped listening")
@@ -528,33 +585,89 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			pass
 		self._unlock()
 	
-	def _startPollingThread(self):
-		if not self._pollingThread:
-			self._pollingThread = PollingThread(self)
-			self._pollingThread.start()
+	def _startReactor(self):
+		self._lock()
+		if not self._reactor:
+			self._reactor = SocketReactor.Reactor(self.getLogger())
+			self._reactor.start()
+		self._unlock()
 
-	def _stopPollingThread(self):
-		if self._pollingThread:
-			self._pollingThread.stop()
-			self._pollingThread = None
+	def _stopReactor(self):
+		self._lock()
+		reactor = self._reactor
+		self._reactor = None
+		self._unlock()
+		if reactor:
+			reactor.stop()
 
 	##
-	# Interface to be pluggable on a PollingThread
+	# Reactor handlers (called in the reactor thread)
 	##
-	def _getListeningSockets(self):
-		sockets = []
-		self._lock()
-		if self._listeningSocket:
-			sockets.append(self._listeningSocket)
-		self._unlock()
-		return sockets
-	
-	def _getActiveSockets(self):
+	def _onListeningReadable(self):
+		# Accept all pending connections
+		while 1:
+			self._lock()
+			listeningSocket = self._listeningSocket
+			self._unlock()
+			if not listeningSocket:
+				return
+			try:
+				(sock, addr) = listeningSocket.accept()
+			except socket.error, e:
+				if e.args[0] in SocketReactor.RETRY_ERRORS or e.args[0] == errno.ECONNABORTED:
+					return
+				raise
+			self.getLogger().debug("Accepting a new connection")
+			# The accepted socket may inherit the non-blocking mode
+			sock.setblocking(1)
+			if self['use_ssl']:
+				sock = self._toSsl(sock, serverSide = True)
+			self._onIncomingConnection(sock, addr)
+
+	def _onConnectionReadable(self, conn):
+		addr = conn.peerAddress
+		try:
+			data = conn.socket.recv(65535)
+			# SSL records already decrypted are not signaled by the socket
+			while conn.ssl and data and conn.socket.pending():
+				data += conn.socket.recv(65535)
+		except socket.error, e:
+			if e.args[0] in SocketReactor.RETRY_ERRORS:
+				return
+			self.getLogger().info("Error while reading from %s: %s" % (str(addr), str(e)))
+			data = ''
+		if not data:
+			self.getLogger().debug("%s disconnected by peer" % str(addr))
+			# Nothing more can be sent
+			self._lock()
+			conn.outputBuffer = []
+			self._unlock()
+			self._feedData(addr, '') # notify the feeder that we won't have more data
+			self._disconnect(addr, reason = "disconnected by peer")
+		else:
+			self.getLogger().debug("New data to read from %s" % str(addr))
+			self._feedData(addr, data)
+
+	def _onConnectionWritable(self, conn):
 		self._lock()
-		sockets = [conn.socket for conn in self._connections.values()]
-		self._unlock()
-		return sockets
-		
+		try:
+			while conn.outputBuffer:
+				data = conn.outputBuffer[0]
+				try:
+					sent = conn.socket.send(data)
+				except socket.error, e:
+					if e.args[0] in SocketReactor.RETRY_ERRORS:
+						return
+					raise
+				if sent < len(data):
+					conn.outputBuffer[0] = data[sent:]
+					return
+				del conn.outputBuffer[0]
+			if self._reactor:
+				self._reactor.setWritable(conn.socket, False)
+		finally:
+			self._unlock()
+
 	def _feedData(self, addr, data):
 		conn = self._getConnection(addr)
 		if not conn:
@@ -589,27 +702,24 @@ The test system interface port bound to such a probe complies with the ``Transpo
 	def _preEnqueueMsg(self, conn, msg, addr, disconnected):
 		decoder = self['default_decoder']
 		if decoder:
-			buf = conn.decodingBuffer + msg
+			# The session keeps what was not decoded yet (and possibly the codec parse state)
+			if not conn.decodingSession:
+				conn.decodingSession = CodecManager.createDecodingSession(decoder)
+			session = conn.decodingSession
+			session.feed(msg)
 			# Loop on multiple possible APDUs
-			while buf:
-				(status, consumedSize, decodedMessage, summary) = CodecManager.incrementalDecode(decoder, buf, complete = disconnected)
-				if status == CodecManager.IncrementalCodec.DECODING_NEED_MORE_DATA:
+			while session.hasData():
+				(status, payload, decodedMessage, summary) = session.decode(complete = disconnected)
+				if status == CodecManager.DecodingSession.DECODING_NEED_MORE_DATA:
 					# Do nothing. Just wait for new raw segments.
 					self.getLogger().info("Waiting for more raw segments to complete incremental decoding (using codec %s)." % decoder)
-					conn.decodingBuffer = buf
 					break
-				elif status == CodecManager.IncrementalCodec.DECODING_OK:
-					if consumedSize == 0:
-						consumedSize = len(buf)
-					# Store what was not consumed for later
-					conn.decodingBuffer = buf[consumedSize:]
-					# And raise the decoded message
-					self.logReceivedPayload(summary, buf[:consumedSize], addr)
+				elif status == CodecManager.DecodingSession.DECODING_OK:
+					# Raise the decoded message
+					self.logReceivedPayload(summary, payload, addr)
 					self.triEnqueueMsg(decodedMessage, addr)
-					# make sure we update the local loop buffer, too
-					buf = conn.decodingBuffer 
-				else: # status == CodecManager.IncrementalCodec.DECODING_ERROR:
-					self.getLogger().error("Unable to decode raw data with the default decoder (codec %s). Ignoring the segment." % decoder)
+				else: # status == CodecManager.DecodingSession.DECODING_ERROR:
+					self.getLogger().error("Unable to decode raw data with the default decoder (codec %s). Ignoring the buffered data." % decoder)
 					break
 
 		else: # No default decoder
@@ -619,7 +729,7 @@ The test system interface port bound to such a probe complies with the ``Transpo
 				self.triEnqueueMsg(msg, addr)
 	
 	def _onIncomingConnection(self, sock, addr):
-		self._registerIncomingConnection(sock, addr)
+		self._registerConnection(sock, addr, incoming = True)
 		if self['enable_notifications']:
 			args = {}
 			if self['use_ssl']:
@@ -628,66 +738,4 @@ The test system interface port bound to such a probe complies with the ``Transpo
 					args = { 'certificate': c }
 			self.triEnqueueMsg(('connectionNotification', args), "%s:%s" % addr)
 
-class PollingThread(threading.Thread):
-	"""
-	This is a worker thread that pools all existing
-	connections, based on their sockets.
-	It also waits for incoming connections on listening sockets.
-	
-	These sockets are extracted from the probe when needed, that's why
-	the probe implements the following interface:
-		_getListeningSockets()
-		_getActiveSockets()
-		_disconnect(addr)
-		_registerIncomingConnection(sock, addr)
-	"""
-	def __init__(self, probe):
-		threading.Thread.__init__(self)
-		self._probe = probe
-		self._stopEvent = threading.Event()
-	
-	def stop(self):
-		self._stopEvent.set()
-		self.join()
-	
-	def run(self):
-		# Main poll loop
-		while not self._stopEvent.isSet():
-			try:
-				listening = self._probe._getListeningSockets()
-				active = self._probe._getActiveSockets()
-				rset = listening + active
-
-				r, w, e = select.select(rset, [], [], 0.001)
-				for s in r:
-					try:
-						if s in listening:
-							self._probe.getLogger().debug("Accepting a new connection")
-							(sock, addr) = s.accept()
-							if self._probe['use_ssl']:
-								sock = self._probe._toSsl(sock, serverSide = True)
-							self._probe._onIncomingConnection(sock, addr)
-							# Raise a new connection notification event - soon
-						else:
-							addr = s.getpeername()
-							self._probe.getLogger().debug("New data to read from %s" % str(addr))
-							data = s.recv(65535)
-							if not data:
-								self._probe.getLogger().debug("%s disconnected by peer" % str(addr))
-								self._probe._feedData(addr, '') # notify the feeder that we won't have more data
-								self._probe._disconnect(addr, reason = "disconnected by peer")
-							else:
-								# New received message.
-								self._probe._feedData(addr, data)
-
-					except Exception, e:
-						self._probe.getLogger().warning("exception while polling active/listening sockets: %s" % str(e) + ProbeImplementationManager.getBacktrace())
-					
-			except Exception, e:
-				self._probe.getLogger().warning("exception while polling active/listening sockets: %s" % str(e))
-				# Avoid 100% CPU usage when select() raises an error
-				time.sleep(0.01)	
-					
-
-
 ProbeImplementationManager.registerProbeImplementationClass('tcp', TcpProbe)
@@ -19,18 +19,19 @@
 ##
 
 import ProbeImplementationManager
+import CodecManager
+import SocketReactor
 
-import select
 import socket
 import sys
 import threading
-import time
 
 class Connection:
 	def __init__(self):
 		self.localAddress = None
 		self.peerAddress = None
 		self.buffer = ''
+		self.decodingSession = None # decoding session for the default decoder, created on first use
 
 class UdpProbe(ProbeImplementationManager.ProbeImplementation):
 	"""
@@ -50,6 +51,7 @@ Properties:
    "``listening_ip``","string","0.0.0.0","Listening IP address, if listening mode is activated (see below)"
    "``listening_port``","integer","0","Set it to a non-zero port to start listening on mapping. May be the same ip/port as ``local_ip``:``local_port``. In this case, ``listen_on_send`` is meaningless."
    "``default_sut_address``","string (ip:port)","``None``","If set, used as a default SUT address if none provided by the user"
+   "``default_decoder``","string","``None``","If set, must be a valid codec name (aliases are currently not supported). This codec is then used to decode all incoming packets, and the probe only raises an incoming message when the codec successfully decoded something. Each packet is assumed to contain complete messages (such as ``'sip'`` messages over UDP)."
 
 Overview
 --------
@@ -92,6 +94,7 @@ The test system interface port bound to such a probe complies with the ``Transpo
   type TransportProbePortType
   {
     in, out octetstring;
+    out any; // if the default_decoder is used, the raised structure is the decoder's output
   }
 	"""
 	def __init__(self):
@@ -101,13 +104,14 @@ The test system interface port bound to such a probe complies with the ``Transpo
 		self._listeningSocket = None
 		self._localSocket = None # The socket we send messages from (if not listeningSocket)
 		self._connections = {} # Connections() indexed by peer address (ip, port)
-		self._pollingThread = None
+		self._reactor = None
 		self.setDefaultProperty('local_ip', '')
 		self.setDefaultProperty('local_port', 0)
 		self.setDefaultProperty('listen_on_send', True)
 		self.setDefaultProperty('listening_port', 0) # 0 means: not listening
 		self.setDefaultProperty('listening_ip', '')
 		self.setDefaultProperty('default_sut_address', None)
+		self.setDefaultProperty('default_decoder', None)
 
 		# For future use (only datagram mode is supported for now - no context kept per peer address):
 		# || `size` || integer || `0` || Fixed-size packet strategy: if set to non-zero, only raises messages when `size` bytes have been received. All raised messages will hage this constant size. ||
@@ -119,11 +123,11 @@ The test system interface port bound to such a probe complies with the ``Transpo
 	# ProbeImplementation reimplementation
 	def onTriMap(self):
 		self._reset()
+		self._startReactor()
 		# Should we start listening here ??
 		port = self['listening_port']
 		if port:
 			self._startListening()
-		self._startPollingThread()
 	
 	def onTriUnmap(self):
 		self._reset()
@@ -136,17 +140,19 @@ The test system interface port bound to such a probe complies with the ``Transpo
 
 	# Specific implementation
 	def _reset(self):	
-		self._stopPollingThread()
 		self._stopListening()
 		self._lock()
 		self._connections = {}
 		if self._localSocket:
 			try:
+				if self._reactor:
+					self._reactor.unregister(self._localSocket)
 				self._localSocket.close()
 			except Exception, e:
 				pass
 			self._localSocket = None
 		self._unlock()
+		self._stopReactor()
 
 	def onTriSend(self, message, sutAddress):
 		# First implementation level: no notification/connection explicit management.
@@ -199,6 +205,7 @@ The test system interface port bound to such a probe complies with the ``Transpo
 					sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 					sock.bind((self['local_ip'], self['local_port']))
 					self._localSocket = sock
+					self._reactor.register(sock, lambda: self._onReadable(sock))
 				else:
 					# Reuse the local, not listening socket ??
 					sock = self._localSocket
@@ -221,6 +228,7 @@ The test system interface port bound to such a probe complies with the ``Transpo
 		else:
 			try:
 				assert(sock == self._localSocket)
+				self._reactor.unregister(sock)
 				sock.close()
 				self._localSocket = None
 			except:
@@ -257,6 +265,8 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			self._listeningSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 			self._listeningSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 			self._listeningSocket.bind(addr)
+			listeningSocket = self._listeningSocket
+			self._reactor.register(listeningSocket, lambda: self._onReadable(listeningSocket))
 		except Exception, e:
 			self._unlock()
 			raise e
@@ -268,6 +278,8 @@ The test system interface port bound to such a probe complies with the ``Transpo
 		if self._listeningSocket:
 			self.getLogger().info("Stopping listening...")
 			try:
+				if self._reactor:
+					self._reactor.unregister(self._listeningSocket)
 				self._listeningSocket.close()
 			except:
 				pass
@@ -275,32 +287,32 @@ The test system interface port bound to such a probe complies with the ``Transpo
 			self.getLogger().info("Stopped listening")
 		self._unlock()
 	
-	def _startPollingThread(self):
-		if not self._pollingThread:
-			self._pollingThread = PollingThread(self)
-			self._pollingThread.start()
-
-	def _stopPollingThread(self):
-		if self._pollingThread:
-			self._pollingThread.stop()
-			self._pollingThread = None
-
-	def _getListeningSockets(self):
-		sockets = []
-		self._lock()
-		if self._listeningSocket:
-			sockets.append(self._listeningSocket)
-		self._unlock()
-		return sockets
-	
-	def _getActiveSockets(self):
-		sockets = []
-		self._lock()
-		if self._localSocket:
-			sockets.append(self._localSocket)
-		self._unlock()
-		return sockets
-		
+	def _startReactor(self):
+		if not self._reactor:
+			self._reactor = SocketReactor.Reactor(self.getLogger())
+			self._reactor.start()
+
+	def _stopReactor(self):
+		if self._reactor:
+			self._reactor.stop()
+			self._reactor = None
+
+	def _onReadable(self, sock):
+		"""
+		Reactor handler, for the listening and local sockets.
+		"""
+		try:
+			localaddr = sock.getsockname()
+			(data, addr) = sock.recvfrom(65535)
+		except socket.error, e:
+			if e.args[0] in SocketReactor.RETRY_ERRORS:
+				return
+			self.getLogger().warning("exception while reading from a socket: %s" % str(e))
+			return
+		self.getLogger().debug("New data to read from %s" % str(addr))
+		# New received message.
+		self._feedData(localaddr, addr, data)
+
 	def _feedData(self, localaddr, addr, data):
 		conn = self._getConnection(localaddr, addr)
 		if not conn:
@@ -317,68 +329,38 @@ The test system interface port bound to such a probe complies with the ``Transpo
 				while len(conn.buffer) >= size:
 					msg = conn.buffer[:size]
 					conn.buffer = conn.buffer[size+1:]
-					self.logReceivedPayload("UDP data", msg, "%s:%s" % addr)
-					self.triEnqueueMsg(msg, "%s:%s" % addr)
+					self._preEnqueueMsg(conn, msg, "%s:%s" % addr)
 			elif separator is not None:
 				msgs = conn.buffer.split(separator)
 				for msg in msgs[:-1]:
-					self.logReceivedPayload("UDP data", msg, "%s:%s" % addr)
-					self.triEnqueueMsg(msg, "%s:%s" % addr)
+					self._preEnqueueMsg(conn, msg, "%s:%s" % addr)
 				conn.buffer = msgs[-1]
 			else:
 				msg = conn.buffer
 				conn.buffer = ''
 				# No separator or size criteria -> send to userland what we received according to the udp stack
-				self.logReceivedPayload("UDP data", msg, "%s:%s" % addr)
-				self.triEnqueueMsg(msg, "%s:%s" % addr)
-
-
-class PollingThread(threading.Thread):
-	"""
-	This is a worker thread that pools all existing
-	connections, based on their sockets.
-	It also waits for incoming connections on listening sockets.
-	
-	These sockets are extracted from the probe when needed, that's why
-	the probe implements the following interface:
-		_getListeningSockets()
-		_getActiveSockets()
-		_disconnect(addr)
-		_registerIncomingConnection(sock, addr)
-	"""
-	def __init__(self, probe):
-		threading.Thread.__init__(self)
-		self._probe = probe
-		self._stopEvent = threading.Event()
-	
-	def stop(self):
-		self._stopEvent.set()
-		self.join()
-	
-	def run(self):
-		# Main poll loop
-		while not self._stopEvent.isSet():
-			listening = self._probe._getListeningSockets()
-			active = self._probe._getActiveSockets()
-			rset = listening + active
-			
-			try:
-				r, w, e = select.select(rset, [], [], 0.001)
-				for s in r:
-					try:
-						localaddr = s.getsockname()
-						(data, addr) = s.recvfrom(65535)
-						self._probe.getLogger().debug("New data to read from %s" % str(addr))
-						# New received message.
-						self._probe._feedData(localaddr, addr, data)
-
-					except Exception, e:
-						self._probe.getLogger().warning("exception while polling active/listening sockets: %s" % str(e))
-			
-			except Exception, e:
-				self._probe.getLogger().warning("exception while polling active/listening sockets: %s" % str(e))
-				# Avoid 100% CPU usage when select() raised an error
-				time.sleep(0.01)	
+				self._preEnqueueMsg(conn, msg, "%s:%s" % addr)
+
+	def _preEnqueueMsg(self, conn, msg, addr):
+		decoder = self['default_decoder']
+		if decoder:
+			if not conn.decodingSession:
+				conn.decodingSession = CodecManager.createDecodingSession(decoder)
+			session = conn.decodingSession
+			session.feed(msg)
+			# A packet may contain several APDUs, but no incomplete one:
+			# nothing will complete it (complete = True)
+			while session.hasData():
+				(status, payload, decodedMessage, summary) = session.decode(complete = True)
+				if status == CodecManager.DecodingSession.DECODING_OK:
+					self.logReceivedPayload(summary, payload, addr)
+					self.triEnqueueMsg(decodedMessage, addr)
+				else:
+					self.getLogger().error("Unable to decode raw data with the default decoder (codec %s). Ignoring the packet." % decoder)
+					break
+		else: # No default decoder
+			self.logReceivedPayload("UDP data", msg, addr)
+			self.triEnqueueMsg(msg, addr)
 
 
 ProbeImplementationManager.registerProbeImplementationClass('udp', UdpProbe)
@@ -26,14 +26,19 @@
 ##
 
 import ProbeImplementationManager
+import SocketReactor
 import DefaultPayloads
 # Modified version to support any codec
 # (the standard Python wave module fails if the payload type is unknown to it)
 import wave
 
 import cStringIO as StringIO
+import heapq
+import os
 import select
 import socket
+import struct
+import sys
 import threading
 import time
 
@@ -210,6 +215,21 @@ If you prefer start sending a silent sound, you should set the argument ``defaul
 
 You may, of course, inject another payload as a default sound.
 
+You may also get the statistics of the streams being sent and received with the
+``getStatistics`` command, returned in a ``statistics`` notification:
+
+* ``packetCount``: the number of packets sent or received so far,
+* ``jitter``: the interarrival jitter, as defined in RFC 3550 (for a sent stream, computed on the packets sending times),
+* ``drift``: how late the last packet was sent or received, compared to the first one and to the RTP timestamps,
+* for a sent stream, ``maxPacingError`` and ``meanPacingError``: how late the packets were sent compared to their deadlines.
+
+All durations are in ms.
+
+The packets of all the streams sent by the rtp probes of an agent (or a TE, for local probes)
+are sent by a single scheduler thread, against absolute deadlines derived from a monotonic clock
+(on Linux; the system clock is used on other platforms), so that the pacing errors do
+not accumulate over time. All the received streams are received by a single thread too.
+
 Notes:
 
 * A probe can send/receive at most one stream in a way (i.e. can send, receive, or send+receive).
@@ -291,19 +311,40 @@ The test system interface port bound to such a probe complies with the ``RtpPort
     charstring format optional, // choice in wav, raw ; default: wav
   }
   
+  type record GetStatisticsCommand
+  {
+  }
+  
+  type record StreamStatistics
+  {
+    integer packetCount,
+    float jitter, // ms
+    float drift, // ms
+    float maxPacingError optional, // ms, sent streams only
+    float meanPacingError optional, // ms, sent streams only
+  }
+  
+  type record Statistics
+  {
+    StreamStatistics sending optional, // present if sending a stream
+    StreamStatistics receiving optional, // present if receiving a stream
+  }
+  
   type union Command
   {
     StartSendingCommand startSendingRtp,
     StopSendingCommand stopSendingRtp,
     StartListeningCommand startListeningRtp,
     StopListeningCommand stopListeningRtp,
-    PlayCommand play
+    PlayCommand play,
+    GetStatisticsCommand getStatistics
   }
   
   type union Notification
   {
     StartedReceivingNotification startedReceivingRtp,
-    StoppedReceivingNotification stoppedReceivingRtp
+    StoppedReceivingNotification stoppedReceivingRtp,
+    Statistics statistics
   }
   
   type port message RtpPortType
@@ -315,9 +356,8 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 	def __init__(self):
 		ProbeImplementationManager.ProbeImplementation.__init__(self)
 		self._mutex = threading.RLock()
-		self._stopEvent = threading.Event()
-		self._listeningThread = None
-		self._sendingThread = None
+		self._listeningStream = None
+		self._sendingStream = None
 		
 		# A pool of sockets in used, indexed by the local (ip, port)
 		self._sockets = {}
@@ -346,16 +386,16 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 	
 	def _isSending(self):
 		self._lock()
-		thread = self._sendingThread
+		stream = self._sendingStream
 		self._unlock()
-		if thread: return True
+		if stream: return True
 		return False
 	
 	def _isListening(self):
 		self._lock()
-		thread = self._listeningThread
+		stream = self._listeningStream
 		self._unlock()
-		if thread: return True
+		if stream: return True
 		return False
 
 	def onTriMap(self):
@@ -443,6 +483,9 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 			data = loadPayload(payload, type_)
 			self.playPayload(data, loopCount)
 
+		elif cmd == 'getStatistics':
+			self.triEnqueueMsg(('statistics', self.getStatistics()))
+
 	def _reset(self):
 		self.stopSendingRtp()
 		self.stopListeningRtp()		
@@ -528,8 +571,8 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 		self._defaultPayload = LoopablePayload(defaultPayload, packetSize)
 		try:
 			sock = self._getLocalSocket(fromAddr)
-			self._sendingThread = SendingThread(self, sock, toAddr, payloadType, frameSize, packetSize, sampleRate, ssrc)
-			self._sendingThread.start()
+			self._sendingStream = SendingStream(self, sock, toAddr, payloadType, frameSize, packetSize, sampleRate, ssrc)
+			self._sendingStream.start()
 		except Exception, e:
 			self.getLogger().error("Unable to start sending RTP: %s" % str(e))
 		self._unlock()
@@ -541,8 +584,8 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 		self._lock()
 		try:
 			sock = self._getLocalSocket(fromAddr)
-			self._listeningThread = ListeningThread(self, sock, timeout)
-			self._listeningThread.start()
+			self._listeningStream = ListeningStream(self, sock, timeout)
+			self._listeningStream.start()
 		except Exception, e:
 			self.getLogger().error("Unable to start listening RTP: %s" % str(e))
 		self._unlock()
@@ -572,6 +615,11 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 		
 		Also prepares the source data for the next iteration.
 		"""
+		if self._dataToStream is None:
+			# No user provided stream to play - using default values
+			# (fast path, without locking)
+			return self._defaultPayload.getNextPacket()
+
 		self._lock()
 		if self._dataToStream:
 			# File/payload to play, provided by the user
@@ -629,170 +677,438 @@ The test system interface port bound to such a probe complies with the ``RtpPort
 	
 	def stopSendingRtp(self):
 		self._lock()
-		thread = self._sendingThread
-		self._sendingThread = None
+		stream = self._sendingStream
+		self._sendingStream = None
 		self._unlock()
-		if thread:
-			thread.stop()
+		if stream:
+			stream.stop()
 
 	def stopListeningRtp(self):
 		self._lock()
-		thread = self._listeningThread
-		self._listeningThread = None
+		stream = self._listeningStream
+		self._listeningStream = None
 		self._unlock()
-		if thread:
-			thread.stop()
-
-
-TWO_TO_THE_48TH = 2L<<48
-TWO_TO_THE_32ND = 2L<<32
+		if stream:
+			stream.stop()
 
-class SendingThread(threading.Thread):
-	def __init__(self, probe, *args):
+	def getStatistics(self):
 		"""
-		Paramerers:
-		fromSocket, toAddr,
-		payloadType,
-		frameSize,
-		packetSize,
-		sampleRase,
-		ssrc
+		Returns the statistics of the sent and received streams, if any.
 		"""
+		ret = {}
+		self._lock()
+		sendingStream = self._sendingStream
+		listeningStream = self._listeningStream
+		self._unlock()
+		if sendingStream:
+			ret['sending'] = sendingStream.getStatistics()
+		if listeningStream:
+			stats = listeningStream.getStatistics()
+			if stats:
+				ret['receiving'] = stats
+		return ret
+
+
+TWO_TO_THE_16TH = 1<<16
+TWO_TO_THE_32ND = 1L<<32
+
+##
+# Shared RTP engine: a single scheduler thread sends the packets of all the
+# streams (of all the rtp probes of the agent/TE) against absolute deadlines,
+# and a single socket reactor receives them.
+##
+
+def _getMonotonicClock():
+	"""
+	Returns a function returning a monotonic time, in s (float),
+	so that the sending deadlines are not affected by system clock updates.
+
+	Uses clock_gettime(CLOCK_MONOTONIC) on Linux (through ctypes),
+	falls back to time.time() on other platforms.
+	"""
+	try:
+		if not sys.platform.startswith('linux'):
+			raise Exception("CLOCK_MONOTONIC only used on Linux")
+		import ctypes
+		import ctypes.util
+		class timespec(ctypes.Structure):
+			_fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+		libname = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+		# No argtypes: faster calls
+		clock_gettime = ctypes.CDLL(libname).clock_gettime
+		CLOCK_MONOTONIC = 1
+		def monotonic():
+			t = timespec()
+			if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+				raise OSError("clock_gettime(CLOCK_MONOTONIC) failed")
+			return t.tv_sec + t.tv_nsec * 1e-9
+		monotonic()
+		return monotonic
+	except Exception:
+		return time.time
+
+getMonotonicTime = _getMonotonicClock()
+
+
+class Scheduler(threading.Thread):
+	"""
+	Runs scheduled tasks at their deadlines, from a single thread.
+
+	A task implements run(deadline), called at (or as soon as possible
+	after) its deadline, returning the deadline of its next run, or None
+	if it should not be run again. Tasks are run in deadline order,
+	all the tasks due are run in a row.
+
+	Tasks are not removed when cancelled: they just return None on
+	their next run.
+	"""
+	def __init__(self, logger):
 		threading.Thread.__init__(self)
-		self._probe = probe
-		self._args = args
-		self._stopEvent = threading.Event()
-	
-	def stop(self):
-		self._probe.getLogger().info("Stopping sending thread...")
-		self._stopEvent.set()
-		self.join()
-		self._probe.getLogger().info("Sending thread stopped.")
-	
+		self.setDaemon(True)
+		self._logger = logger
+		self._mutex = threading.Lock()
+		# heap of (deadline, insertion count, task)
+		self._tasks = []
+		self._count = 0
+		# Used to wake the scheduler up when a new task
+		# is scheduled before the next deadline
+		self._wakeupPipe = None
+		if os.name == 'posix':
+			import fcntl
+			self._wakeupPipe = os.pipe()
+			for fd in self._wakeupPipe:
+				fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+	def schedule(self, task, deadline):
+		self._mutex.acquire()
+		self._count += 1
+		heapq.heappush(self._tasks, (deadline, self._count, task))
+		isNext = self._tasks[0][2] is task
+		self._mutex.release()
+		if isNext and self._wakeupPipe:
+			try:
+				os.write(self._wakeupPipe[1], 'w')
+			except OSError:
+				# Full pipe: the scheduler will wake up anyway
+				pass
+
+	def _wait(self, timeout):
+		if self._wakeupPipe:
+			r, w, e = select.select([ self._wakeupPipe[0] ], [], [], timeout)
+			if r:
+				try:
+					while os.read(self._wakeupPipe[0], 4096):
+						pass
+				except OSError:
+					pass
+		elif timeout is None:
+			time.sleep(0.01)
+		else:
+			time.sleep(min(timeout, 0.01))
+
 	def run(self):
+		while 1:
+			now = getMonotonicTime()
+			due = []
+			timeout = None
+			self._mutex.acquire()
+			tasks = self._tasks
+			while tasks and tasks[0][0] <= now:
+				due.append(heapq.heappop(tasks))
+			if tasks:
+				timeout = tasks[0][0] - now
+			self._mutex.release()
+
+			if not due:
+				try:
+					self._wait(timeout)
+				except Exception, e:
+					self._logger.warning("Exception while waiting for the next RTP deadline: %s" % str(e))
+				continue
+
+			rescheduled = []
+			for (deadline, count, task) in due:
+				try:
+					nextDeadline = task.run(deadline)
+				except Exception, e:
+					self._logger.warning("Exception while running a RTP task: %s" % str(e))
+					nextDeadline = None
+				if nextDeadline is not None:
+					rescheduled.append((nextDeadline, count, task))
+			self._mutex.acquire()
+			for entry in rescheduled:
+				heapq.heappush(self._tasks, entry)
+			self._mutex.release()
+
+
+_engineMutex = threading.RLock()
+_scheduler = None
+_reactor = None
+
+def getScheduler():
+	"""
+	Returns the shared RTP scheduler, started on first use.
+	"""
+	global _scheduler
+	_engineMutex.acquire()
+	if not _scheduler:
+		_scheduler = Scheduler(ProbeImplementationManager.getLogger())
+		_scheduler.start()
+	_engineMutex.release()
+	return _scheduler
+
+def getReactor():
+	"""
+	Returns the shared RTP socket reactor, started on first use.
+	"""
+	global _reactor
+	_engineMutex.acquire()
+	if not _reactor:
+		_reactor = SocketReactor.Reactor(ProbeImplementationManager.getLogger())
+		_reactor.start()
+	_engineMutex.release()
+	return _reactor
+
+
+class JitterEstimator:
+	"""
+	Computes the interarrival jitter as specified in RFC 3550 (6.4.1),
+	and the drift of the packet times against the RTP timestamps.
+	Times are in s, timestamps in samples.
+	"""
+	def __init__(self, sampleRate):
+		self._sampleRate = float(sampleRate)
+		self._firstTime = None
+		self._firstTs = None
+		self._lastTransit = None
+		self.packetCount = 0
+		self.jitter = 0.0 # s
+		self.drift = 0.0 # s
+
+	def update(self, t, ts):
+		self.packetCount += 1
+		if self._firstTime is None:
+			self._firstTime = t
+			self._firstTs = ts
+		elapsed = ((ts - self._firstTs) % TWO_TO_THE_32ND) / self._sampleRate
+		transit = t - self._firstTime - elapsed
+		if self._lastTransit is not None:
+			self.jitter += (abs(transit - self._lastTransit) - self.jitter) / 16.0
+		self._lastTransit = transit
+		self.drift = transit
+
+	def getStatistics(self):
 		"""
-		RTP sending loop.
+		Durations are in ms.
 		"""
-		fromSocket, toAddr, payloadType, frameSize, packetSize, sampleRate, ssrc = self._args
-		
-		# Some fixed values computation
-		# interval between 2 packets, in s (float)
-		interval = frameSize / 1000.0
+		return { 'packetCount': self.packetCount, 'jitter': round(self.jitter * 1000.0, 3), 'drift': round(self.drift * 1000.0, 3) }
+
+
+class SendingStream:
+	"""
+	Sends a RTP stream, run by the shared scheduler.
+	The deadline of the packet n is start + n * interval (absolute
+	deadlines on a monotonic clock, so that the errors do not accumulate).
+	"""
+	def __init__(self, probe, fromSocket, toAddr, payloadType, frameSize, packetSize, sampleRate, ssrc):
+		if not 0 <= payloadType < 128:
+			raise Exception("Invalid payload type (%s)" % payloadType)
+		self._probe = probe
+		self._socket = fromSocket
+		self._toAddr = toAddr
+		self._payloadType = payloadType
+		self._packetSize = packetSize
+		self._ssrc = ssrc
+		# Interval between 2 packets, in s (float)
+		self._interval = frameSize / 1000.0
+		# NB: for RFC2833, samplesPerPacket 160 should be used.
+		self._samplesPerPacket = frameSize * sampleRate / 1000
+		self._mutex = threading.Lock()
+		self._stopped = False
 		# We always (re)start our stream with a seq number = 0, and a timestamp ts to 0 too
 		# (According to RFC1889, should be a unique ID instead)
-		seq = 0
-		ts = 0
-		samplesPerPacket = frameSize * sampleRate / 1000
-		# NB: for RFC2833, samplesPerPacket 160 should be used.
-		self._probe.getLogger().info("Now sending RTP, %4.4fs between packets, %s samples per packet" % (interval, samplesPerPacket))
+		self._packetCount = 0
+		self._start = None
+		self._jitter = JitterEstimator(sampleRate)
+		self._maxPacingError = 0.0
+		self._totalPacingError = 0.0
 
-		while not self._stopEvent.isSet():
-			try:
-				# Let's build a RTP packet
-				# The payload is a packetsize-bytes extract from the current played resource.
-				data = self._probe.getNextPacket(packetSize)
-				packet = rtp.packets.RTPPacket(ssrc, seq, ts, data, payloadType)
+	def start(self):
+		self._probe.getLogger().info("Now sending RTP, %4.4fs between packets, %s samples per packet" % (self._interval, self._samplesPerPacket))
+		self._start = getMonotonicTime()
+		getScheduler().schedule(self, self._start)
 
-				packetBytes = packet.netbytes()
+	def stop(self):
+		self._probe.getLogger().info("Stopping sending RTP...")
+		# Waits for the packet being sent, if any
+		self._mutex.acquire()
+		self._stopped = True
+		self._mutex.release()
+		self._probe._conditionallyCloseSocket(self._socket)
+		self._probe._resetDataToStream()
+		self._probe.getLogger().info("Stopped sending RTP, statistics: %s" % self.getStatistics())
 
+	def run(self, deadline):
+		self._mutex.acquire()
+		try:
+			if self._stopped:
+				return None
+			seq = self._packetCount % TWO_TO_THE_16TH
+			# The timestamp actually counts the samples.
+			ts = (self._packetCount * self._samplesPerPacket) % TWO_TO_THE_32ND
+			try:
+				# The payload is a packetsize-bytes extract from the current played resource.
+				data = self._probe.getNextPacket(self._packetSize)
+				# RTP v2 header, no padding, extension, CSRC or marker
+				packetBytes = struct.pack('!BBHII', 0x80, self._payloadType, seq, ts, self._ssrc) + data
 				# Log outgoing payloads only on first packet, with a packet as an example.
-				if not seq:
-					self._probe.logSentPayload("Sending RTP...", packetBytes, "%s:%s" % toAddr)
-				
-				# the sequence number is linearly incremented by one.
-				# Cycled on 2^48, at least according to Shtoom implementation.
-				seq += 1
-				if seq > TWO_TO_THE_48TH:
-					seq -= TWO_TO_THE_48TH
-				# The timestamp actually counts the samples.
-				ts += samplesPerPacket
-				if ts > TWO_TO_THE_32ND:
-					ts -= TWO_TO_THE_32ND
-
-				try:
-					fromSocket.sendto(packetBytes, 0, toAddr)
-				except Exception, e:
-					self._probe.getLogger().warning("Exception while sending a RTP packet: %s" % str(e))
+				if not self._packetCount:
+					self._probe.logSentPayload("Sending RTP...", packetBytes, "%s:%s" % self._toAddr)
+				now = getMonotonicTime()
+				self._socket.sendto(packetBytes, 0, self._toAddr)
+				pacingError = now - deadline
+				self._totalPacingError += pacingError
+				if pacingError > self._maxPacingError:
+					self._maxPacingError = pacingError
+				self._jitter.update(now, ts)
 			except Exception, e:
-				self._probe.getLogger().warning("Exception while sending RTP: %s " % str(e))
-			# Wait our interval (should be an asynchronous tick, normally...)
-			time.sleep(interval)
+				self._probe.getLogger().warning("Exception while sending a RTP packet: %s" % str(e))
+			self._packetCount += 1
+			return self._start + self._packetCount * self._interval
+		finally:
+			self._mutex.release()
 
-		self._probe._conditionallyCloseSocket(fromSocket)
-		self._probe._resetDataToStream()
+	def getStatistics(self):
+		"""
+		Durations are in ms.
+		The pacing error of a packet is its delay against its deadline.
+		"""
+		self._mutex.acquire()
+		ret = self._jitter.getStatistics()
+		if ret['packetCount']:
+			ret['maxPacingError'] = round(self._maxPacingError * 1000.0, 3)
+			ret['meanPacingError'] = round(self._totalPacingError * 1000.0 / ret['packetCount'], 3)
+		self._mutex.release()
+		return ret
 
 
-class ListeningThread(threading.Thread):
-	def __init__(self, probe, *args):
-		threading.Thread.__init__(self)
+class ListeningStream:
+	"""
+	Receives a RTP stream through the shared reactor,
+	and detects its interruptions through the shared scheduler.
+	"""
+	def __init__(self, probe, fromSocket, timeout):
 		self._probe = probe
-		self._args = args
-		self._stopEvent = threading.Event()
-	
+		self._socket = fromSocket
+		self._timeout = timeout
+		self._mutex = threading.Lock()
+		self._stopped = False
+		self._lastPt = None
+		self._lastSourceIp = None
+		self._lastSourcePort = None
+		self._lastTime = None # Last time we received a packet
+		self._lastSsrc = None
+		self._jitter = None
+		# Set while a timeout check is scheduled
+		self._checking = False
+
+	def start(self):
+		getReactor().register(self._socket, self._onReadable)
+
 	def stop(self):
-		self._probe.getLogger().info("Stopping listening thread...")
-		self._stopEvent.set()
-		self.join()
-		self._probe.getLogger().info("Listening thread stopped.")
-	
-	def run(self):
+		self._probe.getLogger().info("Stopping listening RTP...")
+		getReactor().unregister(self._socket)
+		# Waits for the packets being received, if any
+		self._mutex.acquire()
+		self._stopped = True
+		self._mutex.release()
+		self._probe._conditionallyCloseSocket(self._socket)
+		self._probe.getLogger().info("Stopped listening RTP.")
+
+	def run(self, deadline):
 		"""
-		Starts listening RTP.
+		Stream interruption detection (scheduled task).
 		"""
-		fromSocket, timeout = self._args
-
-		lastPt = None
-		lastSourceIp = None
-		lastSourcePort = None
-		lastTime = None # Last time(stamp) we received a packet
-		lastSsrc = None
-		while not self._stopEvent.isSet():
-			try:
-				# Stream interrupted on timeout ?
-				if (lastTime) and ((time.time() - lastTime) > timeout):
-					self._probe.triEnqueueMsg(('stoppedReceivingRtp', { 'reason': 'interrupted' }))
-					lastTime = None
-
-				r, w, e = select.select([fromSocket], [], [], 0.01)
-				if not fromSocket in r:
-					continue
-				
-				# Something to read. Get it, decode it.
-				(data, src) = fromSocket.recvfrom(10000)
+		self._mutex.acquire()
+		try:
+			if self._stopped or not self._lastTime:
+				self._checking = False
+				return None
+			if getMonotonicTime() - self._lastTime > self._timeout:
+				self._probe.triEnqueueMsg(('stoppedReceivingRtp', { 'reason': 'interrupted' }))
+				self._lastTime = None
+				self._checking = False
+				return None
+			return self._lastTime + self._timeout
+		finally:
+			self._mutex.release()
+
+	def _onReadable(self):
+		self._mutex.acquire()
+		try:
+			if self._stopped:
+				return
+			# Reads all the packets received so far
+			while 1:
 				try:
-					packet = rtp.packets.parse_rtppacket(data)
-				except:
-					self._probe.getLogger().info("Invalid RTP packet received")
-					continue
-
-				pt = packet.header.pt
-				ssrc = packet.header.ssrc
-				if not lastTime: # i.e. this is our first packet for the stream
-					# Log incoming payloads only on first packet, with a packet as an example.
-					self._probe.logReceivedPayload("Receiving RTP...", data, "%s:%s" % src)
-					self._probe.triEnqueueMsg(('startedReceivingRtp', {'payloadType': pt, 'ssrc': ssrc, 'fromIp': src[0],
-						'fromPort': src[1]}), "%s:%s" % src)
-					lastTime = time.time()
-				else:
-					# Stream continued. Check for possible changes in properties
-					# TODO: use a bitmap of updated properties
-					if (pt, src[0], src[1], ssrc) != (lastPt, lastSourceIp, lastSourcePort, lastSsrc):
-						# PT or emitter updated: raise a stop then a start event.
-						self._probe.triEnqueueMsg(('stoppedReceivingRtp', {'reason': 'updated'}), "%s:%s" % src)
-						self._probe.logReceivedPayload("Receiving RTP...", data, "%s:%s" % src)
-						self._probe.triEnqueueMsg(('startedReceivingRtp', {'payloadType': pt, 'ssrc': ssrc, 'fromIp': lastSourceIp,
-							'fromPort': lastSourcePort}), "%s:%s" % src)
-
-				# Update stream properties with the current values
-				lastPt = pt
-				lastSourceIp, lastSourcePort = src
-				lastSsrc = ssrc
-				lastTime = time.time()
-			
-			except Exception, e:
-				self._probe.getLogger().error("Exception while listening RTP: %s" % str(e))
+					(data, src) = self._socket.recvfrom(10000)
+				except socket.error, e:
+					if e.args[0] in SocketReactor.RETRY_ERRORS:
+						return
+					raise
+				self._onPacket(data, src)
+		finally:
+			self._mutex.release()
+
+	def _onPacket(self, data, src):
+		now = getMonotonicTime()
+		# Only the fixed header is needed
+		try:
+			(b0, b1, seq, ts, ssrc) = struct.unpack('!BBHII', data[:12])
+		except:
+			self._probe.getLogger().info("Invalid RTP packet received")
+			return
+
+		pt = b1 & 127
+		if not self._lastTime: # i.e. this is our first packet for the stream
+			# Log incoming payloads only on first packet, with a packet as an example.
+			self._probe.logReceivedPayload("Receiving RTP...", data, "%s:%s" % src)
+			self._probe.triEnqueueMsg(('startedReceivingRtp', {'payloadType': pt, 'ssrc': ssrc, 'fromIp': src[0],
+				'fromPort': src[1]}), "%s:%s" % src)
+			self._jitter = JitterEstimator(getPacketSizeAndSampleRate(pt, 20)[1])
+		else:
+			# Stream continued. Check for possible changes in properties
+			# TODO: use a bitmap of updated properties
+			if (pt, src[0], src[1], ssrc) != (self._lastPt, self._lastSourceIp, self._lastSourcePort, self._lastSsrc):
+				# PT or emitter updated: raise a stop then a start event.
+				self._probe.triEnqueueMsg(('stoppedReceivingRtp', {'reason': 'updated'}), "%s:%s" % src)
+				self._probe.logReceivedPayload("Receiving RTP...", data, "%s:%s" % src)
+				self._probe.triEnqueueMsg(('startedReceivingRtp', {'payloadType': pt, 'ssrc': ssrc, 'fromIp': self._lastSourceIp,
+					'fromPort': self._lastSourcePort}), "%s:%s" % src)
+				self._jitter = JitterEstimator(getPacketSizeAndSampleRate(pt, 20)[1])
+		self._jitter.update(now, ts)
+
+		# Update stream properties with the current values
+		self._lastPt = pt
+		self._lastSourceIp, self._lastSourcePort = src
+		self._lastSsrc = ssrc
+		self._lastTime = now
+		if not self._checking:
+			self._checking = True
+			getScheduler().schedule(self, now + self._timeout)
+
+	def getStatistics(self):
+		"""
+		Statistics of the stream being received, if any.
+		The drift is the variation of the arrival delay since the
+		first packet of the stream (ms).
+		"""
+		self._mutex.acquire()
+		ret = None
+		if self._lastTime:
+			ret = self._jitter.getStatistics()
+		self._mutex.release()
+		return ret
 
-		self._probe._conditionallyCloseSocket(fromSocket)
 
-	
 ProbeImplementationManager.registerProbeImplementationClass('rtp', RtpProbe)
@@ -33,6 +33,7 @@ import logging
 import cStringIO as StringIO
 import tarfile
 import re
+import collections
 
 
 ################################################################################
@@ -148,6 +149,10 @@ class ProbeImplementationAdapter(ProbeImplementationManager.IProbeImplementation
 		@returns: True in case of a success, False otherwise [but this is a notification...]
 		"""
 		self.getLogger().debug("triEnqueueing to the TACS...")
+		batcher = self.__agent.enqueueBatcher
+		if batcher and profile == Messages.Message.CONTENT_TYPE_PYTHON_PICKLE:
+			batcher.post(self.getUri(), message, sutAddress)
+			return True
 		msg = Messages.Notification(method = "TRI-ENQUEUE-MSG", uri = self.getUri(), protocol = "Xa", version = "1.0")
 		msg.setApplicationBody(message, profile)
 		msg.setHeader("SUT-Address", sutAddress)
@@ -263,17 +268,268 @@ def compareVersions(versionA, versionB):
 	if a.group(4) > b.group(4): return 1
 	return 0
 
+################################################################################
+# Probe requests dispatching
+################################################################################
+
+class RequestDispatcher:
+	"""
+	Executes jobs on a bounded pool of worker threads, through per-key
+	work queues (the key being typically a probe name).
+	
+	The jobs posted with the same key are executed in order, one at a time,
+	while jobs with different keys are executed in parallel, up to poolSize
+	at the same time. Keys with pending jobs are served in a round-robin
+	way, so that a busy key cannot starve the others.
+	
+	Workers are started on demand.
+	"""
+	def __init__(self, poolSize = 10, maxQueueSize = 1000):
+		"""
+		@type  poolSize: integer
+		@param poolSize: the maximum number of worker threads
+		@type  maxQueueSize: integer
+		@param maxQueueSize: the maximum number of pending jobs per key
+		(not counting the job being executed). 0 means no limit.
+		"""
+		self._poolSize = max(1, poolSize)
+		self._maxQueueSize = maxQueueSize
+		self._condition = threading.Condition(threading.Lock())
+		#: pending jobs (deque of callables), indexed by key.
+		# A key is present as long as it has a pending or running job.
+		self._queues = {}
+		#: keys with pending jobs and no running job, in the order they should be served
+		self._ready = collections.deque()
+		self._workerCount = 0
+		self._idleWorkerCount = 0
+		self._running = True
+
+	def dispatch(self, key, job):
+		"""
+		Posts a job to execute after the jobs already posted with the same key.
+		
+		@type  key: any hashable object
+		@param key: the work queue to post the job to
+		@type  job: callable
+		@param job: the job to execute. Exceptions it may raise are logged and discarded.
+		
+		@rtype: boolean
+		@returns: True if the job was queued, False if the queue for this key
+		is full (or the dispatcher is stopped).
+		"""
+		self._condition.acquire()
+		try:
+			if not self._running:
+				return False
+			queue = self._queues.get(key)
+			if queue is None:
+				queue = collections.deque()
+				self._queues[key] = queue
+				self._ready.append(key)
+				# Idle workers count until they wake up: the ones already
+				# notified for the other ready keys cannot serve this one
+				if len(self._ready) > self._idleWorkerCount and self._workerCount < self._poolSize:
+					self._startWorker()
+				elif self._idleWorkerCount:
+					self._condition.notify()
+			elif self._maxQueueSize and len(queue) >= self._maxQueueSize:
+				return False
+			queue.append(job)
+			return True
+		finally:
+			self._condition.release()
+
+	def getQueueSize(self, key):
+		"""
+		Returns the number of pending jobs for a key.
+		"""
+		self._condition.acquire()
+		queue = self._queues.get(key)
+		self._condition.release()
+		if queue is None:
+			return 0
+		return len(queue)
+
+	def stop(self):
+		"""
+		Stops the workers once the jobs being executed are complete.
+		Pending jobs are discarded.
+		"""
+		self._condition.acquire()
+		self._running = False
+		self._queues = {}
+		self._ready.clear()
+		self._condition.notifyAll()
+		self._condition.release()
+
+	def _startWorker(self):
+		"""
+		Must be called with the condition held.
+		"""
+		self._workerCount += 1
+		worker = threading.Thread(target = self._work, name = "RequestDispatcher-%d" % self._workerCount)
+		worker.setDaemon(True)
+		worker.start()
+
+	def _work(self):
+		self._condition.acquire()
+		while 1:
+			while self._running and not self._ready:
+				self._idleWorkerCount += 1
+				self._condition.wait()
+				self._idleWorkerCount -= 1
+			if not self._running:
+				break
+			key = self._ready.popleft()
+			queue = self._queues[key]
+			job = queue.popleft()
+			self._condition.release()
+
+			try:
+				job()
+			except Exception, e:
+				getLogger().error("Unable to execute a request for %s: %s\n%s" % (key, str(e), Nodes.getBacktrace()))
+
+			self._condition.acquire()
+			if self._queues.get(key) is queue:
+				if queue:
+					# Serve the other keys first
+					self._ready.append(key)
+				else:
+					del self._queues[key]
+		self._workerCount -= 1
+		self._condition.release()
+
+
+class EnqueueMsgBatcher:
+	"""
+	Coalesces the messages enqueued by the probes into TRI-ENQUEUE-MSGS
+	notifications, whose body is a list of (probe uri, message, sut address),
+	in the order the messages were enqueued.
+	
+	A batch is sent once it contains maxSize messages, or window seconds
+	after its first message was enqueued.
+	"""
+	def __init__(self, agent, window, maxSize):
+		"""
+		@type  window: float
+		@param window: the max delay of a message in a batch, in s
+		@type  maxSize: integer
+		@param maxSize: the max number of messages in a batch
+		"""
+		self._agent = agent
+		self._window = window
+		self._maxSize = max(1, maxSize)
+		self._condition = threading.Condition(threading.Lock())
+		#: Held while taking and sending the batches, so that they are sent in order
+		self._sendMutex = threading.Lock()
+		self._batch = []
+		#: The full batches, waiting to be sent, in order
+		self._pending = collections.deque()
+		self._running = True
+		self._thread = threading.Thread(target = self._flushLoop, name = "EnqueueMsgBatcher")
+		self._thread.setDaemon(True)
+		self._thread.start()
+
+	def post(self, probeUri, message, sutAddress):
+		self._condition.acquire()
+		self._batch.append((probeUri, message, sutAddress))
+		size = len(self._batch)
+		if size >= self._maxSize:
+			# Swapped out under the lock, so that the other posters
+			# do not make it grow while it waits to be sent
+			self._pending.append(self._batch)
+			self._batch = []
+		elif size == 1:
+			self._condition.notify()
+		self._condition.release()
+		if size >= self._maxSize:
+			self.flush()
+
+	def flush(self):
+		"""
+		Sends the pending messages, if any.
+		"""
+		self._sendMutex.acquire()
+		try:
+			self._condition.acquire()
+			batches = list(self._pending)
+			self._pending.clear()
+			if self._batch:
+				batches.append(self._batch)
+				self._batch = []
+			self._condition.release()
+			for batch in batches:
+				self._send(batch)
+		finally:
+			self._sendMutex.release()
+
+	def stop(self):
+		self._condition.acquire()
+		self._running = False
+		self._condition.notify()
+		self._condition.release()
+		self._thread.join()
+
+	def _send(self, batch):
+		probeUris = []
+		for (probeUri, message, sutAddress) in batch:
+			if not probeUri in probeUris:
+				probeUris.append(probeUri)
+		msg = Messages.Notification(method = "TRI-ENQUEUE-MSGS", uri = self._agent.getUri(), protocol = "Xa", version = "1.0")
+		msg.setApplicationBody(batch, profile = Messages.Message.CONTENT_TYPE_PYTHON_PICKLE)
+		# Enables the TACS to dispatch the batch without decoding it
+		msg.setHeader("Probe-Uris", ','.join(probeUris))
+		try:
+			self._agent.notify(msg)
+		except Exception, e:
+			getLogger().warning("Unable to send %d enqueued messages: %s" % (len(batch), str(e)))
+
+	def _flushLoop(self):
+		while 1:
+			self._condition.acquire()
+			while self._running and not self._batch and not self._pending:
+				self._condition.wait()
+			running = self._running
+			self._condition.release()
+			if not running:
+				break
+			# Condition.wait(timeout) polls, time.sleep() does not
+			time.sleep(self._window)
+			self.flush()
+		self.flush()
+
+
 ################################################################################
 # The Agent itself
 ################################################################################
 
 
 class Agent(Nodes.ConnectingNode):
-	def __init__(self, name = None):
+	def __init__(self, name = None, poolSize = 10, maxProbeQueueSize = 1000, enqueueBatchWindow = 0.0, enqueueBatchSize = 100):
+		"""
+		@type  poolSize: integer
+		@param poolSize: the maximum number of probe requests executed in parallel
+		@type  maxProbeQueueSize: integer
+		@param maxProbeQueueSize: the maximum number of pending requests per probe
+		(0: no limit). Requests to a probe whose queue is full are rejected.
+		@type  enqueueBatchWindow: float
+		@param enqueueBatchWindow: if > 0, the messages enqueued by the probes
+		are sent to the TACS in batches, delayed by up to this window (in s).
+		Requires a TACS supporting TRI-ENQUEUE-MSGS.
+		@type  enqueueBatchSize: integer
+		@param enqueueBatchSize: the max number of messages in a batch
+		"""
 		Nodes.ConnectingNode.__init__(self, name = name, userAgent = "PyTestermanAgent/%s" % getVersion())
 		self.mutex = threading.RLock()
 		#: Declared probes, indexed by their name
 		self.probes = {}
+		#: Executes the probe requests, serialized per probe
+		self.dispatcher = RequestDispatcher(poolSize, maxProbeQueueSize)
+		#: Coalesces the TRI-ENQUEUE-MSG notifications, if enabled
+		self.enqueueBatcher = None
+		if enqueueBatchWindow > 0:
+			self.enqueueBatcher = EnqueueMsgBatcher(self, enqueueBatchWindow, enqueueBatchSize)
 		# Xa channel id to communicate with the TACS
 		self.channel = None
 		#: current agent registration status
@@ -398,29 +654,14 @@ class Agent(Nodes.ConnectingNode):
 				probe = self.probes.get(name, None)
 				if not probe:
 					self.response(transactionId, 404, "Probe not found")
-				else:
-					if method == "TRI-SEND":
-						probe.onTriSend(request.getApplicationBody(), request.getHeader('SUT-Address'))
-						self.response(transactionId, 200, "OK")
-					elif method == "TRI-MAP":
-						probe.onTriMap()
-						self.response(transactionId, 200, "OK")
-					elif method == "TRI-UNMAP":
-						probe.onTriUnmap()
-						self.response(transactionId, 200, "OK")
-					elif method == "TRI-EXECUTE-TESTCASE":
-						# Set the probe properties
-						properties = request.getApplicationBody()
-						if properties:
-							for name, value in properties.items():
-								probe.setProperty(name, value)
-						probe.onTriExecuteTestCase()
-						self.response(transactionId, 200, "OK")
-					elif method == "TRI-SA-RESET":
-						probe.onTriSAReset()
-						self.response(transactionId, 200, "OK")
-					else:
-						self.response(transactionId, 505, "Not supported")
+				elif not method in [ "TRI-SEND", "TRI-MAP", "TRI-UNMAP", "TRI-EXECUTE-TESTCASE", "TRI-SA-RESET" ]:
+					self.response(transactionId, 505, "Not supported")
+				# A slow probe must not delay the requests to the other probes:
+				# the request is executed (and answered) by a dispatcher worker,
+				# after the previous requests to the same probe.
+				elif not self.dispatcher.dispatch(name, lambda: self.onProbeRequest(probe, transactionId, request)):
+					self.getLogger().warning("Too many pending requests for probe %s, rejecting %s" % (name, method))
+					self.response(transactionId, 503, "Too many pending requests for this probe")
 
 			else:
 				# Other scheme
@@ -432,6 +673,42 @@ class Agent(Nodes.ConnectingNode):
 		except Exception, e:
 			self.response(transactionId, 515, "Internal server error", str(e) + "\n" + Nodes.getBacktrace())
 		
+	def onProbeRequest(self, probe, transactionId, request):
+		"""
+		Executes a probe-level request and sends its response.
+		Called from a dispatcher worker.
+		"""
+		method = request.getMethod()
+		try:
+			if method == "TRI-SEND":
+				probe.onTriSend(request.getApplicationBody(), request.getHeader('SUT-Address'))
+				self.response(transactionId, 200, "OK")
+			elif method == "TRI-MAP":
+				probe.onTriMap()
+				self.response(transactionId, 200, "OK")
+			elif method == "TRI-UNMAP":
+				probe.onTriUnmap()
+				self.response(transactionId, 200, "OK")
+			elif method == "TRI-EXECUTE-TESTCASE":
+				# Set the probe properties
+				properties = request.getApplicationBody()
+				if properties:
+					for name, value in properties.items():
+						probe.setProperty(name, value)
+				probe.onTriExecuteTestCase()
+				self.response(transactionId, 200, "OK")
+			elif method == "TRI-SA-RESET":
+				probe.onTriSAReset()
+				self.response(transactionId, 200, "OK")
+			else:
+				self.response(transactionId, 505, "Not supported")
+
+		except ProbeException, e:
+			self.response(transactionId, 516, "Probe error", str(e) + "\n" + Nodes.getBacktrace())
+
+		except Exception, e:
+			self.response(transactionId, 515, "Internal server error", str(e) + "\n" + Nodes.getBacktrace())
+
 	def onNotification(self, channel, message):
 		"""
 		Notification: nothing to support in this Agent.
@@ -444,6 +721,12 @@ class Agent(Nodes.ConnectingNode):
 	def initialize(self, controllerAddress, localAddress):
 		Nodes.ConnectingNode.initialize(self, controllerAddress, localAddress)
 
+	def stop(self):
+		if self.enqueueBatcher:
+			self.enqueueBatcher.stop()
+		Nodes.ConnectingNode.stop(self)
+		self.dispatcher.stop()
+
 	##
 	# Agent actual services implementation.
 	##		
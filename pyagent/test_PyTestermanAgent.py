@@ -0,0 +1,223 @@
+##
+# PyTestermanAgent probe requests dispatching test tool.
+#
+# Feeds an agent with Xa probe requests, as its request adapter thread would,
+# and checks that a blocked probe no longer delays the requests to
+# the other probes, while the requests to a probe stay ordered.
+#
+# Also checks the batching of the messages enqueued by the probes.
+##
+
+import PyTestermanAgent as Agent
+import ProbeImplementationManager
+import TestermanMessages as Messages
+
+import threading
+import time
+
+
+class TestAgent(Agent.Agent):
+	"""
+	Collects the responses instead of sending them over Xa.
+	"""
+	def __init__(self, poolSize = 10, maxProbeQueueSize = 1000, enqueueBatchWindow = 0.0, enqueueBatchSize = 100):
+		Agent.Agent.__init__(self, name = 'test', poolSize = poolSize, maxProbeQueueSize = maxProbeQueueSize, enqueueBatchWindow = enqueueBatchWindow, enqueueBatchSize = enqueueBatchSize)
+		self.responses = {}
+		self.notifications = []
+
+	def notify(self, message):
+		self.notifications.append(message)
+
+	def response(self, transactionId, status, reason, body = None):
+		self.responses[transactionId] = (status, time.time())
+
+	def waitResponse(self, transactionId, timeout = 5.0):
+		"""
+		Returns the response status, or None on timeout.
+		"""
+		deadline = time.time() + timeout
+		while not self.responses.has_key(transactionId) and time.time() < deadline:
+			time.sleep(0.001)
+		if self.responses.has_key(transactionId):
+			return self.responses[transactionId][0]
+		return None
+
+
+class RecordingProbe(ProbeImplementationManager.ProbeImplementation):
+	"""
+	Records the sent messages.
+	Blocks on each send while blocked.
+	"""
+	def __init__(self):
+		ProbeImplementationManager.ProbeImplementation.__init__(self)
+		self.sent = []
+		self.unblocked = threading.Event()
+		self.unblocked.set()
+
+	def onTriSend(self, message, sutAddress):
+		self.unblocked.wait()
+		self.sent.append(message)
+
+
+def deployProbe(agent, name):
+	probeImplementation = RecordingProbe()
+	agent.probes[name] = Agent.ProbeImplementationAdapter(agent, name, 'test', probeImplementation)
+	return probeImplementation
+
+def triSend(agent, transactionId, name, message):
+	request = Messages.Request(method = "TRI-SEND", uri = "probe:%s@test" % name, protocol = "Xa", version = "1.0")
+	request.setApplicationBody(message)
+	agent.onRequest(None, transactionId, request)
+
+
+def test_blocked_probe():
+	"""
+	A probe blocked on a send does not delay the sends to a second probe.
+	"""
+	agent = TestAgent()
+	blocked = deployProbe(agent, 'blocked')
+	other = deployProbe(agent, 'other')
+	blocked.unblocked.clear()
+
+	start = time.time()
+	triSend(agent, 1, 'blocked', 'stuck')
+	for i in range(100):
+		triSend(agent, 100 + i, 'other', i)
+	assert(agent.waitResponse(199) == 200)
+	duration = time.time() - start
+	print "100 TRI-SENDs to a second probe answered in %.1f ms while the first probe is blocked" % (duration * 1000)
+	assert(duration < 1.0)
+	assert(other.sent == range(100))
+	assert(not agent.responses.has_key(1))
+	assert(blocked.sent == [])
+
+	# More requests to the blocked probe are queued, then executed in order
+	for i in range(10):
+		triSend(agent, 2 + i, 'blocked', i)
+	blocked.unblocked.set()
+	assert(agent.waitResponse(11) == 200)
+	assert(blocked.sent == [ 'stuck' ] + range(10))
+	assert([ agent.responses[i][1] for i in range(1, 12) ] == sorted([ agent.responses[i][1] for i in range(1, 12) ]))
+	agent.dispatcher.stop()
+	print "blocked probe: OK"
+
+def test_queue_limit():
+	"""
+	Requests to a probe with too many pending requests are rejected.
+	"""
+	agent = TestAgent(maxProbeQueueSize = 5)
+	blocked = deployProbe(agent, 'blocked')
+	blocked.unblocked.clear()
+	triSend(agent, 1, 'blocked', 0)
+	while agent.dispatcher.getQueueSize('blocked'):
+		time.sleep(0.001)
+	for i in range(1, 7):
+		triSend(agent, 1 + i, 'blocked', i)
+	# 1 running and 5 pending requests
+	assert(agent.waitResponse(7, timeout = 1.0) == 503)
+	blocked.unblocked.set()
+	assert(agent.waitResponse(6) == 200)
+	assert(blocked.sent == range(6))
+	agent.dispatcher.stop()
+	print "queue limit: OK"
+
+def test_pool_size():
+	"""
+	No more than poolSize probes are executing requests at the same time.
+	"""
+	agent = TestAgent(poolSize = 2)
+	probes = [ deployProbe(agent, 'probe%d' % i) for i in range(3) ]
+	for p in probes:
+		p.unblocked.clear()
+	for i in range(3):
+		triSend(agent, 1 + i, 'probe%d' % i, i)
+	time.sleep(0.2)
+	assert(agent.dispatcher._workerCount == 2)
+	assert(agent.dispatcher.getQueueSize('probe2') == 1)
+	for p in probes:
+		p.unblocked.set()
+	for i in range(3):
+		assert(agent.waitResponse(1 + i) == 200)
+	agent.dispatcher.stop()
+	print "pool size: OK"
+
+def test_enqueue_batching():
+	"""
+	Messages enqueued by several probes are sent in ordered batches,
+	by size or after the batch window.
+	"""
+	agent = TestAgent(enqueueBatchWindow = 0.05, enqueueBatchSize = 100)
+	probes = [ deployProbe(agent, 'probe%d' % i) for i in range(4) ]
+
+	def enqueue(probe):
+		for i in range(1000):
+			probe.triEnqueueMsg(i, 'sut:%d' % i)
+	threads = [ threading.Thread(target = enqueue, args = (p,)) for p in probes ]
+	# Batches being sent: the posters keep enqueuing meanwhile
+	agent.enqueueBatcher._sendMutex.acquire()
+	for t in threads:
+		t.start()
+	time.sleep(0.2)
+	agent.enqueueBatcher._sendMutex.release()
+	for t in threads:
+		t.join()
+	time.sleep(0.2)
+
+	received = {}
+	for notification in agent.notifications:
+		assert(notification.getMethod() == "TRI-ENQUEUE-MSGS")
+		batch = notification.getApplicationBody()
+		assert(len(batch) <= 100)
+		probeUris = notification.getHeader('Probe-Uris').split(',')
+		assert(sorted(probeUris) == sorted(dict.fromkeys([ x[0] for x in batch ]).keys()))
+		for (probeUri, message, sutAddress) in batch:
+			assert(sutAddress == 'sut:%d' % message)
+			received.setdefault(probeUri, []).append(message)
+	assert(len(received) == 4)
+	for messages in received.values():
+		assert(messages == range(1000))
+	print "%d messages enqueued by 4 probes sent in %d batches" % (4000, len(agent.notifications))
+
+	# A single message is sent after the window
+	agent.notifications = []
+	probes[0].triEnqueueMsg('alone')
+	assert(agent.notifications == [])
+	time.sleep(0.2)
+	assert(len(agent.notifications) == 1)
+	assert(agent.notifications[0].getApplicationBody() == [ ('probe:probe0@test', 'alone', None) ])
+	agent.enqueueBatcher.stop()
+	agent.dispatcher.stop()
+	print "enqueue batching: OK"
+
+def test_idle_worker_wakeup():
+	"""
+	Two keys dispatched to a single idle worker, before it wakes up,
+	are served in parallel: the second one starts a new worker.
+	"""
+	for i in range(20):
+		dispatcher = Agent.RequestDispatcher(poolSize = 10)
+		done = threading.Event()
+		dispatcher.dispatch('warmup', done.set)
+		done.wait(1.0)
+		while dispatcher._idleWorkerCount != 1:
+			time.sleep(0.001)
+		unblocked = threading.Event()
+		done.clear()
+		dispatcher.dispatch('A', unblocked.wait)
+		dispatcher.dispatch('B', done.set)
+		done.wait(1.0)
+		assert(done.isSet())
+		assert(dispatcher._workerCount == 2)
+		unblocked.set()
+		dispatcher.stop()
+	print "idle worker wakeup: OK"
+
+def test():
+	test_blocked_probe()
+	test_queue_limit()
+	test_pool_size()
+	test_idle_worker_wakeup()
+	test_enqueue_batching()
+
+if __name__ == '__main__':
+	test()
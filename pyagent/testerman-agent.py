@@ -132,6 +132,10 @@ def main():
 		parser.add_option("--pid-filename", dest = "pidFilename", metavar = "FILE", help = "use FILE to dump the process PID when daemonizing (default: no pidfile)", default = None)
 	parser.add_option("--probe-path", dest = "probePaths", metavar = "PATHS", help = "search for probe modules in PATHS, which is a comma-separated list of paths")
 	parser.add_option("--codec-path", dest = "codecPaths", metavar = "PATHS", help = "search for codec modules in PATHS, which is a comma-separated list of paths")
+	parser.add_option("--probe-threads", dest = "probeThreads", metavar = "COUNT", help = "execute up to COUNT probe requests in parallel (default: %default)", default = 10, type = "int")
+	parser.add_option("--probe-queue-size", dest = "probeQueueSize", metavar = "SIZE", help = "reject the requests to a probe with SIZE pending requests, 0 for no limit (default: %default)", default = 1000, type = "int")
+	parser.add_option("--enqueue-batch-window", dest = "enqueueBatchWindow", metavar = "MS", help = "send the messages received by the probes to the TACS in batches, delayed by up to MS ms, 0 to disable (default: %default)", default = 0.0, type = "float")
+	parser.add_option("--enqueue-batch-size", dest = "enqueueBatchSize", metavar = "COUNT", help = "send up to COUNT messages per batch (default: %default)", default = 100, type = "int")
 
 	(options, args) = parser.parse_args()
 
@@ -162,7 +166,7 @@ def main():
 				logging.getLogger('pyagent').info("Daemonizing...")
 			daemonize(pidFilename = options.pidFilename, displayPid = True)
 
-	agent = Agent.Agent(name = options.name)
+	agent = Agent.Agent(name = options.name, poolSize = options.probeThreads, maxProbeQueueSize = options.probeQueueSize, enqueueBatchWindow = options.enqueueBatchWindow / 1000.0, enqueueBatchSize = options.enqueueBatchSize)
 	agent.initialize(controllerAddress = (options.controllerIp, options.controllerPort), localAddress = (options.localIp, 0))
 	agent.info("Starting agent...")
 	agent.start()